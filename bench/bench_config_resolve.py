@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# Measures how long loading a config and resolving the variables of every file takes.
+#
+#   python3 bench/bench_config_resolve.py [file_count]
+#
+# The config mimics a dotfiles setup: dirs built from a few layers of common
+# variables, entries with their own varDict, 100 files per entry.
+import sys
+import os
+import importlib.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tempfile
+import time
+
+MYINIT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "myinit.py")
+
+def load_myinit():
+    spec = importlib.util.spec_from_file_location("myinit", MYINIT_PATH)
+    myinit = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(myinit)
+    myinit.init()
+    return myinit
+
+def write_config(config_path: str, file_count: int):
+    config_lines = [
+        "specVersion: 1",
+        "confVersion: 1",
+        "id: bench",
+        "commonVarDict:",
+        '  Root: "/tmp/bench/"',
+        '  HomeDir: "{Root}home/"',
+        "  UserHomeDir:",
+        "    refVar: HomeDir",
+        '  ConfigDir: "{UserHomeDir}.config/"',
+        '  WorkspaceDir: "{Root}ws/"',
+        "entries:",
+    ]
+    for file_id in range(file_count):
+        if file_id % 100 == 0:
+            config_lines += [
+                f'  - id: files{file_id // 100}',
+                "    type: file",
+                "    varDict:",
+                f'      AppDir: "{{ConfigDir}}app{file_id // 100}/"',
+                "    files:",
+            ]
+        config_lines += [
+            f'      - name: f{file_id}',
+            f'        archiveDir: "d{file_id % 50}/"',
+            "        systemDir:",
+            "          refVar: AppDir",
+        ]
+    with open(config_path, "w") as f:
+        f.write("\n".join(config_lines) + "\n")
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    myinit = load_myinit()
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        config_path = os.path.join(root_dir, "config.yaml")
+        write_config(config_path, file_count)
+
+        # yaml parsing is timed apart: it does not depend on how variables are resolved
+        start = time.perf_counter()
+        with open(config_path, "r") as f:
+            config = myinit.yaml.safe_load(f)
+        parsed = time.perf_counter()
+        myinit.preprocess_config(config)
+        preprocessed = time.perf_counter()
+        # what pack and unpack do for every file
+        for entry in config["entries"]:
+            for file in entry.get("files", []):
+                myinit.resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config)
+                myinit.resolve_var_ref_in_dict_by_key(file, "systemDir", entry["id"] + "/" + file["name"] + "/", entry, config)
+        resolved = time.perf_counter()
+
+        print(f'files: {file_count}')
+        print(f'parse yaml:        {(parsed - start) * 1000:9.1f}ms')
+        print(f'preprocess_config: {(preprocessed - parsed) * 1000:9.1f}ms')
+        print(f'resolve all dirs:  {(resolved - preprocessed) * 1000:9.1f}ms')
+        print(f'resolution total:  {(resolved - parsed) * 1000:9.1f}ms (preprocess_config and resolve all dirs)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Measures how `myinit unpack` scales with --jobs when applying many small files.
+#
+#   python3 bench/bench_parallel_apply.py [file_count] [max_jobs]
+#
+# Every run unpacks into an empty system dir and workspace ("fresh"), then
+# unpacks the same archive again with every file up to date ("up to date"),
+# and once more after the mode of every file changed ("mode drift").
+import sys
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+MYINIT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "myinit.py")
+
+def make_workspace(root_dir: str, file_count: int) -> str:
+    # dotfile-sized files spread over a few dirs and entries, 500 files per entry
+    rng = random.Random(0)
+    workspace_dir = os.path.join(root_dir, "ws")
+    source_dir = os.path.join(root_dir, "src")
+    os.makedirs(os.path.join(workspace_dir, "__extra__"))
+    config_lines = [
+        "specVersion: 1",
+        "confVersion: 1",
+        "id: bench",
+        "commonVarDict:",
+        f'  SysRoot: "{root_dir}/sys/"',
+        f'  SrcRoot: "{source_dir}/"',
+        f'  WorkspaceDir: "{root_dir}/ws2/"',
+        "entries:",
+    ]
+    for file_id in range(file_count):
+        if file_id % 500 == 0:
+            config_lines += [f'  - id: files{file_id // 500}', "    type: file", "    files:"]
+        dir_name = f'd{file_id % 50}'
+        os.makedirs(os.path.join(source_dir, dir_name), exist_ok=True)
+        with open(os.path.join(source_dir, dir_name, f'f{file_id}'), "wb") as f:
+            f.write(rng.randbytes(rng.randint(256, 8192)))
+        config_lines += [
+            f'      - name: f{file_id}',
+            f'        archiveDir: "{dir_name}/"',
+            f'        systemDir: "{{SysRoot}}{dir_name}/"',
+            '        mode: "0644"',
+        ]
+    with open(os.path.join(workspace_dir, "config.yaml"), "w") as f:
+        f.write("\n".join(config_lines) + "\n")
+
+    # pack reads the files from their systemDir, so the tree is packed from a copy placed there
+    shutil.copytree(source_dir, os.path.join(root_dir, "sys"))
+    subprocess.check_call([sys.executable, MYINIT_PATH, "pack", "-a", "--chunked"], cwd=workspace_dir, stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return os.path.join(workspace_dir, "bench.1.tar.gz")
+
+def unpack(archive_path: str, jobs: int) -> float:
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, MYINIT_PATH, "unpack", "-a", "-j", str(jobs), archive_path], stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def chmod_tree(dir_path: str, mode: int):
+    for dir_name, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            os.chmod(os.path.join(dir_name, file_name), mode)
+
+def main():
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    cpu_count = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    jobs_list = [1]
+    while jobs_list[-1] * 2 <= cpu_count:
+        jobs_list.append(jobs_list[-1] * 2)
+    if jobs_list[-1] != cpu_count:
+        jobs_list.append(cpu_count)
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        archive_path = make_workspace(root_dir, file_count)
+        print(f'files: {file_count}, cpus: {os.cpu_count()}')
+        baselines = {}
+        for jobs in jobs_list:
+            shutil.rmtree(os.path.join(root_dir, "sys"))
+            shutil.rmtree(os.path.join(root_dir, "ws2"), ignore_errors=True)
+            for scenario in ("fresh", "up to date", "mode drift"):
+                if scenario == "mode drift":
+                    chmod_tree(os.path.join(root_dir, "sys"), 0o600)
+                elapsed = unpack(archive_path, jobs)
+                baselines.setdefault(scenario, elapsed)
+                print(f'jobs={jobs:<3} {scenario:<10} {elapsed:7.3f}s {file_count / elapsed:8.0f} files/s  speedup {baselines[scenario] / elapsed:5.2f}x')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# Measures how ParallelCompressWriter (used by `myinit pack`) scales with --jobs.
+#
+#   python3 bench/bench_parallel_gzip.py [size_in_mib] [max_jobs]
+import sys
+import os
+import io
+import gzip
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import myinit
+
+def make_payload(size: int) -> bytes:
+    # text-like data that compresses at roughly the ratio of a dotfile tree
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz_/.") for _ in range(rng.randint(2, 12))) for _ in range(4096)]
+    chunks = []
+    total = 0
+    while total < size:
+        line = b" ".join(rng.choice(words) for _ in range(rng.randint(4, 16))) + b"\n"
+        chunks.append(line)
+        total += len(line)
+    return b"".join(chunks)[:size]
+
+def bench(payload: bytes, jobs: int) -> float:
+    out = io.BytesIO()
+    start = time.perf_counter()
+    writer = myinit.ParallelCompressWriter(out, jobs)
+    for offset in range(0, len(payload), 65536):
+        writer.write(payload[offset:offset + 65536])
+    writer.close()
+    elapsed = time.perf_counter() - start
+    assert gzip.decompress(out.getvalue()) == payload
+    return elapsed
+
+def main():
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 * 1024 * 1024
+    payload = make_payload(size)
+    cpu_count = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+
+    jobs_list = [1]
+    while jobs_list[-1] * 2 <= cpu_count:
+        jobs_list.append(jobs_list[-1] * 2)
+    if jobs_list[-1] != cpu_count:
+        jobs_list.append(cpu_count)
+
+    print(f'payload: {size / 1024 / 1024:.0f} MiB, cpus: {os.cpu_count()}')
+    baseline: float = 0
+    for jobs in jobs_list:
+        elapsed = bench(payload, jobs)
+        if jobs == 1:
+            baseline = elapsed
+        print(f'jobs={jobs:<3} {elapsed:7.3f}s {size / 1024 / 1024 / elapsed:8.1f} MiB/s  speedup {baseline / elapsed:5.2f}x')
+
+if __name__ == "__main__":
+    main()
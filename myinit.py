@@ -4,7 +4,7 @@ import sys
 import getopt
 import os
 from dataclasses import dataclass
-from typing import Tuple, Callable, List, Union, IO
+from typing import Tuple, Callable, List, Union, IO, Awaitable
 import contextlib
 import tarfile
 import subprocess
@@ -18,6 +18,28 @@ import tempfile
 import io
 import shutil
 import traceback
+import json
+import hashlib
+import gzip
+import zlib
+import collections
+import concurrent.futures
+import struct
+import bisect
+import bz2
+import lzma
+import stat
+import sqlite3
+import time
+import difflib
+import fcntl
+import codecs
+import ctypes
+import threading
+import asyncio
+import select
+import shlex
+import secrets
 
 @dataclass
 class CommandFuncEntry:
@@ -62,7 +84,15 @@ def error_color(s: str):
 
 
 dbg_print = do_nothing
-eprint = functools.partial(print, file=sys.stderr)
+def eprint(*args, sep: str = " ", end: str = "\n", file: Union[IO, None] = None, flush: bool = False):
+    # written in one call, so that lines printed by the threads applying files never run into each other;
+    # and not while another thread asks a question (see AskLock)
+    file = file if file is not None else sys.stderr
+    with AskLock:
+        file.write(sep.join(str(arg) for arg in args) + end)
+        if flush:
+            file.flush()
+
 # dbg_print = lambda *args, **kwargs: eprint(info_color(args[0]), *args[1:], **kwargs)
 print = lambda *args, **kwargs: eprint(info_color(args[0]), *args[1:], **kwargs)
 warn_print = lambda *args, **kwargs: eprint(warn_color(args[0]), *args[1:], **kwargs)
@@ -70,187 +100,379 @@ error_print = lambda *args, **kwargs: eprint(error_color(args[0]), *args[1:], **
 input_old = input
 input = lambda *args, **kwargs: input_old(warn_color(args[0]), *args[1:], **kwargs)
 
-AskStorage = {}
-RecognizedOpts = ["yes", "no", "exit", "all", "overwrite", "skip", "resolve"]
-RecognizedOptsNotCapitalized = ["nottoall", "alwaysoverwrite", "alwaysskip", "alwaysresolve"]
+# archive format 2: config.yaml and the member index are stored in front of
+# every other member, so both can be read without scanning the whole archive
+ARCHIVE_FORMAT_VERSION = 2
+ARCHIVE_CONFIG_MEMBER = "config.yaml"
+ARCHIVE_INDEX_MEMBER = "index.json"
 
-def ask(storage_token: str, prompt: str, opts: List[str]):
-    remembered_response: str = AskStorage.get(storage_token, None)
-    if remembered_response is not None:
-        return remembered_response
-
-    capitalized_opts = []
-    one_letter_opts = []
-    for opt in opts:
-        if opt in RecognizedOpts:
-            capitalized_opts.append(opt[0].upper() + opt[1:])
-            one_letter_opts.append(opt[0].lower())
-        elif opt in RecognizedOptsNotCapitalized:
-            capitalized_opts.append(opt)
-            one_letter_opts.append(None)
-        else:
-            raise ValueError(f'unrecognized option: {opt}')
+INSTALLED_LEDGER_FILENAME = "installed.sqlite3"
+BLOB_STORE_DIRNAME = "objects"
+# followed by the pid of the unpack that stages extra files in the workspace, so leftovers of killed runs can be told
+WORKSPACE_STAGING_DIR_PREFIX = ".myinit-staging-"
 
-    while True:
-        if Overrides.get("AskAutomaticallyUseDefault", False):
-            input_value = opts[0]
-        else:
-            input_value = input(prompt + f'[{"/".join(capitalized_opts)}]: ')
+# ioctl cloning a whole file as a copy-on-write reflink (btrfs, xfs, ...)
+FICLONE = 0x40049409
 
-        index: int
-        if input_value == "":
-            input_value = opts[0]
+# system files at least this large are updated in place, rewriting only the blocks that differ
+DELTA_WRITE_MIN_SIZE = 64 * 1024 * 1024
+DELTA_WRITE_BLOCK_SIZE = 128 * 1024
 
-        if input_value.lower() in opts:
-            index = opts.index(input_value.lower())
-        elif input_value[0].lower() in one_letter_opts:
-            index = one_letter_opts.index(input_value.lower())
-        else:
-            continue
+# files are compared and copied in chunks of this size; text/binary is told from the first TEXT_SNIFF_SIZE bytes
+COMPARE_CHUNK_SIZE = 1024 * 1024
+TEXT_SNIFF_SIZE = 8192
 
-        response: str = opts[index]
+# chunked archives end with two empty gzip members: one carrying the chunk
+# index as its comment, and a fixed size footer pointing at that member
+GZIP_FLAG_FEXTRA = 0x04
+GZIP_FLAG_FCOMMENT = 0x10
+GZIP_EMPTY_MEMBER_BODY = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS).flush() + struct.pack("<II", 0, 0)
+CHUNK_INDEX_SUBFIELD_ID = b"MI"
+CHUNK_INDEX_FOOTER_SIZE = 10 + 2 + 4 + 16 + len(GZIP_EMPTY_MEMBER_BODY)
 
-        if response == "exit":
-            sys.exit(1)
+AskStorage = {}
+# held while prompting, so that files applied in parallel never interleave their questions, and nothing is printed over one
+AskLock = threading.RLock()
+RecognizedOpts = ["yes", "no", "exit", "all", "overwrite", "skip", "resolve"]
+RecognizedOptsNotCapitalized = ["nottoall", "alwaysoverwrite", "alwaysskip", "alwaysresolve"]
 
-        if response == "all":
-            response = "yes"
-            AskStorage[storage_token] = "yes"
+# answers read from --answers, used instead of prompting: variable values by prompted name, ask() answers by storage token
+Answers: dict = {"variables": {}, "ask": {}}
+# every answer of this session, written out by --record-answers; None for a question answered differently each time
+RecordedAnswers: dict = {"variables": {}, "ask": {}}
 
-        if response == "nottoall":
-            response = "no"
-            AskStorage[storage_token] = "no"
+def record_answer(kind: str, key: str, value: str):
+    if RecordedAnswers[kind].get(key, value) != value:
+        RecordedAnswers[kind][key] = None
+    else:
+        RecordedAnswers[kind][key] = value
 
-        if response.startswith("always"):
-            response = response[len("always"):]
-            AskStorage[storage_token] = response
-        
-        return response
+def read_answers_file(path: str):
+    with contextlib.closing(open(path, "r")) as f:
+        answers: Union[dict, None] = yaml.safe_load(f)
+    answers = answers if answers is not None else {}
+    assert (isinstance(answers, dict) and set(answers.keys()) <= {"variables", "ask"}), "{}: expected a mapping with variables and ask".format(path)
+    for kind in ("variables", "ask"):
+        kind_answers: dict = answers.get(kind, None) or {}
+        assert (isinstance(kind_answers, dict)), "{}: {} is not a mapping".format(path, kind)
+        for key, value in kind_answers.items():
+            # an unquoted yes/no is a bool to yaml
+            if isinstance(value, bool):
+                value = ("yes" if value else "no") if kind == "ask" else str(value)
+            Answers[kind][str(key)] = str(value)
+
+def write_answers_file(path: str):
+    # answers may hold secrets typed in, so the file is only readable by its owner
+    answers: dict = { kind: { key: value for key, value in RecordedAnswers[kind].items() if value is not None } for kind in ("variables", "ask") }
+    for kind in ("variables", "ask"):
+        for key, value in RecordedAnswers[kind].items():
+            if value is None:
+                warn_print(f'not recording {kind} {key}: answered differently within this run')
+    with contextlib.closing(open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")) as f:
+        yaml.safe_dump(answers, f, default_flow_style=False, allow_unicode=True)
 
-def str_is_true(s: str):
-    return s == "True" or s == "true" or s == "yes" or s == "Yes"
+def ask(storage_token: str, prompt: str, opts: List[str]):
+    with AskLock:
+        remembered_response: str = AskStorage.get(storage_token, None)
+        if remembered_response is not None:
+            return remembered_response
+        answer: Union[str, None] = Answers["ask"].get(storage_token, None)
+
+        capitalized_opts = []
+        one_letter_opts = []
+        for opt in opts:
+            if opt in RecognizedOpts:
+                capitalized_opts.append(opt[0].upper() + opt[1:])
+                one_letter_opts.append(opt[0].lower())
+            elif opt in RecognizedOptsNotCapitalized:
+                capitalized_opts.append(opt)
+                one_letter_opts.append(None)
+            else:
+                raise ValueError(f'unrecognized option: {opt}')
 
-def format_value(value: str, entry: dict, config: dict, depth: int) -> str:
-    dbg_print(f'formatting {value} in {entry["id"] if entry else "<No Entry>"}...')
+        while True:
+            if answer is not None:
+                input_value = answer
+            elif Overrides.get("AskAutomaticallyUseDefault", False):
+                input_value = opts[0]
+            else:
+                input_value = input(prompt + f'[{"/".join(capitalized_opts)}]: ')
 
-    temp_format_dict: dict = {}
-    for _, key_var_name, _, _ in str_formatter.parse(value):
-        if key_var_name is None:
-            continue
+            index: int
+            if input_value == "":
+                input_value = opts[0]
+
+            if input_value.lower() in opts:
+                index = opts.index(input_value.lower())
+            elif input_value[0].lower() in one_letter_opts:
+                index = one_letter_opts.index(input_value.lower())
+            elif answer is not None:
+                raise ValueError(f'answer to {storage_token} is not one of {"/".join(opts)}: {answer}')
+            else:
+                continue
 
-        var_ref: dict = {
-            "refVar": key_var_name
-        }
-        temp_format_dict[key_var_name] = resolve_var_ref(key_var_name, var_ref, entry, config, depth + 1)
+            response: str = opts[index]
+            record_answer("ask", storage_token, response)
 
-    return value.format(**temp_format_dict)
+            if response == "exit":
+                sys.exit(1)
 
-def resolve_var_ref_worker(prompt_var_name: str, var_ref: Union[str, dict], entry: dict, config: dict, depth: int = 0) -> str:
-    if depth >= 100:
-        raise RecursionError("resolve_var_ref: depth limit exceeded")
+            if response == "all":
+                response = "yes"
+                AskStorage[storage_token] = "yes"
 
-    dbg_print(f'resolving {prompt_var_name} in {entry["id"] if entry else "<No Entry>"}...')
+            if response == "nottoall":
+                response = "no"
+                AskStorage[storage_token] = "no"
 
-    if var_ref is None:
-        raise ValueError(f'{prompt_var_name} is None')
+            if response.startswith("always"):
+                response = response[len("always"):]
+                AskStorage[storage_token] = response
+        
+            return response
 
-    if isinstance(var_ref, str):
-        return format_value(var_ref, entry, config, depth)
+def str_is_true(s: str):
+    return s == "True" or s == "true" or s == "yes" or s == "Yes"
 
-    if not isinstance(var_ref, dict):
-        return var_ref
-    
-    var_ref: dict
-    final_value = var_ref.get("final_value", None)
-    if final_value is not None:
-        return final_value
+@functools.lru_cache(maxsize=None)
+def get_format_field_names(value: str) -> Tuple[str, ...]:
+    # a format string is parsed once, however many files share it
+    return tuple(field_name for _, field_name, _, _ in str_formatter.parse(value) if field_name is not None)
+
+def get_var_ref_key(var_ref: Union[str, dict]) -> Union[tuple, None]:
+    # var refs with the same content resolve to the same value, so they share a key; the ones
+    # asking for a value are told apart by identity. None if the var ref is its own value
+    if isinstance(var_ref, str):
+        return ("format", var_ref)
 
     imm_value = var_ref.get("value", None)
     if imm_value is not None:
         if var_ref.get("doNotFormat", False) or not isinstance(imm_value, str):
-            var_ref["final_value"] = imm_value
-        else:
-            var_ref["final_value"] = format_value(imm_value, entry, config, depth) 
-        return var_ref["final_value"]
+            return None
+        return ("format", imm_value)
 
     ref_var_name = var_ref.get("refVar", None)
     if ref_var_name is not None:
-        
-        entry_scope_dict: dict
-        if entry is not None:
-            entry_scope_dict = entry.get("varDict", {})
-        else:
-            entry_scope_dict = {}
-
-        config_scope_dict: dict
-        config_scope_dict = config.get("commonVarDict", {})
-        
-        if ref_var_name in Overrides:
-            refed_var_ref = Overrides[ref_var_name]
-        elif ref_var_name in entry_scope_dict:
-            refed_var_ref = entry_scope_dict[ref_var_name]
-        elif ref_var_name in config_scope_dict:
-            refed_var_ref = config_scope_dict[ref_var_name]
-        elif ref_var_name in Consts:
-            refed_var_ref = Consts[ref_var_name]
-        else:
-            raise KeyError(f'{ref_var_name} unresolved!')
-
-        var_ref["final_value"] = resolve_var_ref(ref_var_name, refed_var_ref, entry, config, depth + 1)
-        return var_ref["final_value"]
-
-    default_value = var_ref.get("defaultValue", None)
-    input_value: str = ""
-    if default_value is not None:
-        will_auto_resolve = resolve_var_ref("ResolvingValueAutomaticallyUseDefault", { "refVar": "ValueAutomaticallyUseDefault" }, entry, config, depth + 1)
-
-        if not will_auto_resolve:
-            input_value = input(f'Input value for variable {prompt_var_name}{("(" + var_ref["description"] + ")") if "description" in var_ref else ""} [Default={default_value}]: ')
-            if input_value == "":
+        return ("refVar", ref_var_name)
+
+    return ("ask", id(var_ref))
+
+class VarResolver:
+    """Resolves the variables of a config, each at most once per scope.
+
+    A var ref resolves to the same value in every entry unless one of the
+    variables it reaches is defined in the varDict of the entry, so values
+    are memoized per (var ref, entry) only for those, and per var ref for
+    the rest. Nothing is resolved, or asked for, before it is used. A
+    variable that ends up referring to itself raises a ValueError naming
+    the cycle.
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.lock = threading.RLock()
+        self.values: dict = {}
+        self.reached_names: dict = {}
+        self.scopes: dict = {}
+        # the ids of asked dicts are part of their key, so the dicts are kept alive
+        self.asked_var_refs: List[dict] = []
+        self.resolving: List[Tuple[tuple, str]] = []
+        self.checked_dirs: set = set()
+
+    def find_var_ref(self, var_name: str, entry: Union[dict, None]) -> Union[str, dict, None]:
+        if var_name in Overrides:
+            return Overrides[var_name]
+        if entry is not None and var_name in entry.get("varDict", {}):
+            return entry["varDict"][var_name]
+        return self.find_common_var_ref(var_name)
+
+    def find_common_var_ref(self, var_name: str) -> Union[str, dict, None]:
+        if var_name in Overrides:
+            return Overrides[var_name]
+        if var_name in self.config.get("commonVarDict", {}):
+            return self.config["commonVarDict"][var_name]
+        if var_name in Consts:
+            return Consts[var_name]
+        return None
+
+    def get_reached_names(self, key: tuple) -> frozenset:
+        # every variable name the var ref may look up, following the definitions outside of
+        # entries; it is a superset of what it looks up in any entry, which is enough to scope it
+        reached_names = self.reached_names.get(key, None)
+        if reached_names is None:
+            names = set()
+            pending = self.get_direct_names(key)
+            while pending:
+                var_name = pending.pop()
+                if var_name in names:
+                    continue
+                names.add(var_name)
+                common_var_ref = self.find_common_var_ref(var_name)
+                if isinstance(common_var_ref, (str, dict)):
+                    common_key = get_var_ref_key(common_var_ref)
+                    if common_key is not None:
+                        pending.extend(self.get_direct_names(common_key))
+            reached_names = self.reached_names[key] = frozenset(names)
+        return reached_names
+
+    def get_direct_names(self, key: tuple) -> List[str]:
+        kind, arg = key
+        if kind == "format":
+            return list(get_format_field_names(arg))
+        if kind == "refVar":
+            return [arg]
+        return ["ValueAutomaticallyUseDefault"]
+
+    def get_scope(self, key: tuple, entry: Union[dict, None]) -> Union[str, None]:
+        if entry is None or not entry.get("varDict", None):
+            return None
+        scope_key: tuple = (key, entry["id"])
+        if scope_key not in self.scopes:
+            entry_var_dict: dict = entry["varDict"]
+            entry_scoped: bool = any(var_name in entry_var_dict and var_name not in Overrides for var_name in self.get_reached_names(key))
+            self.scopes[scope_key] = entry["id"] if entry_scoped else None
+        return self.scopes[scope_key]
+
+    def resolve(self, prompt_var_name: str, var_ref: Union[str, dict], entry: Union[dict, None]):
+        with self.lock:
+            result = self.resolve_unchecked(prompt_var_name, var_ref, entry)
+            self.check_dir(prompt_var_name, result)
+            return result
+
+    def resolve_unchecked(self, prompt_var_name: str, var_ref: Union[str, dict], entry: Union[dict, None]):
+        if var_ref is None:
+            raise ValueError(f'{prompt_var_name} is None')
+
+        if not isinstance(var_ref, (str, dict)):
+            return var_ref
+
+        key = get_var_ref_key(var_ref)
+        if key is None:
+            return var_ref["value"]
+
+        scoped_key = (key, self.get_scope(key, entry))
+        if scoped_key in self.values:
+            return self.values[scoped_key]
+
+        resolving_keys = [resolving_key for resolving_key, _ in self.resolving]
+        if scoped_key in resolving_keys:
+            # var refs with the same content are one node, so the node is named as it was reached again
+            cycle = [prompt_var_name] + [resolving_name for _, resolving_name in self.resolving[resolving_keys.index(scoped_key) + 1:]] + [prompt_var_name]
+            raise ValueError(f'variable depends on itself: {" -> ".join(cycle)}')
+
+        dbg_print(f'resolving {prompt_var_name} in {entry["id"] if entry else "<No Entry>"}...')
+        self.resolving.append((scoped_key, prompt_var_name))
+        try:
+            value = self.evaluate(prompt_var_name, key, var_ref, entry)
+        finally:
+            self.resolving.pop()
+
+        if key[0] == "ask":
+            self.asked_var_refs.append(var_ref)
+        self.values[scoped_key] = value
+        return value
+
+    def resolve_var_name(self, var_name: str, entry: Union[dict, None]):
+        var_ref = self.find_var_ref(var_name, entry)
+        if var_ref is None:
+            raise KeyError(f'{var_name} unresolved!')
+        result = self.resolve_unchecked(var_name, var_ref, entry)
+        self.check_dir(var_name, result)
+        return result
+
+    def evaluate(self, prompt_var_name: str, key: tuple, var_ref: Union[str, dict], entry: Union[dict, None]):
+        kind, arg = key
+        if kind == "format":
+            return arg.format(**{ field_name: self.resolve_var_name(field_name, entry) for field_name in get_format_field_names(arg) })
+
+        if kind == "refVar":
+            return self.resolve_var_name(arg, entry)
+
+        default_value = var_ref.get("defaultValue", None)
+        input_value: str = ""
+        if prompt_var_name in Answers["variables"]:
+            input_value = Answers["variables"][prompt_var_name]
+        elif default_value is not None:
+            will_auto_resolve = self.resolve_var_name("ValueAutomaticallyUseDefault", entry)
+
+            if not will_auto_resolve:
+                input_value = input(f'Input value for variable {prompt_var_name}{("(" + var_ref["description"] + ")") if "description" in var_ref else ""} [Default={default_value}]: ')
+                if input_value == "":
+                    input_value = default_value
+            else:
                 input_value = default_value
         else:
-            input_value = default_value
-    else:
-        input_value = input(f'Input value for variable {prompt_var_name}{("(" + var_ref["description"] + ")") if "description" in var_ref else ""}: ')
+            input_value = input(f'Input value for variable {prompt_var_name}{("(" + var_ref["description"] + ")") if "description" in var_ref else ""}: ')
+
+        record_answer("variables", prompt_var_name, input_value)
+        return input_value
+
+    def check_dir(self, prompt_var_name: str, result):
+        if not prompt_var_name.lower().endswith("dir"):
+            return
+        # asked once per variable and value, not every time a memoized value is used again
+        if isinstance(result, str):
+            if (prompt_var_name, result) in self.checked_dirs:
+                return
+            self.checked_dirs.add((prompt_var_name, result))
+
+        if not result or result[-1] != "/":
+            ask_value: str = ask("does_not_end_with_backslash", f'{prompt_var_name} does not end with a backslash. Continue? ', [
+                    "yes",
+                    "no",
+                    "all",
+                    "exit"
+                ])
 
-    var_ref["final_value"] = input_value
-    return var_ref["final_value"]
+            if ask_value != "yes":
+                sys.exit(1)
 
-def resolve_var_ref(prompt_var_name: str, var_ref: Union[str, dict], entry: dict, config: dict, depth: int = 0) -> str:
-    result: str = resolve_var_ref_worker(prompt_var_name, var_ref, entry, config, depth)
-    if prompt_var_name.lower().endswith("dir") and (not result or result[-1] != "/"):
-        ask_value: str = ask("does_not_end_with_backslash", f'{prompt_var_name} does not end with a backslash. Continue? ', [
-                "yes",
-                "no",
-                "all",
-                "exit"
-            ])
+def get_var_resolver(config: dict) -> VarResolver:
+    var_resolver: Union[VarResolver, None] = config.get("var_resolver", None)
+    if var_resolver is None:
+        var_resolver = config.setdefault("var_resolver", VarResolver(config))
+    return var_resolver
 
-        if ask_value != "yes":
-            sys.exit(1)
-
-    return result
+def resolve_var_ref(prompt_var_name: str, var_ref: Union[str, dict], entry: dict, config: dict) -> str:
+    return get_var_resolver(config).resolve(prompt_var_name, var_ref, entry)
 
 def resolve_var_ref_in_dict_by_key(d: dict, k: str, prompt_var_name_prefix: str, entry: dict, config: dict) -> str:
-    return resolve_var_ref(prompt_var_name_prefix + k, d[k], entry, config, 0)
+    return resolve_var_ref(prompt_var_name_prefix + k, d[k], entry, config)
+
+def get_entry_files_dict(entry: dict, config: dict) -> dict:
+    # archive file path -> file of a file entry, built on first use so that the variables of
+    # entries that are not unpacked are neither resolved nor asked for
+    files_dict: Union[dict, None] = entry.get("files_dict", None)
+    if files_dict is None:
+        files_dict = {}
+        for file in entry.get("files", []):
+            archive_file_path: str = os.path.join(resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
+            files_dict[archive_file_path] = file
+        entry["files_dict"] = files_dict
+    return files_dict
+
 
+def get_notified_handler_ids(d: dict) -> List[str]:
+    # notify is a handler entry id, or a list of them
+    notify: Union[str, List[str]] = d.get("notify", [])
+    return [notify] if isinstance(notify, str) else notify
 
 def preprocess_config(config: dict):
     # dict-ify entries
     entries_dict = {}
     config["entries_dict"] = entries_dict
+    config["var_resolver"] = VarResolver(config)
     
     for entry in config.get("entries", []):
         assert (entry["id"] not in entries_dict), "duplicate entry id: {}".format(entry["id"])
         entries_dict[entry["id"]] = entry
 
-        if entry["type"] == "file":
-            files_dict = {}
-            entry["files_dict"] = files_dict
-            for file in entry.get("files", []):
-                archive_file_path: str = os.path.join(resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
-                files_dict[archive_file_path] = file
-                
+    for entry in config.get("entries", []):
+        for depended_entry_id in entry.get("dependsOn", []):
+            assert (depended_entry_id in entries_dict), "{} depends on unknown entry id: {}".format(entry["id"], depended_entry_id)
+        for notifying in [entry] + entry.get("files", []):
+            for handler_id in get_notified_handler_ids(notifying):
+                assert (entries_dict.get(handler_id, {}).get("handler", False)), "{} notifies {}, which is not a handler entry".format(entry["id"], handler_id)
 
 def read_config_in_path(path: str):
     config: dict
@@ -260,29 +482,1925 @@ def read_config_in_path(path: str):
     preprocess_config(config)
     return config
 
-def read_config_in_archive(archive_path: str) -> Tuple[tarfile.TarFile, dict]:
-    tar = tarfile.open(archive_path, "r:gz")
-    config_member = tar.getmember("config.yaml")
-    config_f = tar.extractfile(config_member)
-    
+class HashingReader:
+    def __init__(self, fileobj: IO):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    @property
+    def closed(self) -> bool:
+        return self.fileobj.closed
+
+    def close(self):
+        self.fileobj.close()
+
+def make_tar_member_bytes(tarinfo: tarfile.TarInfo, data: bytes) -> bytes:
+    tarinfo.size = len(data)
+    blocks, remainder = divmod(len(data), tarfile.BLOCKSIZE)
+    padding = tarfile.NUL * (tarfile.BLOCKSIZE - remainder) if remainder > 0 else b""
+    return tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, "surrogateescape") + data + padding
+
+def compress_gzip_block(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+@dataclass
+class ArchiveCodec:
+    name: str
+    extension: str
+    magic: bytes
+    min_level: int
+    max_level: int
+    default_level: int
+    block_size: int
+    # compresses one block into a self-contained stream; streams of every codec can be concatenated
+    compress_block: Callable[[bytes, int], bytes]
+    open_stream: Callable[[IO], IO]
+    tarfile_mode: str
+
+ARCHIVE_CODECS: List[ArchiveCodec] = [
+    ArchiveCodec("gzip", ".tar.gz", b"\x1f\x8b", 1, 9, 9, 1024 * 1024, compress_gzip_block, lambda raw: gzip.GzipFile(fileobj=raw, mode="rb"), "r:gz"),
+    ArchiveCodec("bz2", ".tar.bz2", b"BZh", 1, 9, 9, 1024 * 1024, lambda data, level: bz2.compress(data, level), lambda raw: bz2.BZ2File(raw, "rb"), "r:bz2"),
+    ArchiveCodec("xz", ".tar.xz", b"\xfd7zXZ\x00", 0, 9, 6, 8 * 1024 * 1024, lambda data, level: lzma.compress(data, preset=level), lambda raw: lzma.LZMAFile(raw, "rb"), "r:xz"),
+    ArchiveCodec("none", ".tar", b"", 0, 0, 0, 1024 * 1024, lambda data, level: data, lambda raw: raw, "r:"),
+]
+ARCHIVE_CODECS_DICT: dict = { codec.name: codec for codec in ARCHIVE_CODECS }
+DEFAULT_ARCHIVE_CODEC = "gzip"
+
+def parse_codec_spec(spec: str) -> Tuple[ArchiveCodec, int]:
+    # <codec>[:<level>], e.g. "xz", "gzip:6", "none"
+    name, _, level_raw = spec.partition(":")
+    if name not in ARCHIVE_CODECS_DICT:
+        raise ValueError(f'unrecognized codec: {name}')
+
+    codec: ArchiveCodec = ARCHIVE_CODECS_DICT[name]
+    level: int = int(level_raw) if level_raw else codec.default_level
+    if level < codec.min_level or level > codec.max_level:
+        raise ValueError(f'invalid level for codec {name}: {level}')
+
+    return codec, level
+
+def detect_codec(head: bytes) -> ArchiveCodec:
+    for codec in ARCHIVE_CODECS:
+        if codec.magic and head.startswith(codec.magic):
+            return codec
+    return ARCHIVE_CODECS_DICT["none"]
+
+def detect_codec_of_file(archive_path: str) -> ArchiveCodec:
+    with contextlib.closing(open(archive_path, "rb")) as f:
+        return detect_codec(f.read(8))
+
+class ParallelCompressWriter:
+    """Compresses everything written to it into fileobj as a series of
+    independently compressed blocks, like pigz.
+
+    Every block is compressed into a self-contained gzip member (or bz2/xz
+    stream) in a thread pool (zlib, bz2 and lzma release the GIL while
+    compressing), and blocks are written out in order, so the stock
+    decompressor of the codec can read the result.
+    """
+
+    def __init__(self, fileobj: IO, jobs: int, codec: ArchiveCodec = ARCHIVE_CODECS_DICT[DEFAULT_ARCHIVE_CODEC], level: Union[int, None] = None):
+        self.fileobj = fileobj
+        self.jobs = jobs
+        self.codec = codec
+        self.level: int = level if level is not None else codec.default_level
+        self.block_size = codec.block_size
+        self.buffer = bytearray()
+        self.position: int = 0
+        self.compressed_position: int = 0
+        self.submitted_position: int = 0
+        # [compressed offset, compressed size, uncompressed offset, uncompressed size] of every gzip member
+        self.chunks: List[List[int]] = []
+        self.pending: collections.deque = collections.deque()
+        self.executor: Union[concurrent.futures.ThreadPoolExecutor, None] = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+        # when off, blocks are only cut by flush_block(), so that the caller can align them to tar members
+        self.auto_split: bool = True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while self.auto_split and len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit_block(block)
+        return len(data)
+
+    def submit_block(self, block: bytes):
+        uncompressed_offset: int = self.submitted_position
+        self.submitted_position += len(block)
+        if self.executor is None:
+            self.write_chunk(self.codec.compress_block(block, self.level), uncompressed_offset, len(block))
+            return
+
+        self.pending.append((self.executor.submit(self.codec.compress_block, block, self.level), uncompressed_offset, len(block)))
+        # bound the memory held by compressed blocks waiting to be written
+        while len(self.pending) > self.jobs * 2:
+            self.write_pending_chunk()
+
+    def write_chunk(self, compressed: bytes, uncompressed_offset: int, uncompressed_size: int):
+        self.fileobj.write(compressed)
+        self.chunks.append([self.compressed_position, len(compressed), uncompressed_offset, uncompressed_size])
+        self.compressed_position += len(compressed)
+
+    def write_pending_chunk(self):
+        future, uncompressed_offset, uncompressed_size = self.pending.popleft()
+        self.write_chunk(future.result(), uncompressed_offset, uncompressed_size)
+
+    def flush_block(self):
+        if self.buffer:
+            self.submit_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def copy_chunk(self, compressed: bytes, uncompressed_size: int):
+        # appends an already compressed block as is, after everything written so far
+        self.flush_block()
+        while self.pending:
+            self.write_pending_chunk()
+        self.write_chunk(compressed, self.submitted_position, uncompressed_size)
+        self.submitted_position += uncompressed_size
+        self.position += uncompressed_size
+
+    def close(self):
+        self.flush_block()
+        while self.pending:
+            self.write_pending_chunk()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+@dataclass
+class ReusableChunkGroup:
+    """Consecutive chunks of a previous chunked archive that hold whole
+    members and nothing else, so they can be copied into a new archive
+    without decompressing them."""
+    names: List[str]
+    # offsets of the member headers, relative to the start of the group
+    offsets: List[int]
+    manifests: List[dict]
+    # [compressed offset, compressed size, uncompressed offset, uncompressed size] in the previous archive
+    chunks: List[List[int]]
+
+def read_reusable_chunk_groups(archive_path: str) -> dict:
+    """Returns the chunk groups of a chunked archive, keyed by the name of
+    their first member. Archives not written with member-aligned chunks have
+    none."""
+    chunk_index: Union[dict, None] = read_chunk_index(archive_path)
+    if chunk_index is None or "eofOffset" not in chunk_index:
+        return {}
+
+    reader = ArchiveReader(archive_path)
+    index: Union[dict, None] = reader.index
+    reader.close()
+    if index is None:
+        return {}
+
+    data_offset: int = chunk_index["dataOffset"]
+    names_by_offset: dict = {data_offset + member_index["offset"]: name for name, member_index in index.items()}
+    member_offsets: List[int] = sorted(names_by_offset.keys())
+    boundaries: set = set(member_offsets)
+    boundaries.add(data_offset + chunk_index["eofOffset"])
+
+    groups: dict = {}
+    group_chunks: List[List[int]] = []
+    for chunk in chunk_index["chunks"]:
+        _, _, uncompressed_offset, uncompressed_size = chunk
+        if not group_chunks and uncompressed_offset not in boundaries:
+            continue
+        group_chunks.append(chunk)
+        if uncompressed_offset + uncompressed_size not in boundaries:
+            continue
+
+        group_start: int = group_chunks[0][2]
+        offsets: List[int] = member_offsets[bisect.bisect_left(member_offsets, group_start):bisect.bisect_left(member_offsets, uncompressed_offset + uncompressed_size)]
+        if offsets:
+            names: List[str] = [names_by_offset[offset] for offset in offsets]
+            groups[names[0]] = ReusableChunkGroup(
+                names=names,
+                offsets=[offset - group_start for offset in offsets],
+                manifests=[index[name] for name in names],
+                chunks=group_chunks,
+            )
+        group_chunks = []
+    return groups
+
+class ArchiveWriter:
+    """Writes a format 2 archive.
+
+    Members are queued by addfile() and written on close, first to a
+    temporary data section, recording their offsets relative to the start of
+    that section. config.yaml and the member index are then written as the
+    first two members, and the data section is appended after them as further
+    compressed blocks.
+
+    In the chunked layout, blocks are cut at member boundaries (members larger
+    than a block start a block of their own). Given a previous chunked
+    archive, runs of members whose header and content are unchanged are
+    copied from it as compressed blocks, without reading or compressing them
+    again.
+
+    Given the config and manifests of a delta base, only members that differ
+    from the base are written; the index records the unchanged and removed
+    members and the base version.
+    """
+
+    def __init__(self, archive_path: str, jobs: int = 1, chunked: bool = False, codec: ArchiveCodec = ARCHIVE_CODECS_DICT[DEFAULT_ARCHIVE_CODEC], level: Union[int, None] = None, previous_archive_path: Union[str, None] = None, ledger: Union["InstalledLedger", None] = None, delta_base_config: Union[dict, None] = None, delta_base_manifests: Union[dict, None] = None):
+        if chunked and codec.name != "gzip":
+            raise ValueError(f'the chunked layout requires the gzip codec, got {codec.name}')
+        if previous_archive_path is not None and not chunked:
+            raise ValueError(f'reusing members of a previous archive requires the chunked layout')
+
+        self.archive_path = archive_path
+        self.chunked = chunked
+        self.previous_archive_path = previous_archive_path
+        self.ledger = ledger
+        self.delta_base_config = delta_base_config
+        self.delta_base_manifests = delta_base_manifests
+        self.data_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(archive_path)))
+        self.data_compressor = ParallelCompressWriter(self.data_file, jobs, codec, level)
+        self.data_compressor.auto_split = not chunked
+        self.data_tar = tarfile.open(fileobj=self.data_compressor, mode="w")
+        self.members: List[Tuple[tarfile.TarInfo, Union[str, None]]] = []
+        self.arcnames: set = set()
+        self.index: dict = {}
+        self.reused_member_count: int = 0
+
+    def gettarinfo(self, name: str, arcname: str, fileobj: Union[IO, None] = None) -> tarfile.TarInfo:
+        return self.data_tar.gettarinfo(name, arcname, fileobj)
+
+    def addfile(self, tarinfo: tarfile.TarInfo, source_path: Union[str, None] = None):
+        self.members.append((tarinfo, source_path))
+        self.arcnames.add(tarinfo.name)
+
+    def add(self, name: str, arcname: str):
+        if arcname in self.arcnames:
+            return
+
+        tarinfo = self.gettarinfo(name, arcname)
+        self.addfile(tarinfo, name if tarinfo.isreg() else None)
+
+        if tarinfo.isdir():
+            for child in sorted(os.listdir(name)):
+                self.add(os.path.join(name, child), os.path.join(arcname, child))
+
+    def header_sha256(self, tarinfo: tarfile.TarInfo) -> str:
+        return hashlib.sha256(tarinfo.tobuf(self.data_tar.format, self.data_tar.encoding, self.data_tar.errors)).hexdigest()
+
+    def source_sha256(self, source_path: str) -> str:
+        if self.ledger is not None:
+            return self.ledger.hash_system_file(source_path)
+        return hash_file(source_path)
+
+    def group_is_unchanged(self, group: ReusableChunkGroup, member_id: int) -> bool:
+        members: List[Tuple[tarfile.TarInfo, Union[str, None]]] = self.members[member_id:member_id + len(group.names)]
+        if len(members) != len(group.names):
+            return False
+        # compare the cheap headers of the whole run before hashing any content
+        for (tarinfo, _), name, manifest in zip(members, group.names, group.manifests):
+            if tarinfo.name != name or manifest.get("header", None) != self.header_sha256(tarinfo):
+                return False
+        for (tarinfo, source_path), manifest in zip(members, group.manifests):
+            if tarinfo.isreg() and self.source_sha256(source_path) != manifest["sha256"]:
+                return False
+        return True
+
+    def copy_group(self, group: ReusableChunkGroup, previous_archive_fd: int):
+        group_offset: int = self.data_tar.offset
+        for compressed_offset, compressed_size, _, uncompressed_size in group.chunks:
+            self.data_compressor.copy_chunk(os.pread(previous_archive_fd, compressed_size, compressed_offset), uncompressed_size)
+            self.data_tar.offset += uncompressed_size
+        for name, offset, manifest in zip(group.names, group.offsets, group.manifests):
+            member_index: dict = dict(manifest)
+            member_index["offset"] = group_offset + offset
+            self.index[name] = member_index
+        self.reused_member_count += len(group.names)
+
+    def make_member_index(self, tarinfo: tarfile.TarInfo, sha256: Union[str, None]) -> dict:
+        member_index: dict = {
+            "header": self.header_sha256(tarinfo),
+        }
+        if tarinfo.isreg():
+            member_index["size"] = tarinfo.size
+            member_index["sha256"] = sha256
+            member_index["mode"] = stat.S_IMODE(tarinfo.mode)
+            member_index["owner"] = f'{tarinfo.uname}:{tarinfo.gname}'
+        return member_index
+
+    def split_delta_members(self) -> dict:
+        # keeps only the members that differ from the delta base in content, mode or owner
+        unchanged: dict = {}
+        changed_members: List[Tuple[tarfile.TarInfo, Union[str, None]]] = []
+        for tarinfo, source_path in self.members:
+            base_manifest: Union[dict, None] = self.delta_base_manifests.get(tarinfo.name, None)
+            member_index: dict = self.make_member_index(tarinfo, self.source_sha256(source_path) if tarinfo.isreg() else None)
+            if base_manifest is not None and all(base_manifest.get(key, None) == member_index.get(key, None) for key in ("size", "sha256", "mode", "owner")):
+                unchanged[tarinfo.name] = member_index
+            else:
+                changed_members.append((tarinfo, source_path))
+        self.members = changed_members
+
+        return {
+            "baseId": self.delta_base_config["id"],
+            "baseConfVersion": str(self.delta_base_config["confVersion"]) if "confVersion" in self.delta_base_config else None,
+            "removed": [name for name in self.delta_base_manifests.keys() if name not in self.arcnames],
+            "unchanged": unchanged,
+        }
+
+    def write_member(self, tarinfo: tarfile.TarInfo, source_path: Union[str, None]):
+        # a member spanning several blocks starts a block of its own, so that its blocks can be reused on their own
+        is_large: bool = self.chunked and tarinfo.size >= self.data_compressor.block_size
+        if is_large:
+            self.data_compressor.flush_block()
+            self.data_compressor.auto_split = True
+
+        offset: int = self.data_tar.offset
+        sha256: Union[str, None] = None
+        if source_path is not None:
+            with contextlib.closing(open(source_path, "rb")) as f:
+                source_stat = os.fstat(f.fileno())
+                hashing_fileobj = HashingReader(f)
+                self.data_tar.addfile(tarinfo, hashing_fileobj)
+            sha256 = hashing_fileobj.hash.hexdigest()
+            if self.ledger is not None:
+                self.ledger.cache_sha256(source_path, source_stat, sha256)
+        else:
+            self.data_tar.addfile(tarinfo)
+
+        member_index: dict = {
+            "offset": offset,
+        }
+        member_index.update(self.make_member_index(tarinfo, sha256))
+        self.index[tarinfo.name] = member_index
+
+        if self.chunked:
+            self.data_compressor.auto_split = False
+            if is_large or len(self.data_compressor.buffer) >= self.data_compressor.block_size:
+                self.data_compressor.flush_block()
+
+    def close(self, config_path: str):
+        with contextlib.closing(open(config_path, "rb")) as f:
+            config_bytes: bytes = f.read()
+        config_member = self.gettarinfo(config_path, ARCHIVE_CONFIG_MEMBER)
+
+        delta: Union[dict, None] = self.split_delta_members() if self.delta_base_config is not None else None
+
+        reusable_groups: dict = read_reusable_chunk_groups(self.previous_archive_path) if self.previous_archive_path is not None else {}
+        previous_archive_fd: Union[int, None] = os.open(self.previous_archive_path, os.O_RDONLY) if reusable_groups else None
+        try:
+            member_id: int = 0
+            while member_id < len(self.members):
+                tarinfo, source_path = self.members[member_id]
+                group: Union[ReusableChunkGroup, None] = reusable_groups.get(tarinfo.name, None)
+                if group is not None and self.group_is_unchanged(group, member_id):
+                    self.copy_group(group, previous_archive_fd)
+                    member_id += len(group.names)
+                    continue
+                self.write_member(tarinfo, source_path)
+                member_id += 1
+        finally:
+            if previous_archive_fd is not None:
+                os.close(previous_archive_fd)
+
+        # the end-of-archive blocks go into a block of their own, so that the block of the last member can be reused
+        self.data_compressor.flush_block()
+        eof_offset: int = self.data_tar.offset
+        self.data_tar.close()
+        self.data_compressor.close()
+
+        archive_index: dict = {
+            "formatVersion": ARCHIVE_FORMAT_VERSION,
+            "members": self.index,
+        }
+        if delta is not None:
+            archive_index["delta"] = delta
+        index_bytes: bytes = json.dumps(archive_index, separators=(",", ":")).encode("utf-8")
+        index_member = tarfile.TarInfo(ARCHIVE_INDEX_MEMBER)
+        index_member.mtime = config_member.mtime
+        index_member.mode = 0o644
+        index_member.uid, index_member.gid, index_member.uname, index_member.gname = config_member.uid, config_member.gid, config_member.uname, config_member.gname
+
+        # the previous archive may have the same name, and is read until here
+        partial_path: str = self.archive_path + ".partial"
+        with contextlib.closing(open(partial_path, "wb")) as archive_file:
+            header_bytes: bytes = make_tar_member_bytes(config_member, config_bytes) + make_tar_member_bytes(index_member, index_bytes)
+            header_compressed: bytes = self.data_compressor.codec.compress_block(header_bytes, self.data_compressor.level)
+            archive_file.write(header_compressed)
+            self.data_file.seek(0)
+            shutil.copyfileobj(self.data_file, archive_file)
+
+            if self.chunked:
+                chunks: List[List[int]] = [[0, len(header_compressed), 0, len(header_bytes)]]
+                for compressed_offset, compressed_size, uncompressed_offset, uncompressed_size in self.data_compressor.chunks:
+                    chunks.append([len(header_compressed) + compressed_offset, compressed_size, len(header_bytes) + uncompressed_offset, uncompressed_size])
+                write_chunk_index(archive_file, {
+                    "formatVersion": ARCHIVE_FORMAT_VERSION,
+                    "dataOffset": len(header_bytes),
+                    "eofOffset": eof_offset,
+                    "chunks": chunks,
+                })
+        os.replace(partial_path, self.archive_path)
+
+        self.data_file.close()
+
+def write_chunk_index(archive_file: IO, chunk_index: dict):
+    index_member_offset: int = archive_file.tell()
+    index_member: bytes = struct.pack("<BBBBIBB", 0x1f, 0x8b, zlib.DEFLATED, GZIP_FLAG_FCOMMENT, 0, 0, 255) + json.dumps(chunk_index, separators=(",", ":")).encode("ascii") + b"\0" + GZIP_EMPTY_MEMBER_BODY
+    archive_file.write(index_member)
+
+    footer_extra: bytes = CHUNK_INDEX_SUBFIELD_ID + struct.pack("<HQQ", 16, index_member_offset, len(index_member))
+    archive_file.write(struct.pack("<BBBBIBBH", 0x1f, 0x8b, zlib.DEFLATED, GZIP_FLAG_FEXTRA, 0, 0, 255, len(footer_extra)) + footer_extra + GZIP_EMPTY_MEMBER_BODY)
+
+def read_chunk_index(archive_path: str) -> Union[dict, None]:
+    with contextlib.closing(open(archive_path, "rb")) as archive_file:
+        archive_file.seek(0, os.SEEK_END)
+        if archive_file.tell() < CHUNK_INDEX_FOOTER_SIZE:
+            return None
+        archive_file.seek(-CHUNK_INDEX_FOOTER_SIZE, os.SEEK_END)
+        footer: bytes = archive_file.read(CHUNK_INDEX_FOOTER_SIZE)
+        if footer[:4] != bytes([0x1f, 0x8b, zlib.DEFLATED, GZIP_FLAG_FEXTRA]) or footer[12:14] != CHUNK_INDEX_SUBFIELD_ID:
+            return None
+        _, index_member_offset, index_member_size = struct.unpack("<HQQ", footer[14:32])
+
+        archive_file.seek(index_member_offset)
+        index_member: bytes = archive_file.read(index_member_size)
+        if index_member[:4] != bytes([0x1f, 0x8b, zlib.DEFLATED, GZIP_FLAG_FCOMMENT]):
+            return None
+        return json.loads(index_member[10:index_member.index(b"\0", 10)].decode("ascii"))
+
+class ChunkedGzipFile:
+    """Read-only, seekable view of the uncompressed content of a chunked archive.
+
+    Only the chunks covering the bytes being read are decompressed. Chunks
+    announced with prefetch() are decompressed ahead in a thread pool, a
+    bounded number at a time.
+    """
+
+    def __init__(self, archive_path: str, chunks: List[List[int]], jobs: int = 1):
+        self.fd = os.open(archive_path, os.O_RDONLY)
+        self.chunks = chunks
+        self.chunk_starts: List[int] = [chunk[2] for chunk in chunks]
+        self.size: int = chunks[-1][2] + chunks[-1][3] if chunks else 0
+        self.position: int = 0
+        self.jobs = jobs
+        self.executor: Union[concurrent.futures.ThreadPoolExecutor, None] = concurrent.futures.ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.planned: collections.deque = collections.deque()
+        self.in_flight: dict = {}
+        self.decompressed: collections.OrderedDict = collections.OrderedDict()
+
+    def decompress_chunk(self, chunk_id: int) -> bytes:
+        compressed_offset, compressed_size, _, _ = self.chunks[chunk_id]
+        return zlib.decompress(os.pread(self.fd, compressed_size, compressed_offset), 16 + zlib.MAX_WBITS)
+
+    def chunk_id_at(self, position: int) -> int:
+        return bisect.bisect_right(self.chunk_starts, position) - 1
+
+    def prefetch(self, ranges: List[Tuple[int, int]]):
+        for start, end in ranges:
+            for chunk_id in range(self.chunk_id_at(start), self.chunk_id_at(max(start, end - 1)) + 1):
+                if not self.planned or self.planned[-1] != chunk_id:
+                    self.planned.append(chunk_id)
+        self.fill()
+
+    def fill(self):
+        if self.executor is None:
+            return
+        while self.planned and len(self.in_flight) < self.jobs * 2:
+            chunk_id = self.planned.popleft()
+            if chunk_id not in self.in_flight and chunk_id not in self.decompressed:
+                self.in_flight[chunk_id] = self.executor.submit(self.decompress_chunk, chunk_id)
+
+    def get_chunk(self, chunk_id: int) -> bytes:
+        data: Union[bytes, None] = self.decompressed.get(chunk_id, None)
+        if data is not None:
+            self.decompressed.move_to_end(chunk_id)
+            return data
+
+        future = self.in_flight.pop(chunk_id, None)
+        data = future.result() if future is not None else self.decompress_chunk(chunk_id)
+        self.decompressed[chunk_id] = data
+        while len(self.decompressed) > 4:
+            self.decompressed.popitem(last=False)
+        self.fill()
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        end: int = self.size if size < 0 else min(self.size, self.position + size)
+        pieces: List[bytes] = []
+        while self.position < end:
+            chunk_id = self.chunk_id_at(self.position)
+            data = self.get_chunk(chunk_id)
+            start_in_chunk: int = self.position - self.chunks[chunk_id][2]
+            piece = data[start_in_chunk:start_in_chunk + end - self.position]
+            if not piece:
+                break
+            pieces.append(piece)
+            self.position += len(piece)
+        return b"".join(pieces)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.in_flight.values():
+                future.cancel()
+            self.executor.shutdown()
+            self.executor = None
+        os.close(self.fd)
+
+class ArchiveReader:
+    """Reads members of an archive by path.
+
+    For format 2 archives the member index is used to seek straight to the
+    header of a member; reading members in the order they are stored never
+    seeks backward in the gzip stream. Chunked archives are read through
+    ChunkedGzipFile, so only the chunks holding requested members are
+    decompressed. Older archives fall back to a single scan of all members.
+    """
+
+    def __init__(self, archive_path: str, is_spool: bool = False, jobs: int = 1):
+        self.archive_path = archive_path
+        self.is_spool = is_spool
+        self.chunked_file: Union[ChunkedGzipFile, None] = None
+
+        self.codec: ArchiveCodec = detect_codec_of_file(archive_path)
+        chunk_index: Union[dict, None] = read_chunk_index(archive_path) if self.codec.name == "gzip" else None
+        if chunk_index is not None:
+            self.chunked_file = ChunkedGzipFile(archive_path, chunk_index["chunks"], jobs)
+            self.tar = tarfile.open(fileobj=self.chunked_file, mode="r:")
+        else:
+            self.tar = tarfile.open(archive_path, self.codec.tarfile_mode)
+        self.members: dict = {}
+        self.index: Union[dict, None] = None
+        self.delta: Union[dict, None] = None
+        self.data_offset: int = 0
+
+        first_member = self.tar.next()
+        if first_member is not None and first_member.name == ARCHIVE_CONFIG_MEMBER:
+            self.members[first_member.name] = first_member
+            index_member = self.tar.next()
+            if index_member is not None and index_member.name == ARCHIVE_INDEX_MEMBER:
+                self.members[index_member.name] = index_member
+                archive_index: dict = json.load(self.tar.extractfile(index_member))
+                self.index = archive_index["members"]
+                self.delta = archive_index.get("delta", None)
+                self.data_offset = self.tar.offset
+
+        if self.index is None:
+            dbg_print(f'{archive_path} has no member index, scanning members...')
+            for tarinfo in self.tar.getmembers():
+                self.members[tarinfo.name] = tarinfo
+
+    def getmember(self, name: str) -> tarfile.TarInfo:
+        tarinfo: Union[tarfile.TarInfo, None] = self.members.get(name, None)
+        if tarinfo is not None:
+            return tarinfo
+
+        if self.index is None or name not in self.index:
+            raise KeyError(f'{name} not found in {self.archive_path}')
+
+        self.tar.fileobj.seek(self.data_offset + self.index[name]["offset"])
+        tarinfo = tarfile.TarInfo.fromtarfile(self.tar)
+        self.members[name] = tarinfo
+        return tarinfo
+
+    def getnames(self) -> List[str]:
+        if self.index is not None:
+            return list(self.index.keys())
+        return list(self.members.keys())
+
+    def getmanifest(self, name: str) -> Union[dict, None]:
+        if self.index is None:
+            return None
+        return self.index.get(name, None)
+
+    def prefetch(self, names: List[str]):
+        if self.chunked_file is None or self.index is None:
+            return
+
+        member_offsets: List[int] = sorted(member_index["offset"] for member_index in self.index.values())
+        ranges: List[Tuple[int, int]] = []
+        for name in names:
+            if name not in self.index:
+                continue
+            offset: int = self.index[name]["offset"]
+            next_offset_pos: int = bisect.bisect_right(member_offsets, offset)
+            end: int = member_offsets[next_offset_pos] if next_offset_pos < len(member_offsets) else self.chunked_file.size - self.data_offset
+            ranges.append((self.data_offset + offset, self.data_offset + end))
+        self.chunked_file.prefetch(ranges)
+
+    def extractfile(self, name: str) -> IO:
+        return self.tar.extractfile(self.getmember(name))
+
+    def extract(self, name: str, path: str):
+        self.tar.extract(self.getmember(name), path)
+
+    def close(self):
+        self.tar.close()
+        if self.chunked_file is not None:
+            self.chunked_file.close()
+        if self.is_spool:
+            os.unlink(self.archive_path)
+
+    def extract_prefix(self, prefix: str, path: str):
+        for name in self.getnames():
+            if name.startswith(prefix):
+                self.extract(name, path)
+
+    def retain(self, prefix: str, staging_dir: Union[str, None]):
+        pass
+
+    def copy_to(self, path: Union[str, None]):
+        if path is not None:
+            shutil.copy2(self.archive_path, path)
+
+class TeeReader:
+    """Copies everything read from fileobj into a sink file. Data read
+    before the sink is attached is buffered in memory."""
+
+    def __init__(self, fileobj: IO):
+        self.fileobj = fileobj
+        self.pending: Union[List[bytes], None] = []
+        self.sink: Union[IO, None] = None
+        self.head: bytes = b""
+
+    def read_through(self, size: int) -> bytes:
+        data = self.fileobj.read(size)
+        if self.sink is not None:
+            self.sink.write(data)
+        elif self.pending is not None:
+            self.pending.append(data)
+        return data
+
+    def peek(self, size: int) -> bytes:
+        while len(self.head) < size:
+            data = self.read_through(size - len(self.head))
+            if not data:
+                break
+            self.head += data
+        return self.head[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        if self.head:
+            data = self.head if size < 0 else self.head[:size]
+            self.head = self.head[len(data):]
+            return data
+        return self.read_through(size)
+
+    def attach(self, sink: Union[IO, None]):
+        if sink is not None:
+            for data in self.pending:
+                sink.write(data)
+        self.pending = None
+        self.sink = sink
+
+    def drain(self):
+        while self.read(65536):
+            pass
+
+class ArchiveNotStreamableError(Exception):
+    def __init__(self, raw: IO, codec: ArchiveCodec):
+        super().__init__("config.yaml is not the first member of the archive")
+        self.raw = raw
+        self.codec = codec
+
+class ArchiveStreamReader:
+    """Reads members of a format 2 archive in a single sequential pass.
+
+    Members must be requested in the order they are stored, which is the
+    order command_unpack consumes them. Members under a retained prefix are
+    staged while passing over them, so they can still be extracted to the
+    workspace at the end. "-" reads the archive from stdin.
+    """
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        self.raw: Union[IO, TeeReader]
+        if archive_path == "-":
+            self.raw = TeeReader(sys.stdin.buffer)
+        else:
+            self.raw = open(archive_path, "rb")
+        self.codec: ArchiveCodec = detect_codec(self.raw.peek(8))
+        self.tar = tarfile.open(fileobj=self.codec.open_stream(self.raw), mode="r|")
+        self.random_access_archive: Union[ArchiveReader, None] = None
+        self.retained_prefix: Union[str, None] = None
+        self.staging_dir: Union[tempfile.TemporaryDirectory, None] = None
+        self.copy_path: Union[str, None] = None
+
+        self.config_member = self.tar.next()
+        if self.config_member is None or self.config_member.name != ARCHIVE_CONFIG_MEMBER:
+            self.tar.close()
+            raise ArchiveNotStreamableError(self.raw, self.codec)
+        self.config_bytes: bytes = self.tar.extractfile(self.config_member).read()
+
+        index_member = self.tar.next()
+        archive_index: dict = json.load(self.tar.extractfile(index_member)) if index_member is not None and index_member.name == ARCHIVE_INDEX_MEMBER else {}
+        self.index: dict = archive_index.get("members", {})
+        self.delta: Union[dict, None] = archive_index.get("delta", None)
+
+    def getnames(self) -> List[str]:
+        return list(self.index.keys())
+
+    def getmanifest(self, name: str) -> Union[dict, None]:
+        return self.index.get(name, None)
+
+    def prefetch(self, names: List[str]):
+        pass
+
+    def retain(self, prefix: str, staging_dir: Union[str, None]):
+        self.retained_prefix = prefix
+        self.staging_dir = tempfile.TemporaryDirectory(prefix=f'{WORKSPACE_STAGING_DIR_PREFIX}{os.getpid()}-', dir=staging_dir)
+
+    def next(self) -> Union[tarfile.TarInfo, None]:
+        tarinfo: Union[tarfile.TarInfo, None] = self.tar.next()
+        if tarinfo is not None and self.retained_prefix is not None and tarinfo.name.startswith(self.retained_prefix):
+            self.tar.extract(tarinfo, self.staging_dir.name)
+        return tarinfo
+
+    def extractfile(self, name: str) -> IO:
+        if name == ARCHIVE_CONFIG_MEMBER:
+            return io.BytesIO(self.config_bytes)
+
+        if self.random_access_archive is None:
+            while True:
+                tarinfo = self.next()
+                if tarinfo is None:
+                    break
+                if tarinfo.name != name:
+                    continue
+                if self.retained_prefix is not None and name.startswith(self.retained_prefix):
+                    return open(os.path.join(self.staging_dir.name, name), "rb")
+                return self.tar.extractfile(tarinfo)
+
+        if self.archive_path == "-":
+            raise KeyError(f'{name} not found ahead in the archive stream')
+
+        # the member is stored out of apply order; fall back to random access
+        if self.random_access_archive is None:
+            self.random_access_archive = ArchiveReader(self.archive_path)
+        return self.random_access_archive.extractfile(name)
+
+    def extract(self, name: str, path: str):
+        if name == ARCHIVE_CONFIG_MEMBER:
+            config_file_path = os.path.join(path, ARCHIVE_CONFIG_MEMBER)
+            with contextlib.closing(open(config_file_path, "wb")) as f:
+                f.write(self.config_bytes)
+            os.chmod(config_file_path, self.config_member.mode)
+            os.utime(config_file_path, (self.config_member.mtime, self.config_member.mtime))
+            return
+
+        file_obj = self.extractfile(name)
+        target_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with contextlib.closing(open(target_path, "wb")) as f:
+            shutil.copyfileobj(file_obj, f)
+
+    def extract_prefix(self, prefix: str, path: str):
+        assert prefix == self.retained_prefix, f'{prefix} is not retained'
+        if self.random_access_archive is None:
+            while self.next() is not None:
+                pass
+
+        staged_prefix_dir = os.path.join(self.staging_dir.name, prefix)
+        for dir_path, _, file_names in os.walk(staged_prefix_dir):
+            target_dir_path = os.path.join(path, os.path.relpath(dir_path, self.staging_dir.name))
+            os.makedirs(target_dir_path, exist_ok=True)
+            shutil.copystat(dir_path, target_dir_path)
+            for file_name in file_names:
+                os.replace(os.path.join(dir_path, file_name), os.path.join(target_dir_path, file_name))
+
+    def copy_to(self, path: Union[str, None]):
+        if isinstance(self.raw, TeeReader):
+            # stdin can not be read twice, so the archive is copied while it is being read
+            self.copy_path = path
+            self.raw.attach(open(path + ".partial", "wb") if path is not None else None)
+        elif path is not None:
+            shutil.copy2(self.archive_path, path)
+
+    def close(self):
+        self.tar.close()
+        if self.random_access_archive is not None:
+            self.random_access_archive.close()
+        if self.staging_dir is not None:
+            self.staging_dir.cleanup()
+
+        if isinstance(self.raw, TeeReader):
+            self.raw.drain()
+            if self.raw.sink is not None:
+                self.raw.sink.close()
+                os.replace(self.copy_path + ".partial", self.copy_path)
+        else:
+            self.raw.close()
+
+def remove_stale_staging_dirs(workspace_dir_obj: pathlib.Path):
+    # staging dirs of unpacks that were killed before cleaning up; the ones of runs still alive are left
+    for staging_dir_obj in workspace_dir_obj.glob(WORKSPACE_STAGING_DIR_PREFIX + "*"):
+        pid_str: str = staging_dir_obj.name[len(WORKSPACE_STAGING_DIR_PREFIX):].partition("-")[0]
+        if pid_str.isdigit() and int(pid_str) != os.getpid():
+            try:
+                os.kill(int(pid_str), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+        print(f'removing stale staging dir: {staging_dir_obj.as_posix()}')
+        shutil.rmtree(staging_dir_obj.as_posix())
+
+def spool_archive_stream(raw: TeeReader, codec: ArchiveCodec) -> str:
+    spool_file = tempfile.NamedTemporaryFile("wb", prefix="myinit-", suffix=codec.extension, delete=False)
+    raw.attach(spool_file)
+    raw.drain()
+    spool_file.close()
+    return spool_file.name
+
+class DeltaArchiveReader:
+    """Reads a delta archive as the full archive it stands for.
+
+    Changed members are read from the delta archive, unchanged ones from its
+    base archive, which is only opened when such a member is read. Members
+    removed since the base are not listed.
+    """
+
+    def __init__(self, delta_archive: Union[ArchiveReader, ArchiveStreamReader], base_archive_path: str, jobs: int = 1):
+        self.delta_archive = delta_archive
+        self.delta: dict = delta_archive.delta
+        self.base_archive_path = base_archive_path
+        self.base_archive: Union[ArchiveReader, "DeltaArchiveReader", None] = None
+        self.jobs = jobs
+        self.codec: ArchiveCodec = delta_archive.codec
+        self.index: dict = dict(self.delta["unchanged"])
+        self.index.update(delta_archive.index)
+
+    def in_delta(self, name: str) -> bool:
+        return name in (ARCHIVE_CONFIG_MEMBER, ARCHIVE_INDEX_MEMBER) or name in self.delta_archive.index
+
+    def get_base_archive(self) -> Union[ArchiveReader, "DeltaArchiveReader"]:
+        if self.base_archive is None:
+            self.base_archive = open_archive_reader(self.base_archive_path, self.jobs)
+        return self.base_archive
+
+    def getmember(self, name: str) -> tarfile.TarInfo:
+        return (self.delta_archive if self.in_delta(name) else self.get_base_archive()).getmember(name)
+
+    def getnames(self) -> List[str]:
+        return list(self.index.keys())
+
+    def getmanifest(self, name: str) -> Union[dict, None]:
+        return self.index.get(name, None)
+
+    def prefetch(self, names: List[str]):
+        self.delta_archive.prefetch([name for name in names if self.in_delta(name)])
+        base_names: List[str] = [name for name in names if not self.in_delta(name)]
+        if base_names:
+            self.get_base_archive().prefetch(base_names)
+
+    def extractfile(self, name: str) -> IO:
+        return (self.delta_archive if self.in_delta(name) else self.get_base_archive()).extractfile(name)
+
+    def extract(self, name: str, path: str):
+        (self.delta_archive if self.in_delta(name) else self.get_base_archive()).extract(name, path)
+
+    def extract_prefix(self, prefix: str, path: str):
+        # the workspace already holds the unchanged members under prefix
+        self.delta_archive.extract_prefix(prefix, path)
+
+    def retain(self, prefix: str, staging_dir: Union[str, None]):
+        self.delta_archive.retain(prefix, staging_dir)
+
+    def copy_to(self, path: Union[str, None]):
+        self.delta_archive.copy_to(path)
+
+    def close(self):
+        self.delta_archive.close()
+        if self.base_archive is not None:
+            self.base_archive.close()
+
+def make_delta_base_config(delta: dict) -> dict:
+    config: dict = {"id": delta["baseId"]}
+    if delta["baseConfVersion"] is not None:
+        config["confVersion"] = delta["baseConfVersion"]
+    return config
+
+def open_archive_reader(archive_path: str, jobs: int = 1) -> Union[ArchiveReader, DeltaArchiveReader]:
+    # the base of a delta archive is looked up next to it
+    archive = ArchiveReader(archive_path, jobs=jobs)
+    if archive.delta is None:
+        return archive
+    base_archive_obj: pathlib.Path = find_archive_in_dir(pathlib.Path(os.path.dirname(os.path.abspath(archive_path))), make_delta_base_config(archive.delta))
+    if not base_archive_obj.exists():
+        archive.close()
+        raise RuntimeError(f'{archive_path} is a delta archive, but its base {base_archive_obj.as_posix()} does not exist')
+    return DeltaArchiveReader(archive, base_archive_obj.as_posix(), jobs)
+
+def attach_delta_base(archive: Union[ArchiveReader, ArchiveStreamReader], archive_path: str, workspace_dir_obj: pathlib.Path, jobs: int = 1) -> DeltaArchiveReader:
+    # a delta only applies on top of the exact version it was made from
+    delta: dict = archive.delta
+    base_version: str = f'{delta["baseId"]} version {delta["baseConfVersion"]}'
+    workspace_conf_obj: pathlib.Path = workspace_dir_obj / "config.yaml"
+    if not workspace_conf_obj.exists():
+        raise RuntimeError(f'{archive_path} is a delta from {base_version}, but nothing is installed in {workspace_dir_obj.as_posix()}. Refusing to apply it.')
+
+    installed_config: dict = read_config_in_path(workspace_conf_obj.as_posix())
+    installed_conf_version: Union[str, None] = str(installed_config["confVersion"]) if "confVersion" in installed_config else None
+    if installed_config["id"] != delta["baseId"] or installed_conf_version != delta["baseConfVersion"]:
+        raise RuntimeError(f'{archive_path} is a delta from {base_version}, but {installed_config["id"]} version {installed_conf_version} is installed. Refusing to apply it.')
+
+    base_archive_obj: pathlib.Path = find_archive_in_dir(workspace_dir_obj, installed_config)
+    if not base_archive_obj.exists():
+        raise RuntimeError(f'{archive_path} is a delta from {base_version}, but {base_archive_obj.as_posix()} does not exist. Refusing to apply it.')
+    return DeltaArchiveReader(archive, base_archive_obj.as_posix(), jobs)
+
+def read_config_in_archive(archive_path: str, stream: bool = False, jobs: int = 1) -> Tuple[Union[ArchiveReader, ArchiveStreamReader], dict]:
+    archive: Union[ArchiveReader, ArchiveStreamReader]
+    if stream and archive_path != "-" and read_chunk_index(archive_path) is not None:
+        # chunked archives are decompressed in parallel, and only where needed
+        archive = ArchiveReader(archive_path, jobs=jobs)
+    elif stream:
+        try:
+            archive = ArchiveStreamReader(archive_path)
+        except ArchiveNotStreamableError as e:
+            # archives of older formats keep config.yaml at the end
+            dbg_print(f'{archive_path} is not streamable, falling back to random access...')
+            if isinstance(e.raw, TeeReader):
+                archive = ArchiveReader(spool_archive_stream(e.raw, e.codec), is_spool=True)
+            else:
+                e.raw.close()
+                archive = ArchiveReader(archive_path)
+    else:
+        archive = ArchiveReader(archive_path)
+    config_f = archive.extractfile(ARCHIVE_CONFIG_MEMBER)
+
     config: dict = yaml.safe_load(config_f)
 
     preprocess_config(config)
     config["commonVarDict"] = config.get("commonVarDict", {})
     config["commonVarDict"]["Archive"] = archive_path
-    return tar, config
+    return archive, config
+
+class InstalledLedger:
+    """Records what unpack installed, per system file, in a SQLite database
+    in the workspace.
+
+    A row keeps the content hash and size of the archive member, the stat of
+    the system file right after it was written, the owner/mode applied and
+    the archive version. Rows are written in one transaction that is only
+    committed when the whole unpack finishes. The connection is shared by the
+    threads applying files, one statement at a time.
+    """
+
+    def __init__(self, ledger_path: str, read_only: bool = False):
+        self.ledger_path = ledger_path
+        if read_only:
+            self.conn = sqlite3.connect(pathlib.Path(ledger_path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(ledger_path, check_same_thread=False)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS installed_files (
+                    system_path TEXT PRIMARY KEY,
+                    entry_id TEXT NOT NULL,
+                    archive_path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER,
+                    dev INTEGER,
+                    inode INTEGER,
+                    mode INTEGER,
+                    uid INTEGER,
+                    gid INTEGER,
+                    config_id TEXT NOT NULL,
+                    conf_version TEXT
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    version_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    config_id TEXT NOT NULL,
+                    conf_version TEXT,
+                    installed_at INTEGER NOT NULL,
+                    config_yaml TEXT NOT NULL
+                )
+            """)
+            # rows without a system path are files of the workspace itself, under the extra archive prefix
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS version_files (
+                    version_id INTEGER NOT NULL,
+                    system_path TEXT,
+                    archive_path TEXT NOT NULL,
+                    entry_id TEXT,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mode INTEGER,
+                    uid INTEGER,
+                    gid INTEGER
+                )
+            """)
+            # the inputs of the last successful run of each onlyIfChanged command entry
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS command_runs (
+                    entry_id TEXT PRIMARY KEY,
+                    inputs_sha256 TEXT NOT NULL,
+                    ran_at INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS stat_cache (
+                    system_path TEXT PRIMARY KEY,
+                    dev INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+            """)
+        self.read_only = read_only
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+
+    def get(self, system_path: str) -> Union[dict, None]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM installed_files WHERE system_path = ?", (system_path,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_all(self) -> List[dict]:
+        return [dict(row) for row in self.conn.execute("SELECT * FROM installed_files ORDER BY rowid")]
+
+    def get_cached_sha256(self, system_path: str, system_file_stat: os.stat_result, installed_record: Union[dict, None] = None) -> Union[str, None]:
+        # the hash of a file is reused as long as (device, inode, size, mtime_ns) is unchanged
+        stat_key: tuple = (system_file_stat.st_dev, system_file_stat.st_ino, system_file_stat.st_size, system_file_stat.st_mtime_ns)
+        if installed_record is not None and (installed_record["dev"], installed_record["inode"], installed_record["size"], installed_record["mtime_ns"]) == stat_key:
+            return installed_record["sha256"]
+
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT dev, inode, size, mtime_ns, sha256 FROM stat_cache WHERE system_path = ?", (system_path,)).fetchone()
+        except sqlite3.OperationalError:
+            # read-only ledgers of older workspaces have no stat cache
+            return None
+        if row is not None and tuple(row)[:4] == stat_key:
+            return row["sha256"]
+        return None
+
+    def cache_sha256(self, system_path: str, system_file_stat: os.stat_result, sha256: str):
+        # a file modified within the mtime granularity right after being hashed would keep its stat, so recent files are not cached
+        if self.read_only or time.time_ns() - system_file_stat.st_mtime_ns < 2 * 1000 * 1000 * 1000:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO stat_cache VALUES (?, ?, ?, ?, ?, ?)", (
+                system_path,
+                system_file_stat.st_dev,
+                system_file_stat.st_ino,
+                system_file_stat.st_size,
+                system_file_stat.st_mtime_ns,
+                sha256,
+            ))
+
+    def hash_system_file(self, system_path: str, installed_record: Union[dict, None] = None) -> str:
+        system_file_stat = os.stat(system_path)
+        sha256: Union[str, None] = self.get_cached_sha256(system_path, system_file_stat, installed_record)
+        if sha256 is None:
+            sha256 = hash_file(system_path)
+            self.cache_sha256(system_path, system_file_stat, sha256)
+        return sha256
+
+    def record(self, system_path: str, entry_id: str, archive_path: str, sha256: str, size: int, config: dict, system_file_has_content: bool = True, system_file_stat: Union[os.stat_result, None] = None):
+        # when the system file does not hold the archive content (e.g. a resolved conflict), its stat is not
+        # recorded, so that the next unpack hashes it and finds it modified. Files written by a helper come with their stat
+        if system_file_stat is None:
+            system_file_stat = os.stat(system_path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO installed_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                system_path,
+                entry_id,
+                archive_path,
+                sha256,
+                size,
+                system_file_stat.st_mtime_ns if system_file_has_content else None,
+                system_file_stat.st_dev if system_file_has_content else None,
+                system_file_stat.st_ino if system_file_has_content else None,
+                stat.S_IMODE(system_file_stat.st_mode),
+                system_file_stat.st_uid,
+                system_file_stat.st_gid,
+                config["id"],
+                str(config["confVersion"]) if "confVersion" in config else None,
+            ))
+
+    def forget(self, system_path: str):
+        self.conn.execute("DELETE FROM installed_files WHERE system_path = ?", (system_path,))
+
+    def record_version(self, config: dict, config_yaml: str, workspace_files: List[Tuple[str, str, int]]) -> int:
+        # a version is a snapshot of every installed file, plus the (archive path, sha256, size) of the workspace files
+        cursor = self.conn.execute("INSERT INTO versions (config_id, conf_version, installed_at, config_yaml) VALUES (?, ?, ?, ?)", (
+            config["id"],
+            str(config["confVersion"]) if "confVersion" in config else None,
+            int(time.time()),
+            config_yaml,
+        ))
+        version_id: int = cursor.lastrowid
+        self.conn.execute("""
+            INSERT INTO version_files
+            SELECT ?, system_path, archive_path, entry_id, sha256, size, mode, uid, gid FROM installed_files ORDER BY rowid
+        """, (version_id,))
+        self.conn.executemany("INSERT INTO version_files VALUES (?, NULL, ?, NULL, ?, ?, NULL, NULL, NULL)", [
+            (version_id, archive_path, sha256, size) for archive_path, sha256, size in workspace_files
+        ])
+        return version_id
+
+    def get_versions(self) -> List[dict]:
+        return [dict(row) for row in self.conn.execute("SELECT * FROM versions ORDER BY version_id")]
+
+    def get_version_files(self, version_id: int) -> List[dict]:
+        return [dict(row) for row in self.conn.execute("SELECT * FROM version_files WHERE version_id = ? ORDER BY rowid", (version_id,))]
 
-def get_system_file_to_read__(path: str, as_user: str) -> IO:
-    # must be a file
-    if as_user == Consts["CurrentUser"]:
-        return open(path, "r")
+    def delete_version(self, version_id: int):
+        self.conn.execute("DELETE FROM version_files WHERE version_id = ?", (version_id,))
+        self.conn.execute("DELETE FROM versions WHERE version_id = ?", (version_id,))
+
+    def get_referenced_sha256s(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT sha256 FROM version_files UNION SELECT sha256 FROM installed_files")}
+
+    def get_command_inputs_sha256(self, entry_id: str) -> Union[str, None]:
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT inputs_sha256 FROM command_runs WHERE entry_id = ?", (entry_id,)).fetchone()
+        except sqlite3.OperationalError:
+            # read-only ledgers of older workspaces have no command runs
+            return None
+        return row["inputs_sha256"] if row is not None else None
+
+    def record_command_run(self, entry_id: str, inputs_sha256: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO command_runs VALUES (?, ?, ?)", (entry_id, inputs_sha256, int(time.time())))
+
+    def system_file_matches(self, system_path: str, installed_record: dict) -> bool:
+        # an unchanged stat means the content is still what was installed; otherwise fall back to hashing
+        return self.hash_system_file(system_path, installed_record) == installed_record["sha256"]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def open_installed_ledger(workspace_dir_obj: pathlib.Path, dry: bool) -> Union[InstalledLedger, None]:
+    ledger_obj: pathlib.Path = workspace_dir_obj / INSTALLED_LEDGER_FILENAME
+    if not dry:
+        return InstalledLedger(ledger_obj.as_posix())
+
+    try:
+        if ledger_obj.exists():
+            return InstalledLedger(ledger_obj.as_posix(), read_only=True)
+    except Exception:
+        error_print(traceback.format_exc())
+    return None
+
+def clone_file(src_path: str, dst_path: str):
+    # a reflink shares the blocks of src_path copy-on-write; other filesystems get a plain copy
+    with contextlib.closing(open(src_path, "rb")) as src_file, contextlib.closing(open(dst_path, "wb")) as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src_file, dst_file)
+
+def write_file_delta(src_fileobj: IO, dst_path: str, block_size: int = DELTA_WRITE_BLOCK_SIZE) -> Tuple[int, int]:
+    """Makes dst_path a copy of the content of src_fileobj by comparing them
+    block by block and rewriting only the blocks that differ, in place.
+    Returns the number of blocks written and the number of blocks read."""
+    written_block_count: int = 0
+    block_count: int = 0
+    offset: int = 0
+    dst_fd: int = os.open(dst_path, os.O_RDWR)
+    try:
+        while True:
+            block: bytes = src_fileobj.read(block_size)
+            if not block:
+                break
+            block_count += 1
+            if os.pread(dst_fd, len(block), offset) != block:
+                os.pwrite(dst_fd, block, offset)
+                written_block_count += 1
+            offset += len(block)
+        os.ftruncate(dst_fd, offset)
+        os.fsync(dst_fd)
+    finally:
+        os.close(dst_fd)
+    return written_block_count, block_count
+
+@functools.lru_cache(maxsize=None)
+def resolve_owner(owner: str) -> Tuple[int, int]:
+    """Resolves an owner as chown takes it ("user", "user:group", "user:",
+    ":group", names or numeric ids) to a (uid, gid) pair, -1 for the part to
+    leave as it is. Cached, as a whole entry usually shares one owner.
+    """
+    owner_user, sep, owner_group = owner.partition(":")
+    uid: int = -1
+    gid: int = -1
+    try:
+        if owner_user:
+            # a numeric id needs no passwd entry, except for "uid:", which takes the login group from it
+            uid = int(owner_user) if owner_user.isdigit() else pwd.getpwnam(owner_user).pw_uid
+            if sep and not owner_group:
+                gid = pwd.getpwuid(uid).pw_gid
+        if owner_group:
+            gid = int(owner_group) if owner_group.isdigit() else grp.getgrnam(owner_group).gr_gid
+    except KeyError:
+        raise RuntimeError(f'invalid owner: {owner}')
+    return uid, gid
+
+def apply_owner_and_mode(path: Union[str, int], owner: Union[str, None], mode: Union[str, None]):
+    # in-process instead of a chown and a chmod per file; path may be the fd of a file still open. Only what differs is
+    # changed, so a file of another user is left alone when it already has its owner and mode
+    path_stat: os.stat_result = os.stat(path)
+    if owner is not None:
+        uid, gid = resolve_owner(owner)
+        if (uid if uid != -1 else path_stat.st_uid, gid if gid != -1 else path_stat.st_gid) != (path_stat.st_uid, path_stat.st_gid):
+            os.chown(path, uid, gid)
+            path_stat = os.stat(path)
+
+    # after chown, which may clear the setuid/setgid bits
+    if mode is not None and int(mode, 8) != stat.S_IMODE(path_stat.st_mode):
+        os.chmod(path, int(mode, 8))
+
+def can_replace_file_beside(target_path: str, target_stat: Union[os.stat_result, None]) -> bool:
+    # the rename needs a writable dir, and a file of another owner can only be replaced by a process that may give the
+    # new file that owner
+    if not os.access(os.path.dirname(target_path), os.W_OK):
+        return False
+    return target_stat is None or os.geteuid() == 0 or (target_stat.st_uid == os.geteuid() and target_stat.st_gid in (os.getegid(), *os.getgroups()))
+
+def write_file_beside(src_fileobj: IO, path: str, owner: Union[str, None], mode: Union[str, None], new_file_mode: int) -> Tuple[str, str]:
+    """Streams src_fileobj into a temp file next to path and gives it its
+    owner and mode. Returns the temp file path and the path it is meant to
+    replace; move_file_into_place puts it there.
+
+    Without owner/mode, an existing file keeps its own and a new file gets
+    new_file_mode. A symlink at path is followed, so its target is the one
+    to replace. An existing file that can not be replaced by a rename is
+    written in place instead: the temp file is then made in the temp dir,
+    and owner and mode are applied when it is moved into place.
+    """
+    target_path: str = os.path.realpath(path)
+    target_stat: Union[os.stat_result, None] = os.stat(target_path) if os.path.exists(target_path) else None
+    if not can_replace_file_beside(target_path, target_stat):
+        temp_fd, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(target_path) + ".")
+        try:
+            with contextlib.closing(open(temp_fd, "wb")) as temp_file:
+                shutil.copyfileobj(src_fileobj, temp_file, COMPARE_CHUNK_SIZE)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path, target_path
+
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), prefix="." + os.path.basename(target_path) + ".")
+    try:
+        with contextlib.closing(open(temp_fd, "wb")) as temp_file:
+            shutil.copyfileobj(src_fileobj, temp_file, COMPARE_CHUNK_SIZE)
+
+            # on the open fd, sparing a path lookup per call
+            if target_stat is not None:
+                if (target_stat.st_uid, target_stat.st_gid) != (os.geteuid(), os.getegid()):
+                    os.chown(temp_fd, target_stat.st_uid, target_stat.st_gid)
+                os.chmod(temp_fd, stat.S_IMODE(target_stat.st_mode))
+            else:
+                os.chmod(temp_fd, new_file_mode)
+            apply_owner_and_mode(temp_fd, owner, mode)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path, target_path
+
+def move_file_into_place(temp_path: str, target_path: str, owner: Union[str, None], mode: Union[str, None]):
+    # a temp file beside its target is renamed over it; one write_file_beside made elsewhere is copied into the target,
+    # which keeps its inode, owner and mode, and is removed
+    if os.path.dirname(temp_path) == os.path.dirname(target_path):
+        os.replace(temp_path, target_path)
+        return
+    with contextlib.closing(open(temp_path, "rb")) as temp_file, contextlib.closing(open(target_path, "r+b")) as target_file:
+        shutil.copyfileobj(temp_file, target_file, COMPARE_CHUNK_SIZE)
+        target_file.truncate()
+        target_file.flush()
+        apply_owner_and_mode(target_file.fileno(), owner, mode)
+    os.unlink(temp_path)
+
+def replace_file_atomically(src_fileobj: IO, path: str, owner: Union[str, None], mode: Union[str, None], new_file_mode: int):
+    # renamed over path once complete, so path is never seen half written or with the wrong permissions (unless it
+    # has to be written in place)
+    temp_path, target_path = write_file_beside(src_fileobj, path, owner, mode, new_file_mode)
+    try:
+        move_file_into_place(temp_path, target_path, owner, mode)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+# the helper runs this as another user, with the python of myinit or through the hidden helper command of a frozen
+# myinit; it only needs the standard library. File contents move in chunks of at most COMPARE_CHUNK_SIZE, through handles
+PRIVILEGED_HELPER_COMMAND = "__helper__"
+PRIVILEGED_HELPER_SOURCE: str = r'''
+import sys, os, json, struct, hashlib, tempfile, stat, errno
+
+# handle -> [file, temp_path, target_path] of files being read (no paths) or written
+handles = {}
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        sys.exit(0)
+    return data
+
+def get_handle(handle):
+    if handle not in handles:
+        raise OSError(errno.EBADF, "no such handle")
+    return handles[handle]
+
+def stat_result_to_list(st):
+    return [list(st), {key: getattr(st, key) for key in ("st_atime", "st_mtime", "st_ctime", "st_atime_ns", "st_mtime_ns", "st_ctime_ns")}]
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def open_file(path, handle):
+    f = open(path, "rb")
+    handles[handle] = [f, None, None]
+    return stat_result_to_list(os.fstat(f.fileno()))
+
+def read_chunk(handle, size):
+    # the handle is closed at the end of the file
+    f = get_handle(handle)[0]
+    data = f.read(size)
+    if len(data) < size:
+        close_handle(handle)
+    return data
+
+def can_replace_beside(target_path, target_stat):
+    if not os.access(os.path.dirname(target_path), os.W_OK):
+        return False
+    return target_stat is None or os.geteuid() == 0 or (target_stat.st_uid == os.geteuid() and target_stat.st_gid in (os.getegid(), *os.getgroups()))
+
+def create_file(path, handle):
+    # a file that can not be replaced by a rename is staged in the temp dir and written in place on commit
+    target_path = os.path.realpath(path)
+    target_stat = os.stat(target_path) if os.path.exists(target_path) else None
+    temp_dir = os.path.dirname(target_path) if can_replace_beside(target_path, target_stat) else None
+    temp_fd, temp_path = tempfile.mkstemp(dir=temp_dir, prefix="." + os.path.basename(target_path) + ".")
+    handles[handle] = [open(temp_fd, "w+b"), temp_path, target_path]
+
+def commit_file(handle, uid, gid, mode, new_file_mode):
+    f, temp_path, target_path = get_handle(handle)
+    target_stat = os.stat(target_path) if os.path.exists(target_path) else None
+    try:
+        if os.path.dirname(temp_path) != os.path.dirname(target_path):
+            f.seek(0)
+            with open(target_path, "r+b") as target_file:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    target_file.write(block)
+                target_file.truncate()
+                target_file.flush()
+                set_owner_and_mode(target_file.fileno(), uid, gid, mode)
+        else:
+            if target_stat is not None:
+                if (target_stat.st_uid, target_stat.st_gid) != (os.geteuid(), os.getegid()):
+                    os.chown(f.fileno(), target_stat.st_uid, target_stat.st_gid)
+                os.chmod(f.fileno(), stat.S_IMODE(target_stat.st_mode))
+            else:
+                os.chmod(f.fileno(), new_file_mode)
+            set_owner_and_mode(f.fileno(), uid, gid, mode)
+            f.close()
+            os.replace(temp_path, target_path)
+    finally:
+        close_handle(handle)
+    return stat_result_to_list(os.stat(target_path))
+
+def close_handle(handle):
+    # a file being written that is not committed is dropped
+    f, temp_path, _ = handles.pop(handle, [None, None, None])
+    if f is not None:
+        f.close()
+    if temp_path is not None and os.path.exists(temp_path):
+        os.unlink(temp_path)
+
+def set_owner_and_mode(path, uid, gid, mode):
+    # only what differs, so a file of another user is left alone when it already has its owner and mode
+    st = os.stat(path)
+    if (uid if uid != -1 else st.st_uid, gid if gid != -1 else st.st_gid) != (st.st_uid, st.st_gid):
+        os.chown(path, uid, gid)
+        st = os.stat(path)
+    if mode is not None and mode != stat.S_IMODE(st.st_mode):
+        os.chmod(path, mode)
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        header_size, body_size = struct.unpack("!II", read_exactly(stdin, 8))
+        ops = json.loads(read_exactly(stdin, header_size))
+        body = read_exactly(stdin, body_size)
+        body_offset = 0
+        results, result_bodies = [], []
+        for op, path, *args in ops:
+            try:
+                if op == "stat":
+                    results.append({"v": stat_result_to_list(os.stat(path))})
+                elif op == "hash":
+                    results.append({"v": hash_file(path)})
+                elif op == "open":
+                    results.append({"v": open_file(path, args[0])})
+                elif op == "read":
+                    result_bodies.append(read_chunk(args[0], args[1]))
+                    results.append({"v": len(result_bodies[-1])})
+                elif op == "create":
+                    create_file(path, args[0])
+                    results.append({"v": None})
+                elif op == "write":
+                    handle, size = args
+                    get_handle(handle)[0].write(body[body_offset:body_offset + size])
+                    body_offset += size
+                    results.append({"v": None})
+                elif op == "commit":
+                    results.append({"v": commit_file(*args)})
+                elif op == "close":
+                    close_handle(args[0])
+                    results.append({"v": None})
+                elif op == "chown_chmod":
+                    uid, gid, mode = args
+                    set_owner_and_mode(path, uid, gid, mode)
+                    results.append({"v": stat_result_to_list(os.stat(path))})
+                elif op == "makedirs":
+                    os.makedirs(path, mode=args[0], exist_ok=True)
+                    results.append({"v": None})
+                else:
+                    results.append({"e": [0, f"unknown operation {op}"]})
+            except OSError as e:
+                results.append({"e": [e.errno or 0, e.strerror or str(e)]})
+        results_header = json.dumps(results).encode()
+        result_body = b"".join(result_bodies)
+        stdout.write(struct.pack("!II", len(results_header), len(result_body)) + results_header)
+        stdout.write(result_body)
+        stdout.flush()
+
+main()
+'''
+
+def get_privileged_helper_argv() -> List[str]:
+    # a myinit frozen by pyinstaller runs no python source, but itself with the hidden helper command
+    if getattr(sys, "frozen", False):
+        return [sys.executable, PRIVILEGED_HELPER_COMMAND]
+    return [sys.executable, "-c", PRIVILEGED_HELPER_SOURCE]
+
+class PrivilegedHelper:
+    """A python process running as another user, started once through sudo,
+    that does the file I/O of the entries with that asUser.
+
+    Requests are frames of a length-prefixed JSON list of operations, with the
+    chunks written appended; each is answered by one frame with the results
+    of all its operations, and the chunks read. Batching operations spares a
+    sudo (and its PAM session) per file, and a round trip per file where the
+    files are known up front. Contents are read and written through handles,
+    a chunk at a time, so no file is ever held whole in memory.
+    """
+
+    def __init__(self, as_user: str):
+        self.as_user = as_user
+        self.lock = threading.Lock()
+        self.handle_ids = iter(range(sys.maxsize))
+        # the helper needs no terminal: sudo asks for a password on the one of myinit, if at all
+        self.proc = subprocess.Popen(["sudo", "-u", as_user] + get_privileged_helper_argv(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd="/")
+
+    def read_exactly(self, size: int) -> bytes:
+        data: bytes = self.proc.stdout.read(size)
+        if len(data) != size:
+            raise RuntimeError(f'the helper process of {self.as_user} exited with status code {self.proc.wait()}')
+        return data
+
+    def call(self, ops: List[list], body: bytes = b"") -> Tuple[List[Union[object, OSError]], bytes]:
+        """Runs a batch of operations. Returns their results in order (an
+        OSError for each failed one), and the content of the read files."""
+        header: bytes = json.dumps(ops).encode()
+        with self.lock:
+            try:
+                self.proc.stdin.write(struct.pack("!II", len(header), len(body)) + header)
+                self.proc.stdin.write(body)
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                raise RuntimeError(f'the helper process of {self.as_user} exited with status code {self.proc.wait()}')
+            results_header_size, result_body_size = struct.unpack("!II", self.read_exactly(8))
+            results: List[dict] = json.loads(self.read_exactly(results_header_size))
+            result_body: bytes = self.read_exactly(result_body_size)
+        return [OSError(result["e"][0], result["e"][1], op[1]) if "e" in result else result["v"] for op, result in zip(ops, results)], result_body
+
+    @staticmethod
+    def make_stat_result(value: list) -> os.stat_result:
+        return os.stat_result(tuple(value[0]), value[1])
+
+    def stat_files(self, paths: List[str]) -> List[Union[os.stat_result, OSError]]:
+        results, _ = self.call([["stat", path] for path in paths])
+        return [result if isinstance(result, OSError) else self.make_stat_result(result) for result in results]
+
+    def hash_files(self, paths: List[str]) -> List[Union[str, OSError]]:
+        results, _ = self.call([["hash", path] for path in paths])
+        return results
+
+    def call_checked(self, ops: List[list], body: bytes = b"") -> Tuple[List[object], bytes]:
+        results, result_body = self.call(ops, body)
+        for result in results:
+            if isinstance(result, OSError):
+                raise result
+        return results, result_body
+
+    def read_file(self, path: str, dst_fileobj: IO) -> os.stat_result:
+        """Copies the file to dst_fileobj. Returns the stat of the file, as
+        opened. A file smaller than a chunk takes a single round trip."""
+        handle: int = next(self.handle_ids)
+        try:
+            results, chunk = self.call_checked([["open", path, handle], ["read", path, handle, COMPARE_CHUNK_SIZE]])
+            system_file_stat: os.stat_result = self.make_stat_result(results[0])
+            dst_fileobj.write(chunk)
+            # the helper closes the handle at the end of the file
+            while len(chunk) == COMPARE_CHUNK_SIZE:
+                _, chunk = self.call_checked([["read", path, handle, COMPARE_CHUNK_SIZE]])
+                dst_fileobj.write(chunk)
+        except BaseException:
+            self.discard_handle(path, handle)
+            raise
+        return system_file_stat
+
+    def write_file(self, path: str, src_fileobj: IO, owner: Union[str, None], mode: Union[str, None], new_file_mode: int) -> os.stat_result:
+        """Same as replace_file_atomically, done as the user of the helper.
+        Returns the stat of the written file."""
+        uid, gid = resolve_owner(owner) if owner is not None else (-1, -1)
+        handle: int = next(self.handle_ids)
+        ops: List[list] = [["create", path, handle]]
+        try:
+            while True:
+                chunk: bytes = src_fileobj.read(COMPARE_CHUNK_SIZE)
+                ops.append(["write", path, handle, len(chunk)])
+                if len(chunk) < COMPARE_CHUNK_SIZE:
+                    ops.append(["commit", path, handle, uid, gid, int(mode, 8) if mode is not None else None, new_file_mode])
+                    results, _ = self.call_checked(ops, chunk)
+                    return self.make_stat_result(results[-1])
+                self.call_checked(ops, chunk)
+                ops = []
+        except BaseException:
+            # drops the temp file beside path
+            self.discard_handle(path, handle)
+            raise
+
+    def discard_handle(self, path: str, handle: int):
+        # after a failed operation; there is nothing to discard if the helper itself is gone
+        if self.proc.poll() is None:
+            self.call([["close", path, handle]])
+
+    def apply_owner_and_mode(self, path: str, owner: Union[str, None], mode: Union[str, None]) -> os.stat_result:
+        uid, gid = resolve_owner(owner) if owner is not None else (-1, -1)
+        results, _ = self.call_checked([["chown_chmod", path, uid, gid, int(mode, 8) if mode is not None else None]])
+        return self.make_stat_result(results[0])
+
+    def makedirs(self, path: str, mode: int):
+        self.call_checked([["makedirs", path, mode]])
+
+    def close(self):
+        # end of input makes the helper exit
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+class PrivilegedHelperPool:
+    """The helpers of the users whose files are accessed, each started on
+    first use and shared by every thread."""
+
+    def __init__(self):
+        self.helpers: dict = {}
+        self.lock = threading.Lock()
+
+    def get(self, as_user: Union[str, None]) -> Union[PrivilegedHelper, None]:
+        # files of entries without asUser, or of the current user, are accessed directly
+        if as_user is None or as_user == Consts["CurrentUser"]:
+            return None
+        with self.lock:
+            if as_user not in self.helpers:
+                self.helpers[as_user] = PrivilegedHelper(as_user)
+            return self.helpers[as_user]
+
+    def close(self):
+        for helper in self.helpers.values():
+            helper.close()
+        self.helpers.clear()
+
+def stat_system_file(path: str, helper: Union[PrivilegedHelper, None]) -> os.stat_result:
+    if helper is None:
+        return os.stat(path)
+    system_file_stat: Union[os.stat_result, OSError] = helper.stat_files([path])[0]
+    if isinstance(system_file_stat, OSError):
+        raise system_file_stat
+    return system_file_stat
+
+def system_file_exists(path: str, helper: Union[PrivilegedHelper, None]) -> bool:
+    try:
+        stat_system_file(path, helper)
+        return True
+    except OSError:
+        return False
+
+def copy_system_file_as_user(helper: PrivilegedHelper, path: str) -> str:
+    # a temp copy of a file that only the helper may read, for what needs it on disk
+    with contextlib.closing(tempfile.NamedTemporaryFile("wb", delete=False)) as temp_file:
+        try:
+            helper.read_file(path, temp_file)
+        except BaseException:
+            os.unlink(temp_file.name)
+            raise
+    return temp_file.name
+
+def hash_system_files_as_user(helper: PrivilegedHelper, paths: List[str], system_file_stats: List[os.stat_result], ledger: Union["InstalledLedger", None], installed_records: Union[List[Union[dict, None]], None] = None) -> List[Union[str, None]]:
+    # the stat cache of the ledger spares hashing unchanged files; the others are hashed by the helper in one batch, None if unreadable
+    sha256s: List[Union[str, None]] = [
+        ledger.get_cached_sha256(path, system_file_stat, installed_records[path_id] if installed_records is not None else None) if ledger is not None else None
+        for path_id, (path, system_file_stat) in enumerate(zip(paths, system_file_stats))
+    ]
+    path_ids_to_hash: List[int] = [path_id for path_id, sha256 in enumerate(sha256s) if sha256 is None]
+    for path_id, sha256 in zip(path_ids_to_hash, helper.hash_files([paths[path_id] for path_id in path_ids_to_hash])):
+        if isinstance(sha256, OSError):
+            continue
+        sha256s[path_id] = sha256
+        if ledger is not None:
+            ledger.cache_sha256(paths[path_id], system_file_stats[path_id], sha256)
+    return sha256s
+
+def sync_filesystems(paths: List[str]):
+    # one syncfs per filesystem instead of one fsync per file
+    syncfs: Union[Callable, None] = getattr(ctypes.CDLL(None, use_errno=True), "syncfs", None)
+    if syncfs is None:
+        os.sync()
+        return
+
+    dir_paths_by_device: dict = {}
+    for path in paths:
+        dir_path: str = os.path.dirname(os.path.abspath(path))
+        dir_paths_by_device.setdefault(os.stat(dir_path).st_dev, dir_path)
+    for dir_path in dir_paths_by_device.values():
+        dir_fd: int = os.open(dir_path, os.O_RDONLY)
+        try:
+            if syncfs(dir_fd) != 0:
+                errno: int = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), dir_path)
+        finally:
+            os.close(dir_fd)
+
+class StagedApply:
+    """Applies file updates as one transaction.
+
+    Updates are staged as temp files next to their targets. commit() makes
+    them durable with one syncfs per touched filesystem, renames them over
+    their targets and syncs again for the renames. Replaced targets are kept
+    as hardlinked backups until every rename succeeded, so a failure at any
+    point leaves all targets as they were. Targets written in place (see
+    write_file_beside) are backed up by a copy, and copied back on failure.
+    Callbacks in after_commit run once the updates are in place.
+    """
+
+    def __init__(self):
+        # (temp path, target path, owner, mode)
+        self.staged: List[Tuple[str, str, Union[str, None], Union[str, None]]] = []
+        self.after_commit: List[Callable[[], None]] = []
+        # reentrant, as a failed commit rolls back
+        self.lock = threading.RLock()
+
+    def add(self, temp_path: str, target_path: str, owner: Union[str, None], mode: Union[str, None], after_commit: Union[Callable[[], None], None] = None):
+        # takes over a temp file from write_file_beside; called from the threads applying files
+        with self.lock:
+            self.staged.append((temp_path, target_path, owner, mode))
+            if after_commit is not None:
+                self.after_commit.append(after_commit)
+
+    def commit(self):
+        with self.lock:
+            if self.staged:
+                sync_filesystems([temp_path for temp_path, _, _, _ in self.staged])
+
+            # (target, backup of the replaced file or None if the target is new, stat of the target written in place)
+            replaced: List[Tuple[str, Union[str, None], Union[os.stat_result, None]]] = []
+            try:
+                for temp_path, target_path, owner, mode in self.staged:
+                    backup_path: Union[str, None] = None
+                    in_place_stat: Union[os.stat_result, None] = None
+                    if os.path.dirname(temp_path) != os.path.dirname(target_path):
+                        backup_path = temp_path + ".orig"
+                        in_place_stat = os.stat(target_path)
+                        shutil.copyfile(target_path, backup_path)
+                    elif os.path.exists(target_path):
+                        backup_path = temp_path + ".orig"
+                        try:
+                            os.link(target_path, backup_path)
+                        except OSError:
+                            shutil.copy2(target_path, backup_path)
+                    # recorded first, as a copy in place can fail half way
+                    replaced.append((target_path, backup_path, in_place_stat))
+                    move_file_into_place(temp_path, target_path, owner, mode)
+                if self.staged:
+                    sync_filesystems([target_path for _, target_path, _, _ in self.staged])
+            except BaseException:
+                for target_path, backup_path, in_place_stat in reversed(replaced):
+                    if in_place_stat is not None:
+                        move_file_into_place(backup_path, target_path, f'{in_place_stat.st_uid}:{in_place_stat.st_gid}', f'{stat.S_IMODE(in_place_stat.st_mode):o}')
+                    elif backup_path is not None:
+                        os.replace(backup_path, target_path)
+                    elif os.path.exists(target_path):
+                        os.unlink(target_path)
+                self.rollback()
+                raise
+
+            for _, backup_path, _ in replaced:
+                if backup_path is not None and os.path.exists(backup_path):
+                    os.unlink(backup_path)
+            self.staged = []
+
+            after_commit: List[Callable[[], None]] = self.after_commit
+            self.after_commit = []
+            for callback in after_commit:
+                callback()
+
+    def rollback(self):
+        with self.lock:
+            for temp_path, _, _, _ in self.staged:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            self.staged = []
+            self.after_commit = []
+
+class OrderedTurns:
+    """Lets threads take turns in the order of their task ids, e.g. to read
+    the members of an archive front to back while the files are applied in
+    parallel.
+
+    Every task id must be marked done, whether it took its turn or not;
+    ids submitted to a pool in order can then never wait on each other in a
+    cycle.
+    """
+
+    def __init__(self):
+        self.next_task_id: int = 0
+        self.done_task_ids: set = set()
+        self.condition = threading.Condition()
+
+    def wait(self, task_id: int):
+        with self.condition:
+            self.condition.wait_for(lambda: self.next_task_id == task_id)
+
+    def done(self, task_id: int):
+        with self.condition:
+            if task_id < self.next_task_id:
+                return
+            self.done_task_ids.add(task_id)
+            while self.next_task_id in self.done_task_ids:
+                self.done_task_ids.remove(self.next_task_id)
+                self.next_task_id += 1
+            self.condition.notify_all()
+
+class BlobStore:
+    """Content-addressed store of installed file contents in the workspace.
+
+    A blob is named after the sha256 of its content, so a content is stored
+    once however many versions refer to it. Blobs are read-only and never
+    handed out as the files they are restored to, so editing a system file
+    can not corrupt the store.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+
+    def get_blob_path(self, sha256: str) -> str:
+        return os.path.join(self.store_dir, sha256[:2], sha256)
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.get_blob_path(sha256))
+
+    def add_file(self, path: str, sha256: Union[str, None] = None) -> Union[str, None]:
+        """Stores a copy of path and returns its sha256. With sha256 given,
+        the copy is only kept if its content has that hash."""
+        if sha256 is not None and self.has(sha256):
+            return sha256
+
+        os.makedirs(self.store_dir, mode=0o0700, exist_ok=True)
+        temp_file = tempfile.NamedTemporaryFile(dir=self.store_dir, prefix=".", delete=False)
+        temp_file.close()
+        try:
+            clone_file(path, temp_file.name)
+            content_sha256: str = hash_file(temp_file.name)
+            if sha256 is not None and content_sha256 != sha256:
+                return None
+            blob_path: str = self.get_blob_path(content_sha256)
+            os.makedirs(os.path.dirname(blob_path), mode=0o0700, exist_ok=True)
+            os.chmod(temp_file.name, 0o0444)
+            os.replace(temp_file.name, blob_path)
+            return content_sha256
+        finally:
+            if os.path.exists(temp_file.name):
+                os.unlink(temp_file.name)
+
+    def restore(self, sha256: str, path: str, mode: Union[int, None] = None, uid: Union[int, None] = None, gid: Union[int, None] = None):
+        # written next to path and renamed over it, so path is never seen half written; a file that can not be
+        # replaced that way is written in place
+        path_stat: Union[os.stat_result, None] = os.stat(path) if os.path.exists(path) else None
+        if not can_replace_file_beside(os.path.abspath(path), path_stat):
+            with contextlib.closing(open(self.get_blob_path(sha256), "rb")) as blob_file:
+                replace_file_atomically(blob_file, path, f'{uid}:{gid}' if uid is not None and gid is not None else None, f'{mode if mode is not None else 0o0644:o}', 0o0644)
+            return
+        temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), prefix="." + os.path.basename(path) + ".", delete=False)
+        temp_file.close()
+        try:
+            clone_file(self.get_blob_path(sha256), temp_file.name)
+            if uid is not None and gid is not None and (uid, gid) != (os.geteuid(), os.getegid()):
+                os.chown(temp_file.name, uid, gid)
+            os.chmod(temp_file.name, mode if mode is not None else 0o0644)
+            os.replace(temp_file.name, path)
+        finally:
+            if os.path.exists(temp_file.name):
+                os.unlink(temp_file.name)
+
+    def gc(self, referenced_sha256s: set, dry: bool = False) -> Tuple[int, int]:
+        """Removes blobs not in referenced_sha256s, and temporary files left
+        by interrupted runs. Returns the number and total size of the removed
+        files."""
+        removed_count: int = 0
+        removed_size: int = 0
+        for dir_path, _, file_names in os.walk(self.store_dir):
+            for file_name in file_names:
+                if file_name in referenced_sha256s:
+                    continue
+                file_path: str = os.path.join(dir_path, file_name)
+                removed_count += 1
+                removed_size += os.lstat(file_path).st_size
+                if not dry:
+                    os.unlink(file_path)
+                else:
+                    print(f'dry: removed {file_path}')
+        return removed_count, removed_size
+
+def remove_installed_file(ledger: InstalledLedger, installed_record: dict, dry: bool):
+    # files no longer shipped are only removed if nobody modified them since they were installed
+    system_file_path: str = installed_record["system_path"]
+    print(f'removing: {system_file_path}')
+    if os.path.exists(system_file_path) and not ledger.system_file_matches(system_file_path, installed_record):
+        warn_print(f'WARNING: {system_file_path} is modified since the installation of last version. Keeping it.')
+    elif not dry:
+        if os.path.exists(system_file_path):
+            os.unlink(system_file_path)
     else:
-        proc = subprocess.Popen(["sudo", "-u", as_user, "cat", path], stdout=subprocess.PIPE)
-        proc.wait()
-        return proc.stdout
-        
-def make_archive_filename(config: dict):
-    return config["id"] + ("." + str(config["confVersion"]) if "confVersion" in config else "") + ".tar.gz"
+        print(f'dry: removed {system_file_path}')
+
+    if not dry:
+        ledger.forget(system_file_path)
+
+def make_archive_filename(config: dict, codec: Union[ArchiveCodec, None] = None):
+    if codec is None:
+        codec, _ = parse_codec_spec(config.get("codec", DEFAULT_ARCHIVE_CODEC))
+    return config["id"] + ("." + str(config["confVersion"]) if "confVersion" in config else "") + codec.extension
+
+def find_previous_chunked_archive(dir_obj: pathlib.Path, config: dict) -> Union[pathlib.Path, None]:
+    # the newest archive of this config in the chunked layout, whatever its version
+    candidates: List[pathlib.Path] = [
+        archive_obj for archive_obj in dir_obj.glob(config["id"] + "*" + ARCHIVE_CODECS_DICT["gzip"].extension)
+        if archive_obj.is_file() and archive_obj.name[len(config["id"]):].startswith(".")
+    ]
+    candidates.sort(key=lambda archive_obj: archive_obj.stat().st_mtime, reverse=True)
+    for archive_obj in candidates:
+        if read_chunk_index(archive_obj.as_posix()) is not None:
+            return archive_obj
+    return None
+
+def find_archive_in_dir(dir_obj: pathlib.Path, config: dict) -> pathlib.Path:
+    # the archive may have been packed with a codec other than the one in config.yaml
+    archive_obj: pathlib.Path = dir_obj / make_archive_filename(config)
+    if archive_obj.exists():
+        return archive_obj
+
+    for codec in ARCHIVE_CODECS:
+        codec_archive_obj: pathlib.Path = dir_obj / make_archive_filename(config, codec)
+        if codec_archive_obj.exists():
+            return codec_archive_obj
+
+    return archive_obj
 
 def config_check_user(config: dict):
     conf_expect_as_user = config.get("expectAsUser", None)
@@ -296,18 +2414,434 @@ def config_check_user(config: dict):
         if ask_value != "yes":
             sys.exit(1)
 
-def file_like_pipe(file_from: IO, file_to: IO):
+def hash_fileobj(fileobj: IO) -> str:
+    file_hash = hashlib.sha256()
+    while True:
+        file_bytes = fileobj.read(1024 * 1024)
+        if not file_bytes:
+            break
+        file_hash.update(file_bytes)
+    return file_hash.hexdigest()
+
+def hash_file(path: str) -> str:
+    with contextlib.closing(open(path, "rb")) as f:
+        return hash_fileobj(f)
+
+def get_member_sha256(archive: "ArchiveReader", archive_file_path: str) -> str:
+    manifest: Union[dict, None] = archive.getmanifest(archive_file_path)
+    if manifest is not None and "sha256" in manifest:
+        return manifest["sha256"]
+
+    # archives without a manifest
+    member_file_obj = archive.extractfile(archive_file_path)
+    try:
+        return hash_fileobj(member_file_obj)
+    finally:
+        member_file_obj.close()
+
+def file_looks_like_text(fileobj: io.BufferedReader) -> bool:
+    # only the first chunk is sniffed, without consuming it: a NUL byte or invalid UTF-8 means binary,
+    # a multibyte sequence cut at the end of the chunk does not
+    head: bytes = fileobj.peek(TEXT_SNIFF_SIZE)[:TEXT_SNIFF_SIZE]
+    if b"\0" in head:
+        return False
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def fileobjs_equal(a_fileobj: IO, b_fileobj: IO) -> bool:
+    # compared chunk by chunk, stopping at the first difference
     while True:
-        file_bytes = file_from.read(8192)
-        if file_bytes:
+        a_bytes: bytes = a_fileobj.read(COMPARE_CHUNK_SIZE)
+        b_bytes: bytes = b_fileobj.read(COMPARE_CHUNK_SIZE)
+        if a_bytes != b_bytes:
+            return False
+        if not a_bytes:
+            return True
+
+def get_file_mode(file: dict) -> Union[str, None]:
+    mode: Union[str, int, None] = file.get("mode")
+    if isinstance(mode, int):
+        if mode < 0o000 or mode > 0o777:
+            raise ValueError(f'invalid mode value: {oct(mode)}')
+
+        mode = oct(mode)[2:]
+    return mode
+
+def system_file_content_is_up_to_date(system_file_path: str, manifest: Union[dict, None], ledger: Union["InstalledLedger", None] = None) -> bool:
+    # compares the content of the system file with the manifest of the archive member
+    if manifest is None or "sha256" not in manifest:
+        return False
+
+    try:
+        system_file_stat = os.stat(system_file_path)
+        if not stat.S_ISREG(system_file_stat.st_mode) or system_file_stat.st_size != manifest["size"]:
+            return False
+
+        if ledger is not None:
+            return ledger.hash_system_file(system_file_path, ledger.get(system_file_path)) == manifest["sha256"]
+        return hash_file(system_file_path) == manifest["sha256"]
+    except (OSError, KeyError, ValueError):
+        return False
+
+def get_up_to_date_system_file_stats_as_user(helper: PrivilegedHelper, paths: List[str], manifests: List[Union[dict, None]], ledger: Union["InstalledLedger", None] = None) -> List[Union[os.stat_result, None]]:
+    """system_file_content_is_up_to_date for a batch of files of a helper.
+    Returns the stat of each file whose content matches its manifest, None
+    for the others. One round trip stats them all, and one more hashes those
+    of the right size that the stat cache misses."""
+    system_file_stats: List[Union[os.stat_result, OSError]] = helper.stat_files(paths)
+    path_ids: List[int] = [
+        path_id for path_id, (manifest, system_file_stat) in enumerate(zip(manifests, system_file_stats))
+        if manifest is not None and "sha256" in manifest and not isinstance(system_file_stat, OSError) and stat.S_ISREG(system_file_stat.st_mode) and system_file_stat.st_size == manifest["size"]
+    ]
+    up_to_date_stats: List[Union[os.stat_result, None]] = [None] * len(paths)
+    sha256s: List[Union[str, None]] = hash_system_files_as_user(helper, [paths[path_id] for path_id in path_ids], [system_file_stats[path_id] for path_id in path_ids], ledger)
+    for path_id, sha256 in zip(path_ids, sha256s):
+        if sha256 == manifests[path_id]["sha256"]:
+            up_to_date_stats[path_id] = system_file_stats[path_id]
+    return up_to_date_stats
+
+def system_file_metadata_is_up_to_date(system_file_stat: os.stat_result, owner: Union[str, None], mode: Union[str, None]) -> bool:
+    # compares mode/owner of the system file with the ones the file entry sets, if any
+    try:
+        if mode is not None and stat.S_IMODE(system_file_stat.st_mode) != int(mode, 8):
+            return False
+
+        if owner is not None:
+            uid, gid = resolve_owner(owner)
+            if uid not in (-1, system_file_stat.st_uid) or gid not in (-1, system_file_stat.st_gid):
+                return False
+        return True
+    except (RuntimeError, ValueError):
+        return False
+
+def entry_is_selected(entry: dict, selector_entry: Union[str, None], selector_entry_prefix: Union[str, None]) -> bool:
+    if selector_entry:
+        if selector_entry != entry["id"]:
+            return False
+
+    if selector_entry_prefix:
+        if not entry["id"].startswith(selector_entry_prefix):
+            return False
+
+    return True
+
+def make_command_entry_bash_command(as_user: Union[str, None], script_path: str) -> Tuple[List[str], dict]:
+    env = os.environ.copy()
+    if as_user is None or as_user == Consts["CurrentUser"]:
+        env["SHLVL"] = "2"
+        return ["bash", "-i", "-l", script_path], env
+    return ["sudo", "-u", as_user, "-i", "SHLVL=2", "bash", "-i", "-l", script_path], env
+
+def write_fifo(fifo_path: str, data: str):
+    with contextlib.closing(open(fifo_path, "w")) as fifo:
+        fifo.write(data)
+
+class PrefixedOutputLines:
+    """The output lines of a command running beside others, as the event loop
+    reads them. Lines read while another thread asks a question are held
+    back and printed after it, instead of blocking the event loop (see
+    eprint) or running into the question."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.held_lines: List[str] = []
+
+    def add(self, line: bytes):
+        self.held_lines.append(f'{self.prefix}{line.decode(errors="replace").rstrip(chr(10))}')
+        if AskLock.acquire(blocking=False):
+            try:
+                self.flush()
+            finally:
+                AskLock.release()
+
+    def flush(self):
+        # waits for a question being asked; called off the event loop
+        if self.held_lines:
+            eprint("\n".join(self.held_lines))
+            self.held_lines.clear()
+
+class ShellSession:
+    """A long-lived login shell of one user, running the scripts of command
+    entries one after another, so its profiles are only loaded once.
+
+    Scripts are written to a FIFO the shell reads its commands from. Each is
+    run by eval in a subshell, so that exit, set -e, cd and syntax errors
+    stay within the entry. The exit status comes back through a second FIFO,
+    or, when the output is piped, as a marker line at its end.
+    """
+
+    def __init__(self, as_user: Union[str, None], piped: bool = False):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.status_fifo_path: str = os.path.join(self.tmp_dir.name, "status")
+        script_fifo_path: str = os.path.join(self.tmp_dir.name, "fifo")
+        os.mkfifo(script_fifo_path)
+        os.mkfifo(self.status_fifo_path)
+        self.token: str = secrets.token_hex(16)
+        self.piped = piped
+
+        self.bash_command, env = make_command_entry_bash_command(as_user, script_fifo_path)
+        self.proc = subprocess.Popen(self.bash_command, env=env, **({"stdin": subprocess.DEVNULL, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT} if piped else {}))
+        # both FIFOs are opened read-write, which never blocks: a shell that fails to start is noticed while waiting for a status
+        self.script_fd: int = os.open(script_fifo_path, os.O_RDWR)
+        self.status_fd: int = os.open(self.status_fifo_path, os.O_RDWR)
+
+    def frame_script(self, script: str) -> str:
+        delimiter: str = f'MYINIT_SCRIPT_{self.token}'
+        status_redirect: str = "" if self.piped else f' > {shlex.quote(self.status_fifo_path)}'
+        status_prefix: str = f'MYINIT_STATUS_{self.token} ' if self.piped else ""
+        return f"""( eval "$(cat <<'{delimiter}'\n{script}\n{delimiter}\n)" )\nprintf '{status_prefix}%s\\n' "$?"{status_redirect}\n"""
+
+    def send_script(self, script: str):
+        framed_script: bytes = self.frame_script(script).encode()
+        while framed_script:
+            framed_script = framed_script[os.write(self.script_fd, framed_script):]
+
+    def check_alive(self):
+        if self.proc.poll() is not None:
+            raise RuntimeError(f'{" ".join(self.bash_command)} exited with status code {self.proc.returncode} during an entry')
+
+    def run(self, script: str) -> int:
+        # the output goes straight to the terminal, the status through the status FIFO
+        self.send_script(script)
+        status_line: bytes = b""
+        while not status_line.endswith(b"\n"):
+            self.check_alive()
+            if select.select([self.status_fd], [], [], 1.0)[0]:
+                status_line += os.read(self.status_fd, 64)
+        return int(status_line)
+
+    async def run_piped(self, script: str, output_prefix: str) -> int:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.send_script, script)
+        status_marker: bytes = f'MYINIT_STATUS_{self.token} '.encode()
+        output_lines = PrefixedOutputLines(output_prefix)
+        try:
+            while True:
+                line: bytes = await loop.run_in_executor(None, self.proc.stdout.readline)
+                if not line:
+                    self.check_alive()
+                    raise RuntimeError(f'{" ".join(self.bash_command)} closed its output during an entry')
+                output, marker, status = line.partition(status_marker)
+                if output:
+                    output_lines.add(output)
+                if marker:
+                    return int(status)
+        finally:
+            await loop.run_in_executor(None, output_lines.flush)
+
+    def close(self):
+        # end of input makes the shell exit
+        os.close(self.script_fd)
+        os.close(self.status_fd)
+        self.proc.wait()
+        if self.proc.stdout is not None:
+            self.proc.stdout.close()
+        self.tmp_dir.cleanup()
+
+class ShellSessionPool:
+    """Keeps the idle shell sessions of each user. Sessions are reused one
+    entry at a time; entries running side by side get a session each."""
+
+    def __init__(self):
+        self.idle_sessions: dict = collections.defaultdict(list)
+        self.sessions: List[ShellSession] = []
+
+    def acquire(self, as_user: Union[str, None], piped: bool = False) -> ShellSession:
+        idle_sessions: List[ShellSession] = self.idle_sessions[(as_user, piped)]
+        if idle_sessions:
+            return idle_sessions.pop()
+        session = ShellSession(as_user, piped)
+        self.sessions.append(session)
+        return session
+
+    def release(self, session: ShellSession, as_user: Union[str, None]):
+        self.idle_sessions[(as_user, session.piped)].append(session)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+        self.idle_sessions.clear()
+
+def run_command_entry(entry: dict, command: str, dry: bool, shell_sessions: Union[ShellSessionPool, None] = None) -> Union[int, None]:
+    print(f'running entry command')
+    if dry:
+        print(f'dry: run command: {command}')
+        return
+
+    # freshShell: true isolates an entry from what the profiles of a reused session left behind
+    as_user: Union[str, None] = entry.get("asUser", None)
+    if shell_sessions is not None and not entry.get("freshShell", False):
+        session: ShellSession = shell_sessions.acquire(as_user)
+        proc_exit_code = session.run(command)
+        shell_sessions.release(session, as_user)
+        if proc_exit_code != 0 and not entry.get("allowFailure", False):
+            raise RuntimeError(f'{" ".join(session.bash_command)} returned status code {proc_exit_code}')
+        return proc_exit_code
+
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        tmp_fifo_path = os.path.join(tmp_dir_path, "fifo")
+        bash_command, env = make_command_entry_bash_command(entry.get("asUser", None), tmp_fifo_path)
+
+        os.mkfifo(tmp_fifo_path)
+        proc = subprocess.Popen(bash_command, env=env)
+        write_fifo(tmp_fifo_path, command)
+
+        proc_exit_code = proc.wait()
+        if proc_exit_code != 0 and not entry.get("allowFailure", False):
+            raise RuntimeError(f'{" ".join(bash_command)} returned status code {proc_exit_code}')
+        return proc_exit_code
+
+async def run_command_entry_async(entry: dict, command: str, dry: bool, shell_sessions: Union[ShellSessionPool, None] = None) -> Union[int, None]:
+    # commands running side by side can not share the terminal: stdin is /dev/null, and every output line is prefixed with the entry id
+    print(f'running entry command: {entry["id"]}')
+    if dry:
+        print(f'dry: run command: {command}')
+        return
+
+    as_user: Union[str, None] = entry.get("asUser", None)
+    if shell_sessions is not None and not entry.get("freshShell", False):
+        session: ShellSession = shell_sessions.acquire(as_user, piped=True)
+        proc_exit_code = await session.run_piped(command, f'[{entry["id"]}] ')
+        shell_sessions.release(session, as_user)
+        if proc_exit_code != 0 and not entry.get("allowFailure", False):
+            raise RuntimeError(f'{entry["id"]}: {" ".join(session.bash_command)} returned status code {proc_exit_code}')
+        return proc_exit_code
+
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        tmp_fifo_path = os.path.join(tmp_dir_path, "fifo")
+        bash_command, env = make_command_entry_bash_command(entry.get("asUser", None), tmp_fifo_path)
+
+        os.mkfifo(tmp_fifo_path)
+        proc = await asyncio.create_subprocess_exec(*bash_command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # opening the fifo blocks until bash opens it
+        await asyncio.get_running_loop().run_in_executor(None, write_fifo, tmp_fifo_path, command)
+
+        output_lines = PrefixedOutputLines(f'[{entry["id"]}] ')
+        try:
             while True:
-                try:
-                    file_to.write(file_bytes)
+                line: bytes = await proc.stdout.readline()
+                if not line:
                     break
-                except BlockingIOError:
-                    continue
+                output_lines.add(line)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, output_lines.flush)
+
+        proc_exit_code = await proc.wait()
+        if proc_exit_code != 0 and not entry.get("allowFailure", False):
+            raise RuntimeError(f'{entry["id"]}: {" ".join(bash_command)} returned status code {proc_exit_code}')
+        return proc_exit_code
+
+def hash_watched_path(path: str, ledger: Union[InstalledLedger, None] = None) -> Union[str, None]:
+    # a directory hashes the relative paths and contents of the files under it; a missing path hashes as None
+    if os.path.isdir(path):
+        file_hashes: List[list] = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path: str = os.path.join(dir_path, file_name)
+                file_hashes.append([os.path.relpath(file_path, path), hash_watched_path(file_path, ledger)])
+        return hashlib.sha256(json.dumps(file_hashes).encode()).hexdigest()
+    if os.path.isfile(path):
+        return ledger.hash_system_file(path) if ledger is not None else hash_file(path)
+    return None
+
+def get_command_inputs_sha256(entry: dict, command: str, config: dict, ledger: Union[InstalledLedger, None] = None) -> str:
+    """Hashes what an onlyIfChanged command entry depends on: its resolved
+    command text, the user it runs as, the variables of the entry and the
+    content of its watchFiles, as they are right before it runs."""
+    inputs: dict = {
+        "command": command,
+        "asUser": entry.get("asUser", None),
+        "variables": {var_name: resolve_var_ref(entry["id"] + "/" + var_name, var_ref, entry, config) for var_name, var_ref in entry.get("varDict", {}).items()},
+        "watchFiles": {},
+    }
+    for watch_file_id, watch_file_var_ref in enumerate(entry.get("watchFiles", [])):
+        watch_file_path: str = resolve_var_ref(f'{entry["id"]}/watchFiles/{watch_file_id}', watch_file_var_ref, entry, config)
+        inputs["watchFiles"][watch_file_path] = hash_watched_path(watch_file_path, ledger)
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_entry_dependencies(entries: List[dict]) -> dict:
+    """Returns the ids of the entries each entry waits for, by entry id.
+
+    An entry without dependsOn waits for the entry before it, as if entries
+    ran one after another. A file entry also waits for the file entry
+    before it, so the archive is still read front to back. Ids of entries
+    not in entries (not selected, or declined) are dropped.
+    """
+    entry_ids: set = {entry["id"] for entry in entries}
+    dependencies: dict = {}
+    previous_entry: Union[dict, None] = None
+    previous_file_entry: Union[dict, None] = None
+    for entry in entries:
+        if "dependsOn" in entry:
+            entry_dependencies: set = {entry_id for entry_id in entry["dependsOn"] if entry_id in entry_ids}
         else:
-            break
+            entry_dependencies = {previous_entry["id"]} if previous_entry is not None else set()
+        if entry["type"] == "file":
+            if previous_file_entry is not None:
+                entry_dependencies.add(previous_file_entry["id"])
+            previous_file_entry = entry
+        dependencies[entry["id"]] = entry_dependencies
+        previous_entry = entry
+
+    # Kahn's algorithm: whatever can not be ordered is on a cycle
+    waiting_counts: dict = {entry_id: len(entry_dependencies) for entry_id, entry_dependencies in dependencies.items()}
+    ready_entry_ids: List[str] = [entry_id for entry_id, waiting_count in waiting_counts.items() if waiting_count == 0]
+    while ready_entry_ids:
+        ready_entry_id: str = ready_entry_ids.pop()
+        for entry_id, entry_dependencies in dependencies.items():
+            if ready_entry_id in entry_dependencies:
+                waiting_counts[entry_id] -= 1
+                if waiting_counts[entry_id] == 0:
+                    ready_entry_ids.append(entry_id)
+    cyclic_entry_ids: List[str] = [entry_id for entry_id, waiting_count in waiting_counts.items() if waiting_count > 0]
+    if cyclic_entry_ids:
+        raise ValueError(f'entries on or waiting for a dependsOn cycle: {", ".join(cyclic_entry_ids)}')
+
+    return dependencies
+
+async def run_entry_graph(entries: List[dict], jobs: int, run_entry: Callable[[dict], Awaitable[None]]):
+    """Runs every entry once the entries it waits for are done (see
+    get_entry_dependencies), at most jobs at a time, and never two entries
+    of the same concurrencyGroup at once.
+
+    After a failure no more entries are started; the first failure is raised
+    once the running entries are finished.
+    """
+    dependencies: dict = get_entry_dependencies(entries)
+    job_semaphore = asyncio.Semaphore(jobs)
+    group_locks: dict = collections.defaultdict(asyncio.Lock)
+    failures: List[BaseException] = []
+    # entry id -> task returning whether the entry succeeded
+    tasks: dict = {}
+
+    async def run_node(entry: dict) -> bool:
+        for entry_id in dependencies[entry["id"]]:
+            if not await tasks[entry_id]:
+                return False
+
+        async with contextlib.AsyncExitStack() as stack:
+            if "concurrencyGroup" in entry:
+                await stack.enter_async_context(group_locks[entry["concurrencyGroup"]])
+            await stack.enter_async_context(job_semaphore)
+            if failures:
+                return False
+            try:
+                await run_entry(entry)
+                return True
+            except (Exception, SystemExit) as e:
+                failures.append(e)
+                return False
+
+    for entry in entries:
+        tasks[entry["id"]] = asyncio.ensure_future(run_node(entry))
+    await asyncio.gather(*tasks.values())
+    if failures:
+        raise failures[0]
 
 def command_unpack(opts: dict, rest_argv: List[str]):
     assert len(rest_argv) > 0 and len(rest_argv) < 3, "incorrect argument number in unpack"
@@ -328,23 +2862,32 @@ def command_unpack(opts: dict, rest_argv: List[str]):
     else:
         selector_entry_prefix = ""
 
-    tar, config = read_config_in_archive(archive_path)
+    archive, config = read_config_in_archive(archive_path, stream=True, jobs=opts["jobs"])
 
     config_check_user(config)
 
     curr_ver_config: Union[dict, None] = None
-    curr_ver_tar: Union[tarfile.TarFile, None] = None
+    curr_ver_archive: Union[ArchiveReader, DeltaArchiveReader, None] = None
+    curr_ver_archive_path: Union[str, None] = None
 
     # check update
     workspace_dir_path = resolve_var_ref_in_dict_by_key(config["commonVarDict"], "WorkspaceDir", "commonVarDict/", None, config)
     workspace_dir_obj = pathlib.Path(workspace_dir_path)
     workspace_conf_obj: pathlib.Path = workspace_dir_obj / "config.yaml"
 
+    if archive.delta is not None:
+        archive = attach_delta_base(archive, archive_path, workspace_dir_obj, opts["jobs"])
+
     if not opts["dry"]:
         workspace_dir_obj.mkdir(mode=0o0700, parents=True, exist_ok=True)
+        remove_stale_staging_dirs(workspace_dir_obj)
     else:
         print(f'dry: created dir {workspace_dir_obj.as_posix()}')
 
+    archive.retain(Consts["ExtraArchiveFilePrefix"], workspace_dir_path if not opts["dry"] else None)
+    if archive_path == "-":
+        archive.copy_to((workspace_dir_obj / make_archive_filename(config, archive.codec)).as_posix() if not opts["dry"] else None)
+
     workspace_conf_exists = False
     try:
         workspace_conf_exists = workspace_conf_obj.exists()
@@ -359,17 +2902,25 @@ def command_unpack(opts: dict, rest_argv: List[str]):
         if ask_value != "yes":
             sys.exit(1)
 
+    ledger: Union[InstalledLedger, None] = open_installed_ledger(workspace_dir_obj, opts["dry"])
+    # every installed content is kept in the workspace, for rollback
+    blob_store: Union[BlobStore, None] = BlobStore((workspace_dir_obj / BLOB_STORE_DIRNAME).as_posix()) if not opts["dry"] else None
+
     if workspace_conf_exists:
         curr_ver_config = read_config_in_path(workspace_conf_obj.as_posix())
         workspace_archive_obj = workspace_dir_obj / make_archive_filename(curr_ver_config)
 
         workspace_archive_exists = False
         try:
+            workspace_archive_obj = find_archive_in_dir(workspace_dir_obj, curr_ver_config)
             workspace_archive_exists = workspace_archive_obj.exists()
         except Exception:
             error_print(traceback.format_exc())
         
-        if not workspace_archive_exists:
+        if not workspace_archive_exists and ledger is not None and ledger.get_versions():
+            # the ledger tells what the previous version installed: its archive is only needed as a delta base
+            curr_ver_archive_path = None
+        elif not workspace_archive_exists:
             ask_value: str = ask("_", f'{workspace_archive_obj.as_posix()} does not exists or the access is denied. If you continue, unpacked files will forcibly overwrite files in the system. Continue? ', [
                 "yes",
                 "no",
@@ -381,156 +2932,189 @@ def command_unpack(opts: dict, rest_argv: List[str]):
 
             curr_ver_config = None
         else:
-            curr_ver_tar, _ = read_config_in_archive(workspace_archive_obj.as_posix())
-
-    entry: dict
-    for entry in config["entries"]:
-        if selector_entry:
-            if selector_entry != entry["id"]:
-                continue
-
-        if selector_entry_prefix:
-            if not entry["id"].startswith(selector_entry_prefix):
-                continue
-
-        print("\n=======\n" + f'entry: {entry["name"] if "name" in entry else entry["id"]}')
-        if entry.get("askForConfirm", False):
-            ask_value: str = ask("entry_ask_for_confirm", f'{entry["id"]}: apply this entry? ', [
-                "yes",
-                "no",
-                "exit"
-            ])
-            if ask_value == "no":
-                continue
-
-        if entry["type"] == "command":
-            command: str = resolve_var_ref_in_dict_by_key(entry, "command", entry["id"] + "/", entry, config)
-            as_user = entry.get("asUser", None)
-            bash_command: List
-
-            print(f'running entry command')
+            # only opened if the ledger lacks a file it should have
+            curr_ver_archive_path = workspace_archive_obj.as_posix()
+
+    # handlers only run when notified
+    selected_entries: List[dict] = [entry for entry in config["entries"] if entry_is_selected(entry, selector_entry, selector_entry_prefix) and not entry.get("handler", False)]
+
+    # with --transactional, file updates are staged, and committed together before each command entry and at the end
+    transaction: Union[StagedApply, None] = StagedApply() if opts["transactional"] and not opts["dry"] else None
+    if transaction is not None and any(entry["type"] == "file" and entry.get("asUser", None) not in (None, Consts["CurrentUser"]) for entry in selected_entries):
+        raise RuntimeError("--transactional can not stage the files of entries with asUser, which are written by a helper process")
+    # files of entries with asUser are accessed through the helper of that user, started on first use
+    helpers = PrivilegedHelperPool()
+    # ids of the handlers notified by files written since the last flush
+    notified_handler_ids: set = set()
+    curr_ver_archive_lock = threading.Lock()
+
+    def get_old_equals_system(entry: dict, archive_file_path: str, system_file_path: str, helper: Union[PrivilegedHelper, None]) -> Union[bool, None]:
+        # whether the system file is still what the previous version installed; None if it was not installed by it
+        nonlocal curr_ver_archive
+        installed_record: Union[dict, None] = ledger.get(system_file_path) if ledger is not None else None
+        if installed_record is not None:
+            if helper is not None:
+                return hash_system_files_as_user(helper, [system_file_path], [stat_system_file(system_file_path, helper)], ledger, [installed_record])[0] == installed_record["sha256"]
+            return ledger.system_file_matches(system_file_path, installed_record)
+
+        curr_ver_entry: Union[dict, None] = curr_ver_config["entries_dict"].get(entry["id"], None) if curr_ver_config else None
+        if curr_ver_entry is not None and archive_file_path in get_entry_files_dict(curr_ver_entry, curr_ver_config):
+            # workspaces written before the ledger existed: compare with the previous archive
+            with curr_ver_archive_lock:
+                if curr_ver_archive is None:
+                    curr_ver_archive = open_archive_reader(curr_ver_archive_path)
+                old_manifest: Union[dict, None] = curr_ver_archive.getmanifest(archive_file_path)
+                if old_manifest is None or "sha256" not in old_manifest:
+                    with contextlib.closing(curr_ver_archive.extractfile(archive_file_path)) as old_file_obj, contextlib.closing(open(system_file_path, "rb") if helper is None else tempfile.TemporaryFile()) as system_file_obj:
+                        if helper is not None:
+                            helper.read_file(system_file_path, system_file_obj)
+                            system_file_obj.seek(0)
+                        return fileobjs_equal(old_file_obj, system_file_obj)
+            if helper is not None:
+                return hash_system_files_as_user(helper, [system_file_path], [stat_system_file(system_file_path, helper)], None)[0] == old_manifest["sha256"]
+            return hash_file(system_file_path) == old_manifest["sha256"]
+
+        return None
+
+    def check_file_up_to_date(entry: dict, file: dict, archive_file_path: str, system_file_path: str, helper_system_file_stat: Union[os.stat_result, None] = None) -> bool:
+        # files of a helper come with the stat their batch found them up to date with, if they are
+        helper: Union[PrivilegedHelper, None] = helpers.get(entry.get("asUser", None))
+        manifest: Union[dict, None] = archive.getmanifest(archive_file_path)
+        if helper is not None:
+            system_file_stat: Union[os.stat_result, None] = helper_system_file_stat
+            if system_file_stat is None:
+                return False
+        else:
+            if not system_file_content_is_up_to_date(system_file_path, manifest, ledger):
+                return False
+            system_file_stat = os.stat(system_file_path)
+
+        owner: Union[str, None] = file.get("owner")
+        mode: Union[str, None] = get_file_mode(file)
+        if system_file_metadata_is_up_to_date(system_file_stat, owner, mode):
+            print(f'up to date: {file["name"]}')
+        else:
+            # the content is already there: only mode/owner are fixed, nothing is copied and no handler is notified
+            print(f'fixing owner/mode: {file["name"]}')
             if not opts["dry"]:
-                with tempfile.TemporaryDirectory() as tmp_dir_path:
-                    tmp_fifo_path = os.path.join(tmp_dir_path, "fifo")
-                    env = os.environ.copy()
-                    if as_user is None or as_user == Consts["CurrentUser"]:
-                        env["SHLVL"] = "2"
-                        bash_command = ["bash", "-i", "-l", tmp_fifo_path]
-                    else:
-                        bash_command = ["sudo", "-u", as_user, "-i", "SHLVL=2", "bash", "-i", "-l", tmp_fifo_path]
-
-                    os.mkfifo(tmp_fifo_path)
-                    proc = subprocess.Popen(bash_command, env=env)
-                    with contextlib.closing(open(tmp_fifo_path, "w")) as fifo:
-                        fifo.write(command)
-
-                    proc_exit_code = proc.wait()
-                    if proc_exit_code != 0 and not entry.get("allowFailure", False):
-                        raise RuntimeError(f'{" ".join(bash_command)} returned status code {proc_exit_code}')
+                if helper is not None:
+                    system_file_stat = helper.apply_owner_and_mode(system_file_path, owner, mode)
+                else:
+                    apply_owner_and_mode(system_file_path, owner, mode)
+                    system_file_stat = os.stat(system_file_path)
             else:
-                print(f'dry: run command: {command}')
-        elif entry["type"] == "file":
-            for file in entry.get("files", []):
-                print(f'unpacking: {file["name"]}')
-
-                archive_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
-                system_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "systemDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
-                expect_when_unpack: str = file.get("expectWhenUnpack", "none")
-
-                decided_operation: Union[str, None] = None
-
-                if expect_when_unpack not in ("notExist", "exist", "none"):
-                    raise ValueError(f'invalid expectWhenUnpack: {expect_when_unpack}')
-
-                if expect_when_unpack == "notExist":
-                    if os.path.exists(system_file_path):
-                        ask_value: str = ask("system_file_path_exists_whether_overwrite", f'{system_file_path} exists, which is unexpected. Overwrite? ', [
-                            "yes",
-                            "no",
-                            "all",
-                            "nottoall",
-                            "exit"
-                        ])
-                        if ask_value == "no":
-                            continue
-                        decided_operation = "overwrite"
-                elif expect_when_unpack == "exist":
-                    if not os.path.exists(system_file_path):
-                        ask_value: str = ask("system_file_path_not_exists", f'{system_file_path} does not exist, which is unexpected. Continue? ', [
-                            "yes",
-                            "no",
-                            "all",
-                            "exit"
-                        ])
-                        if ask_value != "yes":
-                            sys.exit(1)
-
-                system_file_obj: Union[None, IO] = None
-                archive_new_file_obj = tar.extractfile(tar.getmember(archive_file_path))
-                archive_new_tempfile = tempfile.NamedTemporaryFile("r+b", delete=False)
-                archive_old_tempfile = None
-                system_tempfile = None
-                file_like_pipe(archive_new_file_obj, archive_new_tempfile)
-                overwrite_src_file_path: str = archive_new_tempfile.name
-
-                owner: Union[str, None] = file.get("owner")
-                mode: Union[str, None] = file.get("mode")
-                if isinstance(mode, int):
-                    if mode < 0o000 or mode > 0o777:
-                        raise ValueError(f'invalid mode value: {oct(mode)}')
-
-                    mode = oct(mode)[2:]
-                
-                if os.path.exists(system_file_path):
-                    system_file_obj = open(system_file_path, "rb")
-
-                if decided_operation is None and curr_ver_config and archive_file_path in curr_ver_config["entries_dict"].get(entry["id"], {}).get("files_dict", {}) and system_file_obj is not None:
-                    # Compare: system, archive-old, archive-new
-                    archive_old_tempfile = tempfile.NamedTemporaryFile("r+b", delete=False)
-                    system_tempfile = tempfile.NamedTemporaryFile("r+b", delete=False)
-                    
-                    archive_old_file_obj = curr_ver_tar.extractfile(curr_ver_tar.getmember(archive_file_path))
-
-                    file_like_pipe(archive_old_file_obj, archive_old_tempfile)
-                    file_like_pipe(system_file_obj, system_tempfile)
-
-                    archive_old_file_obj.close()
-
-                    archive_old_tempfile.seek(0)
-                    archive_new_tempfile.seek(0)
-                    system_tempfile.seek(0)
-
-                    file_is_text: bool = True
-                    old_equals_system: bool = False
-                    archive_old_tempfile_text: Union[io.TextIOWrapper, None] = None
-                    system_tempfile_text: Union[io.TextIOWrapper, None] = None
+                if owner is not None:
+                    print(f'dry: chowned {system_file_path} to {owner}')
+                if mode is not None:
+                    print(f'dry: chmoded {system_file_path} to {mode}')
+        if ledger is not None and not opts["dry"]:
+            ledger.record(system_file_path, entry["id"], archive_file_path, manifest["sha256"], manifest["size"], config, system_file_stat=system_file_stat)
+            if helper is not None:
+                if not blob_store.has(manifest["sha256"]):
+                    system_file_copy_path: str = copy_system_file_as_user(helper, system_file_path)
                     try:
-                        archive_old_tempfile_text = io.TextIOWrapper(archive_old_tempfile, encoding="utf-8")
-                        system_tempfile_text = io.TextIOWrapper(system_tempfile, encoding="utf-8")
-
-                        if archive_old_tempfile_text.read() == system_tempfile_text.read():
-                            old_equals_system = True
-
-                        io.TextIOWrapper(archive_new_tempfile, encoding="utf-8").read()
-                    except UnicodeDecodeError:
-                        file_is_text = False
-                        if archive_old_tempfile_text:
-                            archive_old_tempfile_text.detach()
-                            del archive_old_tempfile_text
-                        if system_tempfile_text:
-                            system_tempfile_text.detach()
-                            del system_tempfile_text
-
-                        archive_old_tempfile.seek(0)
-                        system_tempfile.seek(0)
-                        if archive_old_tempfile.read() == system_tempfile.read():
-                            old_equals_system = True
-
-                    archive_old_tempfile.close()
-                    archive_new_tempfile.close()
-                    system_tempfile.close()
-
-                    if not old_equals_system and file_is_text:
+                        blob_store.add_file(system_file_copy_path, manifest["sha256"])
+                    finally:
+                        os.unlink(system_file_copy_path)
+            else:
+                blob_store.add_file(system_file_path, manifest["sha256"])
+        return True
+
+    def apply_file(task_id: int, archive_turns: OrderedTurns, entry: dict, file: dict, archive_file_path: str, system_file_path: str):
+        # runs on the pool; the archive is still read front to back, each file reading its member in its turn
+        staged_file_path: Union[str, None] = None
+        resolved_file_path: Union[str, None] = None
+        # files of entries with asUser are staged locally, and read and written by the helper of that user
+        helper: Union[PrivilegedHelper, None] = helpers.get(entry.get("asUser", None))
+        system_file_copy_path: Union[str, None] = None
+        try:
+            print(f'unpacking: {file["name"]}')
+
+            expect_when_unpack: str = file.get("expectWhenUnpack", "none")
+
+            decided_operation: Union[str, None] = None
+
+            if expect_when_unpack not in ("notExist", "exist", "none"):
+                raise ValueError(f'invalid expectWhenUnpack: {expect_when_unpack}')
+
+            if expect_when_unpack == "notExist":
+                if system_file_exists(system_file_path, helper):
+                    ask_value: str = ask("system_file_path_exists_whether_overwrite", f'{system_file_path} exists, which is unexpected. Overwrite? ', [
+                        "yes",
+                        "no",
+                        "all",
+                        "nottoall",
+                        "exit"
+                    ])
+                    if ask_value == "no":
+                        return
+                    decided_operation = "overwrite"
+            elif expect_when_unpack == "exist":
+                if not system_file_exists(system_file_path, helper):
+                    ask_value: str = ask("system_file_path_not_exists", f'{system_file_path} does not exist, which is unexpected. Continue? ', [
+                        "yes",
+                        "no",
+                        "all",
+                        "exit"
+                    ])
+                    if ask_value != "yes":
+                        sys.exit(1)
+
+            owner: Union[str, None] = file.get("owner")
+            mode: Union[str, None] = get_file_mode(file)
+            manifest: Union[dict, None] = archive.getmanifest(archive_file_path)
+
+            # Compare: system, installed, archive-new
+            old_equals_system: Union[bool, None] = None
+            if decided_operation is None and system_file_exists(system_file_path, helper):
+                old_equals_system = get_old_equals_system(entry, archive_file_path, system_file_path, helper)
+            # still undecided from here on means a conflict, settled once the new member is at hand
+            if decided_operation is None and old_equals_system is not False:
+                decided_operation = "overwrite"
+
+            if decided_operation == "overwrite":
+                system_dir_path = pathlib.Path(os.path.abspath(os.path.dirname(system_file_path)))
+                if not opts["dry"] and helper is not None:
+                    helper.makedirs(system_dir_path.as_posix(), 0o0111 | int(mode, 8) if mode is not None else 0o0777)
+                elif not opts["dry"]:
+                    system_dir_path.mkdir(mode=0o0111 | int(mode, 8) if mode is not None else 0o0777, parents=True, exist_ok=True)
+                else:
+                    print(f'dry: created dir {system_dir_path.as_posix()}')
+
+            # the new member is written beside the system file (or to a temp file, when dry) while the archive is
+            # read, and only hashed on the way for archives without a manifest
+            new_file_mode: int = manifest.get("mode", 0o0600) if manifest is not None else 0o0600
+            archive_new_sha256: Union[str, None] = manifest["sha256"] if manifest is not None and "sha256" in manifest else None
+            archive_new_size: Union[int, None] = manifest["size"] if archive_new_sha256 is not None else None
+            # in-place block rewrites can not be rolled back, so with --transactional every file is staged whole
+            delta_write: bool = decided_operation == "overwrite" and transaction is None and helper is None and archive_new_size is not None and archive_new_size >= DELTA_WRITE_MIN_SIZE and os.path.isfile(system_file_path)
+            archive_turns.wait(task_id)
+            if not opts["dry"] or decided_operation is None:
+                with contextlib.closing(archive.extractfile(archive_file_path)) as archive_new_file_obj:
+                    src_file_obj: Union[IO, HashingReader] = archive_new_file_obj if archive_new_sha256 is not None else HashingReader(archive_new_file_obj)
+                    if opts["dry"] or helper is not None:
+                        with contextlib.closing(tempfile.NamedTemporaryFile("wb", delete=False)) as archive_new_tempfile:
+                            staged_file_path = archive_new_tempfile.name
+                            shutil.copyfileobj(src_file_obj, archive_new_tempfile, COMPARE_CHUNK_SIZE)
+                    elif delta_write:
+                        written_block_count, block_count = write_file_delta(src_file_obj, system_file_path)
+                        print(f'rewrote {written_block_count} of {block_count} blocks of {system_file_path}')
+                    else:
+                        staged_file_path, target_file_path = write_file_beside(src_file_obj, system_file_path, owner, mode, new_file_mode)
+                    if isinstance(src_file_obj, HashingReader):
+                        archive_new_sha256 = src_file_obj.hash.hexdigest()
+                        archive_new_size = os.path.getsize(staged_file_path)
+            archive_turns.done(task_id)
+
+            if decided_operation is None:
+                system_file_copy_path = copy_system_file_as_user(helper, system_file_path) if helper is not None else None
+                local_system_file_path: str = system_file_copy_path if system_file_copy_path is not None else system_file_path
+                with contextlib.closing(open(local_system_file_path, "rb")) as system_file_obj, contextlib.closing(open(staged_file_path, "rb")) as archive_new_file_obj:
+                    file_is_text: bool = file_looks_like_text(system_file_obj) and file_looks_like_text(archive_new_file_obj)
+
+                # the lock is held through the editor too, which needs the terminal to itself
+                with AskLock:
+                    if file_is_text:
                         ask_value: str = ask("conflict", f'{system_file_path} is modified since the installation of last version. Overwrite, skip or resolve conflict? ', [
                             "resolve",
                             "skip",
@@ -540,29 +3124,7 @@ def command_unpack(opts: dict, rest_argv: List[str]):
                             "alwaysoverwrite",
                             "exit"
                         ])
-
-                        if ask_value == "overwrite":
-                            decided_operation = ask_value
-                        elif ask_value == "skip":
-                            decided_operation = ask_value
-                        elif ask_value == "resolve":
-                            git_merge_file_command = ["git", "merge-file", "-L", system_file_path + " (system)", "-L", system_file_path + " (null)", "-L", system_file_path + " (new)", system_tempfile.name, "/dev/null", archive_new_tempfile.name]
-                            print(f'executing {" ".join(git_merge_file_command)}')
-                            proc_exit_code = subprocess.call(git_merge_file_command)
-
-                            if proc_exit_code < 0:
-                                raise RuntimeError(f'git merge-file returned status {proc_exit_code}')
-
-                            proc_exit_code = subprocess.call([os.environ.get("EDITOR", "vim"), system_tempfile.name])
-
-                            if proc_exit_code != 0:
-                                raise RuntimeError(f'vim returned status {proc_exit_code}')
-
-                            overwrite_src_file_path = system_tempfile.name
-                            decided_operation = "overwrite"
-                        else:
-                            raise RuntimeError(f'unexpected response: {ask_value}')
-                    elif not old_equals_system:
+                    else:
                         ask_value: str = ask("conflict_bin", f'{system_file_path} (binary) is modified since the installation of last version. Overwrite or skip? ', [
                             "skip",
                             "overwrite",
@@ -571,98 +3133,305 @@ def command_unpack(opts: dict, rest_argv: List[str]):
                             "exit"
                         ])
 
-                        if ask_value == "overwrite":
-                            decided_operation = ask_value
-                        elif ask_value == "skip":
-                            decided_operation = ask_value
-                        else:
-                            raise RuntimeError(f'unexpected response: {ask_value}')
-                    else:
-                        decided_operation = "overwrite"
-                elif decided_operation is None:
-                    decided_operation = "overwrite"
+                    if ask_value == "overwrite":
+                        decided_operation = ask_value
+                    elif ask_value == "skip":
+                        decided_operation = ask_value
+                    elif ask_value == "resolve" and file_is_text:
+                        # git merge-file works on paths: the system file is merged in a temp copy, with the new member beside it
+                        with contextlib.closing(tempfile.NamedTemporaryFile("wb", delete=False)) as system_tempfile, contextlib.closing(open(local_system_file_path, "rb")) as system_file_obj:
+                            resolved_file_path = system_tempfile.name
+                            shutil.copyfileobj(system_file_obj, system_tempfile, COMPARE_CHUNK_SIZE)
 
-                if system_file_obj and not system_file_obj.closed:
-                    system_file_obj.close()
-                if archive_new_file_obj and not archive_new_file_obj.closed:
-                    archive_new_file_obj.close()
-                if archive_new_tempfile and not archive_new_tempfile.closed:
-                    archive_new_tempfile.close()
-
-                if decided_operation == "overwrite":
-                    system_dir_path = pathlib.Path(os.path.abspath(os.path.dirname(system_file_path)))
-                    if not opts["dry"]:
-                        system_dir_path.mkdir(mode=0o0111 | int(mode, 8), parents=True, exist_ok=True)
-                    else:
-                        print(f'dry: created dir {system_dir_path.as_posix()}')
-
-                    if not opts["dry"]:
-                        shutil.copy(overwrite_src_file_path, system_file_path)
-                    else:
-                        print(f'dry: moved {overwrite_src_file_path} to {system_file_path}')
-                elif decided_operation == "skip":
-                    pass
-                else:
-                    raise RuntimeError(f'unexpected decided_operation: {decided_operation}')
-
-                try:
-                    os.unlink(archive_old_tempfile)
-                except Exception:
-                    pass
+                        git_merge_file_command = ["git", "merge-file", "-L", system_file_path + " (system)", "-L", system_file_path + " (null)", "-L", system_file_path + " (new)", resolved_file_path, "/dev/null", staged_file_path]
+                        print(f'executing {" ".join(git_merge_file_command)}')
+                        proc_exit_code = subprocess.call(git_merge_file_command)
 
-                try:
-                    os.unlink(archive_new_tempfile)
-                except Exception:
-                    pass
+                        if proc_exit_code < 0:
+                            raise RuntimeError(f'git merge-file returned status {proc_exit_code}')
 
-                try:
-                    os.unlink(system_tempfile)
-                except Exception:
-                    pass
+                        proc_exit_code = subprocess.call([os.environ.get("EDITOR", "vim"), resolved_file_path])
 
-                if owner is not None:
-                    if not opts["dry"]:
-                        proc_exit_code = subprocess.call(["chown", owner, system_file_path])
                         if proc_exit_code != 0:
-                            raise RuntimeError(f'chown returned status {proc_exit_code}')
+                            raise RuntimeError(f'vim returned status {proc_exit_code}')
+
+                        decided_operation = "overwrite"
                     else:
-                        print(f'dry: chowned {system_file_path} to {owner}')
-                
-                if mode is not None:
-                    if not opts["dry"]:
-                        proc_exit_code = subprocess.call(["chmod", mode, system_file_path])
-                        if proc_exit_code != 0:
-                            raise RuntimeError(f'chmod returned status {proc_exit_code}')
+                        raise RuntimeError(f'unexpected response: {ask_value}')
+
+            if decided_operation == "overwrite":
+                if not opts["dry"] and helper is not None:
+                    blob_store.add_file(staged_file_path, archive_new_sha256)
+                    with contextlib.closing(open(resolved_file_path if resolved_file_path is not None else staged_file_path, "rb")) as new_file_obj:
+                        system_file_stat: os.stat_result = helper.write_file(system_file_path, new_file_obj, owner, mode, new_file_mode)
+                    if ledger is not None:
+                        ledger.record(system_file_path, entry["id"], archive_file_path, archive_new_sha256, archive_new_size, config, system_file_has_content=(resolved_file_path is None), system_file_stat=system_file_stat)
+                elif not opts["dry"]:
+                    if delta_write:
+                        blob_store.add_file(system_file_path, archive_new_sha256)
+                        apply_owner_and_mode(system_file_path, owner, mode)
                     else:
+                        # the blob store keeps the archive content, even when a resolved file takes its place
+                        blob_store.add_file(staged_file_path, archive_new_sha256)
+                        if resolved_file_path is not None:
+                            os.unlink(staged_file_path)
+                            staged_file_path = None
+                            with contextlib.closing(open(resolved_file_path, "rb")) as resolved_file_obj:
+                                staged_file_path, target_file_path = write_file_beside(resolved_file_obj, system_file_path, owner, mode, new_file_mode)
+
+                    record_installed_file: Union[Callable[[], None], None] = None
+                    if ledger is not None:
+                        record_installed_file = functools.partial(ledger.record, system_file_path, entry["id"], archive_file_path, archive_new_sha256, archive_new_size, config, system_file_has_content=(resolved_file_path is None))
+                    if transaction is not None:
+                        # the ledger keeps the stat of the file in place, so staged files are recorded once committed
+                        transaction.add(staged_file_path, target_file_path, owner, mode, record_installed_file)
+                        staged_file_path = None
+                    else:
+                        if not delta_write:
+                            move_file_into_place(staged_file_path, target_file_path, owner, mode)
+                            staged_file_path = None
+                        if record_installed_file is not None:
+                            record_installed_file()
+                else:
+                    if delta_write:
+                        print(f'dry: rewrote changed blocks of {system_file_path} from {archive_file_path}')
+                    else:
+                        print(f'dry: moved {resolved_file_path if resolved_file_path is not None else archive_file_path} to {system_file_path}')
+                    if owner is not None:
+                        print(f'dry: chowned {system_file_path} to {owner}')
+                    if mode is not None:
                         print(f'dry: chmoded {system_file_path} to {mode}')
+                notified_handler_ids.update(get_notified_handler_ids(entry) + get_notified_handler_ids(file))
+            elif decided_operation == "skip":
+                if not opts["dry"] and helper is not None:
+                    helper.apply_owner_and_mode(system_file_path, owner, mode)
+                elif not opts["dry"]:
+                    apply_owner_and_mode(system_file_path, owner, mode)
+                else:
+                    if owner is not None:
+                        print(f'dry: chowned {system_file_path} to {owner}')
+                    if mode is not None:
+                        print(f'dry: chmoded {system_file_path} to {mode}')
+            else:
+                raise RuntimeError(f'unexpected decided_operation: {decided_operation}')
+        finally:
+            archive_turns.done(task_id)
+            for temp_file_path in (staged_file_path, resolved_file_path, system_file_copy_path):
+                if temp_file_path is not None and os.path.exists(temp_file_path):
+                    os.unlink(temp_file_path)
+
+    def apply_file_entries(file_entries: List[dict]):
+        # the files of the file entries are applied together, in parallel on --jobs threads
+        entry_files: List[Tuple[dict, dict, str, str]] = []
+        for entry in file_entries:
+            for file in entry.get("files", []):
+                archive_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
+                system_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "systemDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
+                entry_files.append((entry, file, archive_file_path, system_file_path))
+
+        # files of entries with asUser are checked by the helper of that user, in one batch per user
+        entry_file_helpers: List[Union[PrivilegedHelper, None]] = [helpers.get(entry.get("asUser", None)) for entry, _, _, _ in entry_files]
+        helper_system_file_stats: dict = {}
+        for helper in set(entry_file_helpers) - {None}:
+            helper_entry_files: List[Tuple[dict, dict, str, str]] = [entry_file for entry_file, entry_file_helper in zip(entry_files, entry_file_helpers) if entry_file_helper is helper]
+            helper_system_file_paths: List[str] = [system_file_path for _, _, _, system_file_path in helper_entry_files]
+            helper_system_file_stats.update(zip(helper_system_file_paths, get_up_to_date_system_file_stats_as_user(helper, helper_system_file_paths, [archive.getmanifest(archive_file_path) for _, _, archive_file_path, _ in helper_entry_files], ledger)))
+
+        with concurrent.futures.ThreadPoolExecutor(opts["jobs"]) as executor:
+            entry_files = [entry_file for entry_file, up_to_date in zip(entry_files, executor.map(lambda entry_file: check_file_up_to_date(*entry_file, helper_system_file_stats.get(entry_file[3], None)), entry_files)) if not up_to_date]
+            archive.prefetch([archive_file_path for _, _, archive_file_path, _ in entry_files])
+
+            archive_turns = OrderedTurns()
+            futures: List[concurrent.futures.Future] = [executor.submit(apply_file, task_id, archive_turns, *entry_file) for task_id, entry_file in enumerate(entry_files)]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # files not started yet are dropped; the ones started come first in archive order, so they still get their turns
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def run_command(entry: dict):
+        command: str = resolve_var_ref_in_dict_by_key(entry, "command", entry["id"] + "/", entry, config)
+        # onlyIfChanged: skipped while the inputs hash the same as at the last successful run
+        inputs_sha256: Union[str, None] = get_command_inputs_sha256(entry, command, config, ledger) if entry.get("onlyIfChanged", False) else None
+        if inputs_sha256 is not None and ledger is not None and ledger.get_command_inputs_sha256(entry["id"]) == inputs_sha256:
+            print(f'up to date: {entry["id"]}')
+            return
+        if run_command_entry(entry, command, opts["dry"], shell_sessions) == 0 and inputs_sha256 is not None and not opts["dry"]:
+            ledger.record_command_run(entry["id"], inputs_sha256)
+
+    async def run_command_async(entry: dict):
+        command: str = resolve_var_ref_in_dict_by_key(entry, "command", entry["id"] + "/", entry, config)
+        inputs_sha256: Union[str, None] = None
+        if entry.get("onlyIfChanged", False):
+            inputs_sha256 = await asyncio.get_running_loop().run_in_executor(None, get_command_inputs_sha256, entry, command, config, ledger)
+            if ledger is not None and ledger.get_command_inputs_sha256(entry["id"]) == inputs_sha256:
+                print(f'up to date: {entry["id"]}')
+                return
+        if await run_command_entry_async(entry, command, opts["dry"], shell_sessions) == 0 and inputs_sha256 is not None and not opts["dry"]:
+            ledger.record_command_run(entry["id"], inputs_sha256)
+
+    def take_notified_handlers() -> List[dict]:
+        # each notified handler runs once, in config order, however many files notified it
+        notified_handlers: List[dict] = [entry for entry in config["entries"] if entry["id"] in notified_handler_ids]
+        notified_handler_ids.clear()
+        return notified_handlers
+
+    def flush_handlers():
+        # handlers run with the files that notified them in place
+        if transaction is not None:
+            transaction.commit()
+        for handler in take_notified_handlers():
+            print("\n=======\n" + f'handler: {handler["name"] if "name" in handler else handler["id"]}')
+            run_command(handler)
+
+    async def flush_handlers_async():
+        if transaction is not None:
+            transaction.commit()
+        for handler in take_notified_handlers():
+            print("\n=======\n" + f'handler: {handler["name"] if "name" in handler else handler["id"]}')
+            await run_command_async(handler)
+
+    async def run_entry(entry: dict):
+        print("\n=======\n" + f'entry: {entry["name"] if "name" in entry else entry["id"]}')
+        if entry["type"] == "command":
+            # commands run with the file entries they wait for in place
+            if transaction is not None:
+                transaction.commit()
+            await run_command_async(entry)
+        elif entry["type"] == "file":
+            await asyncio.get_running_loop().run_in_executor(None, apply_file_entries, [entry])
+        elif entry["type"] == "flush":
+            await flush_handlers_async()
+
+    # command entries of one user share a shell session, started on first use
+    shell_sessions = ShellSessionPool()
+    entry: dict
+    try:
+        # every confirmation, and every variable of the commands and files, is settled before anything is applied,
+        # so that a run never waits for an answer halfway through (answers can also be given with --answers)
+        confirmed_entries: List[dict] = []
+        for entry in selected_entries:
+            if entry.get("askForConfirm", False):
+                ask_value: str = ask("entry_ask_for_confirm", f'{entry["id"]}: apply this entry? ', [
+                    "yes",
+                    "no",
+                    "exit"
+                ])
+                if ask_value == "no":
+                    continue
+            confirmed_entries.append(entry)
+
+        # handlers only run when a file of a confirmed entry notifies them
+        notifiable_handler_ids: set = { handler_id for entry in confirmed_entries for notifying in [entry] + entry.get("files", []) for handler_id in get_notified_handler_ids(notifying) }
+        for entry in confirmed_entries + [entry for entry in config["entries"] if entry["id"] in notifiable_handler_ids]:
+            if entry["type"] == "command":
+                resolve_var_ref_in_dict_by_key(entry, "command", entry["id"] + "/", entry, config)
+                for watch_file_id, watch_file_var_ref in enumerate(entry.get("watchFiles", [])):
+                    resolve_var_ref(f'{entry["id"]}/watchFiles/{watch_file_id}', watch_file_var_ref, entry, config)
+                if entry.get("onlyIfChanged", False):
+                    for var_name, var_ref in entry.get("varDict", {}).items():
+                        resolve_var_ref(entry["id"] + "/" + var_name, var_ref, entry, config)
+            elif entry["type"] == "file":
+                get_entry_files_dict(entry, config)
+                for file in entry.get("files", []):
+                    resolve_var_ref_in_dict_by_key(file, "systemDir", entry["id"] + "/" + file["name"] + "/", entry, config)
+
+        if any("dependsOn" in entry for entry in selected_entries):
+            # entries run as a graph
+            asyncio.run(run_entry_graph(confirmed_entries, opts["jobs"], run_entry))
+            flush_handlers()
+        else:
+            for entry in confirmed_entries:
+                # the files of an entry are applied (in parallel on --jobs threads) right under its banner
+                print("\n=======\n" + f'entry: {entry["name"] if "name" in entry else entry["id"]}')
+                if entry["type"] == "command":
+                    if transaction is not None:
+                        transaction.commit()
+
+                    run_command(entry)
+                elif entry["type"] == "file":
+                    apply_file_entries([entry])
+                elif entry["type"] == "flush":
+                    flush_handlers()
+
+            flush_handlers()
+        if transaction is not None:
+            transaction.commit()
+    except BaseException:
+        if transaction is not None:
+            transaction.rollback()
+        raise
+    finally:
+        shell_sessions.close()
+        helpers.close()
+
+    if isinstance(archive, DeltaArchiveReader):
+        removed_archive_file_paths: set = set(archive.delta["removed"])
+        for installed_record in (ledger.get_all() if ledger is not None else []):
+            if installed_record["archive_path"] not in removed_archive_file_paths or not entry_is_selected({"id": installed_record["entry_id"]}, selector_entry, selector_entry_prefix):
+                continue
+
+            print("\n=======")
+            remove_installed_file(ledger, installed_record, opts["dry"])
+
+        for archive_file_path in removed_archive_file_paths:
+            workspace_file_obj: pathlib.Path = workspace_dir_obj / archive_file_path
+            if archive_file_path.startswith(Consts["ExtraArchiveFilePrefix"]) and workspace_file_obj.is_file():
+                if not opts["dry"]:
+                    workspace_file_obj.unlink()
+                else:
+                    print(f'dry: removed {workspace_file_obj.as_posix()} from workspace')
 
-    if curr_ver_tar:
-        curr_ver_tar.close()
+    if curr_ver_archive:
+        curr_ver_archive.close()
 
     print("\n=======\nfinished\n=======")
 
     dbg_print(f'extracting tar to {workspace_dir_path}...')
 
     if not opts["dry"]:
-        tar.extractall(workspace_dir_path, members=[
-            ti for ti in tar.getmembers()
-            if ti.name.startswith(Consts["ExtraArchiveFilePrefix"])
-        ])
-        tar.extract("config.yaml", workspace_dir_path)
+        archive.extract_prefix(Consts["ExtraArchiveFilePrefix"], workspace_dir_path)
+        archive.extract(ARCHIVE_CONFIG_MEMBER, workspace_dir_path)
+
+        workspace_files: List[Tuple[str, str, int]] = []
+        for archive_file_path in archive.getnames():
+            workspace_file_path: str = os.path.join(workspace_dir_path, archive_file_path)
+            if not archive_file_path.startswith(Consts["ExtraArchiveFilePrefix"]) or not os.path.isfile(workspace_file_path):
+                continue
+            manifest: Union[dict, None] = archive.getmanifest(archive_file_path)
+            workspace_file_sha256: Union[str, None] = blob_store.add_file(workspace_file_path, manifest.get("sha256", None) if manifest is not None else None)
+            if workspace_file_sha256 is not None:
+                workspace_files.append((archive_file_path, workspace_file_sha256, os.path.getsize(workspace_file_path)))
+        with contextlib.closing(open(workspace_conf_obj.as_posix(), "r")) as f:
+            ledger.record_version(config, f.read(), workspace_files)
     else:
         print(f'dry: extracted {Consts["ExtraArchiveFilePrefix"]} to workspace: {workspace_dir_path}')
         print(f'dry: extracted config.yaml to workspace: {workspace_dir_path}')
-    
-    tar.close()
 
-    if os.path.normpath(os.path.abspath(workspace_dir_path)) == os.path.normpath(os.path.abspath(os.path.dirname(archive_path))):
+    if archive_path == "-":
+        if opts["dry"]:
+            print(f'dry: copied archive from stdin to workspace: {workspace_dir_path}')
+    elif os.path.normpath(os.path.abspath(workspace_dir_path)) == os.path.normpath(os.path.abspath(os.path.dirname(archive_path))):
         print("skipping tar copying")
     else:
         if not opts["dry"]:
-            shutil.copy2(archive_path, workspace_dir_path)
+            # stored under its canonical name, where the next unpack and deltas based on this version look for it
+            archive.copy_to((workspace_dir_obj / make_archive_filename(config, archive.codec)).as_posix())
         else:
             print(f'dry: copied {archive_path} to workspace: {workspace_dir_path}')
 
+    archive.close()
+
+    if ledger is not None:
+        if not opts["dry"]:
+            ledger.commit()
+        # only the archive of this version (and its delta bases) stays in the workspace
+        prune_workspace_archives(workspace_dir_obj, ledger, opts["dry"])
+        ledger.close()
+
 def command_pack(opts: dict, rest_argv: List[str]):
     assert len(rest_argv) == 0, "incorrect argument number in pack"
     
@@ -673,23 +3442,78 @@ def command_pack(opts: dict, rest_argv: List[str]):
 
     config_check_user(config)
 
-    tar = tarfile.open(make_archive_filename(config), "w:gz")
+    codec, level = parse_codec_spec(opts["codec"] if opts["codec"] is not None else config.get("codec", DEFAULT_ARCHIVE_CODEC))
+
+    chunked: bool = opts["chunked"]
+    previous_archive_path: Union[str, None] = None
+    ledger: Union[InstalledLedger, None] = None
+    if opts["incremental"]:
+        assert codec.name == "gzip", f'--incremental requires the gzip codec, got {codec.name}'
+        chunked = True
+        previous_archive_obj: Union[pathlib.Path, None] = find_previous_chunked_archive(pathlib.Path("."), config)
+        if previous_archive_obj is None:
+            warn_print(f'WARNING: no previous chunked archive of {config["id"]} found. Packing everything.')
+        else:
+            previous_archive_path = previous_archive_obj.as_posix()
+            print(f'reusing unchanged members of: {previous_archive_path}')
+        # the stat cache of the workspace spares hashing unchanged files
+        ledger = InstalledLedger(INSTALLED_LEDGER_FILENAME)
+
+    delta_base_config: Union[dict, None] = None
+    delta_base_manifests: Union[dict, None] = None
+    if opts["delta_from"] is not None:
+        assert not opts["incremental"], "--delta-from and --incremental can not be used together"
+        delta_base_archive: Union[ArchiveReader, DeltaArchiveReader] = open_archive_reader(opts["delta_from"])
+        delta_base_config = yaml.safe_load(delta_base_archive.extractfile(ARCHIVE_CONFIG_MEMBER))
+        delta_base_manifests = delta_base_archive.index
+        delta_base_archive.close()
+
+        if delta_base_manifests is None:
+            raise RuntimeError(f'{opts["delta_from"]} has no member index. Pack a full archive instead.')
+        if delta_base_config["id"] != config["id"]:
+            raise RuntimeError(f'{opts["delta_from"]} is an archive of {delta_base_config["id"]}, not {config["id"]}')
+        if str(delta_base_config.get("confVersion", None)) == str(config.get("confVersion", None)):
+            raise RuntimeError(f'{opts["delta_from"]} has the same confVersion as ./config.yaml. Bump confVersion first.')
+        print(f'packing delta from: {opts["delta_from"]}')
+        if ledger is None:
+            ledger = InstalledLedger(INSTALLED_LEDGER_FILENAME)
+
+    archive = ArchiveWriter(make_archive_filename(config, codec), opts["jobs"], chunked, codec, level, previous_archive_path, ledger, delta_base_config, delta_base_manifests)
+    extra_archive_dir = resolve_var_ref("ExtraArchiveFilePrefix", { "refVar": "ExtraArchiveFilePrefix" }, None, config)
+
+    # files of entries with asUser are read by the helper of that user, into a spool dir the archive is written from
+    helpers = PrivilegedHelperPool()
+    spool_dir = tempfile.TemporaryDirectory()
 
+    # members are stored in the order command_unpack consumes them, so that it can read the archive in one pass
     entry: dict
     for entry in config["entries"]:
         if entry["type"] != "file":
             continue
 
+        helper: Union[PrivilegedHelper, None] = helpers.get(entry.get("asUser", None))
         for file in entry.get("files", []):
             archive_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "archiveDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
             system_file_path = os.path.join(resolve_var_ref_in_dict_by_key(file, "systemDir", entry["id"] + "/" + file["name"] + "/", entry, config), file["name"])
 
-            if archive_file_path.startswith(resolve_var_ref_in_dict_by_key(Consts, "ExtraArchiveFilePrefix", "", entry, config)):
+            if archive_file_path in archive.arcnames:
                 continue
 
-            system_file = open(system_file_path, "rb")
+            if archive_file_path.startswith(resolve_var_ref_in_dict_by_key(Consts, "ExtraArchiveFilePrefix", "", entry, config)):
+                if os.path.isfile(archive_file_path):
+                    print(f'adding: {archive_file_path}')
+                    archive.add(archive_file_path, archive_file_path)
+                continue
 
-            new_member = tar.gettarinfo(system_file_path, archive_file_path, system_file)
+            source_file_path: str = system_file_path
+            if helper is not None:
+                source_file_path = os.path.join(spool_dir.name, str(len(archive.members)))
+                with contextlib.closing(open(source_file_path, "wb")) as spool_file:
+                    system_file_stat = helper.read_file(system_file_path, spool_file)
+                new_member = archive.gettarinfo(source_file_path, archive_file_path)
+                set_tarinfo_stat(new_member, system_file_stat)
+            else:
+                new_member = archive.gettarinfo(system_file_path, archive_file_path)
 
             mode: Union[str, None] = file.get("mode", None)
             if mode is not None:
@@ -697,29 +3521,464 @@ def command_pack(opts: dict, rest_argv: List[str]):
 
             owner: Union[str, None] = file.get("owner", None)
             if owner is not None:
-                owner = owner.split(":")
-                assert len(owner) == 2, f'{owner} invalid!'
-                new_member.uid, new_member.gid, new_member.uname, new_member.gname = pwd.getpwnam(owner[0]).pw_uid, grp.getgrnam(owner[1]).gr_gid, owner[0], owner[1]
+                # the same owner forms as unpack takes; a part left out keeps the one of the system file
+                uid, gid = resolve_owner(owner)
+                new_member.uid, new_member.gid = uid if uid != -1 else new_member.uid, gid if gid != -1 else new_member.gid
+                new_member.uname, new_member.gname = format_owner(new_member.uid, new_member.gid).split(":")
 
             print(f'adding: {system_file_path} -> {archive_file_path}')
-            tar.addfile(new_member, system_file)
-    
-    extra_archive_dir = resolve_var_ref("ExtraArchiveFilePrefix", { "refVar": "ExtraArchiveFilePrefix" }, None, config)
+            archive.addfile(new_member, source_file_path)
+    helpers.close()
+
     if os.path.isdir(extra_archive_dir):
         print(f'adding: {extra_archive_dir}')
-        tar.add(extra_archive_dir, extra_archive_dir, True)
+        archive.add(extra_archive_dir, extra_archive_dir)
     else:
         warn_print(f'WARNING: extra archive dir {extra_archive_dir} does not exist. Not packing.')
 
     print(f'adding: ./config.yaml -> config.yaml')
-    tar.add("./config.yaml", "config.yaml", False)
-
-    tar.close()
+    archive.close("./config.yaml")
+    spool_dir.cleanup()
+    if ledger is not None:
+        ledger.commit()
+        ledger.close()
+    if previous_archive_path is not None:
+        print(f'reused {archive.reused_member_count} of {len(archive.members)} members')
+    if delta_base_config is not None:
+        print(f'delta: {len(archive.members)} changed, {len(archive.arcnames) - len(archive.members)} unchanged, {len(delta_base_manifests.keys() - archive.arcnames)} removed')
     
     
+def set_tarinfo_stat(tarinfo: tarfile.TarInfo, system_file_stat: os.stat_result):
+    # a member read through a helper describes the system file, not its spooled copy
+    tarinfo.mode = stat.S_IMODE(system_file_stat.st_mode)
+    tarinfo.mtime = system_file_stat.st_mtime
+    tarinfo.uid, tarinfo.gid = system_file_stat.st_uid, system_file_stat.st_gid
+    tarinfo.uname, tarinfo.gname = format_owner(system_file_stat.st_uid, system_file_stat.st_gid).split(":")
+
+def format_owner(uid: int, gid: int) -> str:
+    try:
+        user: str = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        user = str(uid)
+    try:
+        group: str = grp.getgrgid(gid).gr_name
+    except KeyError:
+        group = str(gid)
+    return f'{user}:{group}'
+
+def command_status(opts: dict, rest_argv: List[str]):
+    assert len(rest_argv) < 3, "incorrect argument number in status"
+
+    workspace_dir_path: str = rest_argv[0] if len(rest_argv) > 0 else "./"
+
+    selector_entry_prefix: Union[str, None] = ""
+    selector_entry: Union[str, None] = None
+    if len(rest_argv) > 1:
+        entry_raw: str = rest_argv[1]
+        assert entry_raw != "", "<entry> is empty string"
+        if entry_raw[-1] == "/":
+            selector_entry_prefix = entry_raw[:-1]
+        else:
+            selector_entry_prefix = None
+            selector_entry = entry_raw
+
+    workspace_dir_obj = pathlib.Path(workspace_dir_path)
+    config: dict = read_config_in_path((workspace_dir_obj / "config.yaml").as_posix())
+    ledger_obj: pathlib.Path = workspace_dir_obj / INSTALLED_LEDGER_FILENAME
+    if not ledger_obj.exists():
+        raise RuntimeError(f'{ledger_obj.as_posix()} does not exist. Nothing has been unpacked into this workspace yet.')
+
+    ledger = InstalledLedger(ledger_obj.as_posix(), read_only=not os.access(ledger_obj.as_posix(), os.W_OK))
+
+    # only files of the installed config count as managed
+    installed_records: List[dict] = []
+    for installed_record in ledger.get_all():
+        entry: Union[dict, None] = config["entries_dict"].get(installed_record["entry_id"], None)
+        if entry is None or not entry_is_selected(entry, selector_entry, selector_entry_prefix):
+            continue
+        if installed_record["archive_path"] not in get_entry_files_dict(entry, config):
+            continue
+        installed_records.append(installed_record)
+
+    # files of entries with asUser are stated and hashed by the helper of that user, a batch per user
+    helpers = PrivilegedHelperPool()
+    system_file_helpers: dict = {installed_record["system_path"]: helpers.get(config["entries_dict"][installed_record["entry_id"]].get("asUser", None)) for installed_record in installed_records}
+    helper_system_file_stats: dict = {}
+    for helper in set(system_file_helpers.values()) - {None}:
+        helper_system_file_paths: List[str] = [system_file_path for system_file_path, system_file_helper in system_file_helpers.items() if system_file_helper is helper]
+        helper_system_file_stats.update(zip(helper_system_file_paths, helper.stat_files(helper_system_file_paths)))
+
+    system_file_stats: dict = {}
+    system_file_hashes: dict = {}
+    records_to_hash: List[dict] = []
+    for installed_record in installed_records:
+        system_file_path: str = installed_record["system_path"]
+        if system_file_helpers[system_file_path] is not None:
+            system_file_stat = helper_system_file_stats[system_file_path]
+            if isinstance(system_file_stat, FileNotFoundError):
+                continue
+            if isinstance(system_file_stat, OSError):
+                raise system_file_stat
+        else:
+            try:
+                system_file_stat = os.stat(system_file_path)
+            except FileNotFoundError:
+                continue
+        system_file_stats[system_file_path] = system_file_stat
+
+        sha256: Union[str, None] = ledger.get_cached_sha256(system_file_path, system_file_stat, installed_record)
+        if sha256 is not None:
+            system_file_hashes[system_file_path] = sha256
+        else:
+            records_to_hash.append(installed_record)
+
+    def hash_system_file(system_file_path: str) -> Union[str, None]:
+        try:
+            return hash_file(system_file_path)
+        except OSError:
+            return None
+
+    # only files whose stat changed since they were last hashed are read; hashlib releases the GIL
+    hashed_paths: List[str] = [installed_record["system_path"] for installed_record in records_to_hash]
+    with concurrent.futures.ThreadPoolExecutor(opts["jobs"]) as executor:
+        local_hashed_paths: List[str] = [system_file_path for system_file_path in hashed_paths if system_file_helpers[system_file_path] is None]
+        system_file_hashes.update(zip(local_hashed_paths, executor.map(hash_system_file, local_hashed_paths)))
+    for helper in set(system_file_helpers.values()) - {None}:
+        helper_hashed_paths: List[str] = [system_file_path for system_file_path in hashed_paths if system_file_helpers[system_file_path] is helper]
+        system_file_hashes.update((system_file_path, None if isinstance(sha256, OSError) else sha256) for system_file_path, sha256 in zip(helper_hashed_paths, helper.hash_files(helper_hashed_paths)))
+    helpers.close()
+    for system_file_path in hashed_paths:
+        if system_file_hashes[system_file_path] is not None:
+            ledger.cache_sha256(system_file_path, system_file_stats[system_file_path], system_file_hashes[system_file_path])
+
+    if not ledger.read_only:
+        ledger.commit()
+    ledger.close()
+
+    drift_count: int = 0
+    for installed_record in installed_records:
+        system_file_path: str = installed_record["system_path"]
+        system_file_stat: Union[os.stat_result, None] = system_file_stats.get(system_file_path, None)
+        if system_file_stat is None:
+            warn_print(f'missing: {system_file_path}')
+            drift_count += 1
+            continue
+
+        sha256: Union[str, None] = system_file_hashes[system_file_path]
+        if sha256 is None:
+            warn_print(f'unreadable: {system_file_path}')
+            drift_count += 1
+        elif sha256 != installed_record["sha256"]:
+            warn_print(f'modified: {system_file_path}')
+            drift_count += 1
+
+        if installed_record["mode"] is not None and stat.S_IMODE(system_file_stat.st_mode) != installed_record["mode"]:
+            warn_print(f'mode changed: {system_file_path} {oct(installed_record["mode"])[2:]} -> {oct(stat.S_IMODE(system_file_stat.st_mode))[2:]}')
+            drift_count += 1
+
+        if installed_record["uid"] is not None and (system_file_stat.st_uid, system_file_stat.st_gid) != (installed_record["uid"], installed_record["gid"]):
+            warn_print(f'owner changed: {system_file_path} {format_owner(installed_record["uid"], installed_record["gid"])} -> {format_owner(system_file_stat.st_uid, system_file_stat.st_gid)}')
+            drift_count += 1
+
+    print(f'{len(installed_records)} managed files checked, {len(records_to_hash)} hashed, {drift_count} drifted')
+    if drift_count > 0:
+        sys.exit(1)
+
+def open_workspace_ledger(workspace_dir_obj: pathlib.Path, dry: bool) -> InstalledLedger:
+    ledger_obj: pathlib.Path = workspace_dir_obj / INSTALLED_LEDGER_FILENAME
+    if not ledger_obj.exists():
+        raise RuntimeError(f'{ledger_obj.as_posix()} does not exist. Nothing has been unpacked into this workspace yet.')
+    return InstalledLedger(ledger_obj.as_posix(), read_only=dry)
+
+def get_workspace_archive_chain(workspace_dir_obj: pathlib.Path, installed_config: dict) -> List[pathlib.Path]:
+    # the archive of the installed version, then the archives it is a delta of, if any
+    chain: List[pathlib.Path] = []
+    archive_obj: pathlib.Path = find_archive_in_dir(workspace_dir_obj, installed_config)
+    while archive_obj.is_file() and archive_obj not in chain:
+        chain.append(archive_obj)
+        archive = ArchiveReader(archive_obj.as_posix())
+        delta: Union[dict, None] = archive.delta
+        archive.close()
+        if delta is None:
+            break
+        archive_obj = find_archive_in_dir(workspace_dir_obj, make_delta_base_config(delta))
+    return chain
+
+def prune_workspace_archives(workspace_dir_obj: pathlib.Path, ledger: InstalledLedger, dry: bool):
+    """Removes the archives of the versions of the installed config recorded
+    in the ledger from the workspace, except the installed one and the bases
+    it is a delta of.
+
+    Installed contents are kept in the blob store, so an archive is only
+    needed as the base of the next delta. Archives of other configs sharing
+    the workspace, and of versions never installed here, such as ones packed
+    into the same directory, are left.
+    """
+    workspace_conf_obj: pathlib.Path = workspace_dir_obj / "config.yaml"
+    if not workspace_conf_obj.exists():
+        return
+    with contextlib.closing(open(workspace_conf_obj.as_posix(), "r")) as f:
+        installed_config: dict = yaml.safe_load(f)
+
+    kept_archive_objs: List[pathlib.Path] = get_workspace_archive_chain(workspace_dir_obj, installed_config)
+    for version in ledger.get_versions():
+        if version["config_id"] != installed_config["id"]:
+            continue
+        version_config: dict = make_delta_base_config({"baseId": version["config_id"], "baseConfVersion": version["conf_version"]})
+        for codec in ARCHIVE_CODECS:
+            archive_obj: pathlib.Path = workspace_dir_obj / make_archive_filename(version_config, codec)
+            if archive_obj in kept_archive_objs or not archive_obj.is_file():
+                continue
+            if not dry:
+                archive_obj.unlink()
+                print(f'removed superseded archive: {archive_obj.as_posix()}')
+            else:
+                print(f'dry: removed superseded archive: {archive_obj.as_posix()}')
+
+def command_rollback(opts: dict, rest_argv: List[str]):
+    assert len(rest_argv) < 3, "incorrect argument number in rollback"
+
+    target_conf_version: Union[str, None] = rest_argv[0] if len(rest_argv) > 0 else None
+    workspace_dir_path: str = rest_argv[1] if len(rest_argv) > 1 else "./"
+    workspace_dir_obj = pathlib.Path(workspace_dir_path)
+    workspace_conf_obj: pathlib.Path = workspace_dir_obj / "config.yaml"
+
+    ledger: InstalledLedger = open_workspace_ledger(workspace_dir_obj, opts["dry"])
+    blob_store = BlobStore((workspace_dir_obj / BLOB_STORE_DIRNAME).as_posix())
+
+    installed_config: dict = read_config_in_path(workspace_conf_obj.as_posix())
+    installed_conf_version: Union[str, None] = str(installed_config["confVersion"]) if "confVersion" in installed_config else None
+
+    # without a version, roll back to the newest one that differs from what is installed
+    versions: List[dict] = ledger.get_versions()
+    target_version: Union[dict, None] = None
+    for version in reversed(versions):
+        if version["config_id"] != installed_config["id"]:
+            continue
+        if (target_conf_version is None and version["conf_version"] != installed_conf_version) or (target_conf_version is not None and version["conf_version"] == target_conf_version):
+            target_version = version
+            break
+    if target_version is None:
+        recorded_conf_versions: str = ", ".join(sorted({str(version["conf_version"]) for version in versions}))
+        raise RuntimeError(f'no version of {installed_config["id"]} to roll back to. Recorded versions: {recorded_conf_versions}')
+
+    target_config: dict = yaml.safe_load(target_version["config_yaml"])
+    config_check_user(target_config)
+
+    # nothing is touched unless every file of the version can be restored from local blobs
+    version_files: List[dict] = ledger.get_version_files(target_version["version_id"])
+    missing_sha256s: set = {version_file["sha256"] for version_file in version_files if not blob_store.has(version_file["sha256"])}
+    if missing_sha256s:
+        raise RuntimeError(f'{len(missing_sha256s)} blobs of version {target_version["conf_version"]} are missing from {blob_store.store_dir}. Unpack its archive instead.')
+
+    print(f'rolling back {installed_config["id"]} from version {installed_conf_version} to version {target_version["conf_version"]}')
+
+    system_file_paths: set = set()
+    for version_file in version_files:
+        if version_file["system_path"] is None:
+            workspace_file_path: str = os.path.join(workspace_dir_path, version_file["archive_path"])
+            if not opts["dry"]:
+                os.makedirs(os.path.dirname(workspace_file_path), exist_ok=True)
+                blob_store.restore(version_file["sha256"], workspace_file_path)
+            else:
+                print(f'dry: restored {workspace_file_path}')
+            continue
+
+        system_file_path: str = version_file["system_path"]
+        system_file_paths.add(system_file_path)
+        installed_record: Union[dict, None] = ledger.get(system_file_path)
+
+        if os.path.exists(system_file_path):
+            system_file_stat = os.stat(system_file_path)
+            system_file_is_installed: bool = installed_record is not None and ledger.system_file_matches(system_file_path, installed_record)
+            if system_file_is_installed and installed_record["sha256"] == version_file["sha256"] and (stat.S_IMODE(system_file_stat.st_mode), system_file_stat.st_uid, system_file_stat.st_gid) == (version_file["mode"], version_file["uid"], version_file["gid"]):
+                print(f'up to date: {system_file_path}')
+                if not opts["dry"]:
+                    ledger.record(system_file_path, version_file["entry_id"], version_file["archive_path"], version_file["sha256"], version_file["size"], target_config)
+                continue
+
+            if not system_file_is_installed:
+                ask_value: str = ask("rollback_overwrite_modified", f'{system_file_path} is modified since the installation of the current version. Overwrite? ', [
+                    "yes",
+                    "no",
+                    "all",
+                    "nottoall",
+                    "exit"
+                ])
+                if ask_value == "no":
+                    continue
+
+        print(f'restoring: {system_file_path}')
+        if not opts["dry"]:
+            os.makedirs(os.path.dirname(os.path.abspath(system_file_path)), exist_ok=True)
+            blob_store.restore(version_file["sha256"], system_file_path, version_file["mode"], version_file["uid"], version_file["gid"])
+            ledger.record(system_file_path, version_file["entry_id"], version_file["archive_path"], version_file["sha256"], version_file["size"], target_config)
+        else:
+            print(f'dry: restored {system_file_path} from blob {version_file["sha256"]}')
+
+    for installed_record in ledger.get_all():
+        if installed_record["system_path"] not in system_file_paths:
+            remove_installed_file(ledger, installed_record, opts["dry"])
+
+    if not opts["dry"]:
+        with contextlib.closing(open(workspace_conf_obj.as_posix(), "w")) as f:
+            f.write(target_version["config_yaml"])
+        ledger.record_version(target_config, target_version["config_yaml"], [
+            (version_file["archive_path"], version_file["sha256"], version_file["size"]) for version_file in version_files if version_file["system_path"] is None
+        ])
+        ledger.commit()
+    else:
+        print(f'dry: restored config.yaml of version {target_version["conf_version"]} to workspace: {workspace_dir_path}')
+    ledger.close()
+
+    print(f'rolled back to version {target_version["conf_version"]}. Command entries are not run on rollback.')
+
+def command_gc(opts: dict, rest_argv: List[str]):
+    assert len(rest_argv) < 2, "incorrect argument number in gc"
+
+    workspace_dir_obj = pathlib.Path(rest_argv[0] if len(rest_argv) > 0 else "./")
+    ledger: InstalledLedger = open_workspace_ledger(workspace_dir_obj, opts["dry"])
+    blob_store = BlobStore((workspace_dir_obj / BLOB_STORE_DIRNAME).as_posix())
+
+    # before versions are forgotten, so that their archives are still known
+    prune_workspace_archives(workspace_dir_obj, ledger, opts["dry"])
+
+    # the newest version is what is installed, so it is always kept
+    versions: List[dict] = ledger.get_versions()
+    if opts["keep"] is not None:
+        for version in versions[:-max(opts["keep"], 1)]:
+            print(f'forgetting version {version["conf_version"]} installed at {datetime.datetime.fromtimestamp(version["installed_at"]).isoformat()}')
+            if not opts["dry"]:
+                ledger.delete_version(version["version_id"])
+
+    referenced_sha256s: set = ledger.get_referenced_sha256s()
+    if not opts["dry"]:
+        ledger.commit()
+    ledger.close()
+
+    removed_count, removed_size = blob_store.gc(referenced_sha256s, opts["dry"])
+    print(f'removed {removed_count} unreferenced blobs ({removed_size} bytes)')
+
+DIFF_MAX_MEMBER_SIZE = 16 * 1024 * 1024
+
+def get_archive_file_manifests(archive: ArchiveReader) -> dict:
+    manifests: dict = {}
+    for name in archive.getnames():
+        if name in (ARCHIVE_CONFIG_MEMBER, ARCHIVE_INDEX_MEMBER):
+            continue
+        manifest: Union[dict, None] = archive.getmanifest(name)
+        if manifest is not None:
+            if "sha256" in manifest:
+                manifests[name] = manifest
+        elif archive.getmember(name).isreg():
+            # archives without a manifest
+            tarinfo: tarfile.TarInfo = archive.getmember(name)
+            manifests[name] = {
+                "size": tarinfo.size,
+                "sha256": get_member_sha256(archive, name),
+                "mode": tarinfo.mode,
+                "owner": f'{tarinfo.uname}:{tarinfo.gname}',
+            }
+    return manifests
+
+def format_manifest_metadata(manifest: dict) -> str:
+    # manifests written before modes and owners were recorded have neither
+    mode: Union[int, None] = manifest.get("mode", None)
+    return f'{oct(mode)[2:] if mode is not None else "-"} {manifest.get("owner", None) or "-"}'
+
+def read_archive_members_for_diff(archive: ArchiveReader, names: List[str]) -> dict:
+    # members are read in stored order, so the archive is only read forward
+    contents: dict = {}
+    for name in sorted(names, key=lambda name: archive.getmember(name).offset):
+        if archive.getmember(name).size > DIFF_MAX_MEMBER_SIZE:
+            contents[name] = None
+            continue
+        member_file_obj = archive.extractfile(name)
+        contents[name] = member_file_obj.read()
+        member_file_obj.close()
+    return contents
+
+def make_unified_diff(a_bytes: Union[bytes, None], b_bytes: Union[bytes, None], a_label: str, b_label: str) -> str:
+    try:
+        a_lines: List[str] = a_bytes.decode("utf-8").splitlines(keepends=True) if a_bytes is not None else []
+        b_lines: List[str] = b_bytes.decode("utf-8").splitlines(keepends=True) if b_bytes is not None else []
+    except (UnicodeDecodeError, AttributeError):
+        return f'Binary files {a_label} and {b_label} differ\n'
+    return "".join(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n" for line in difflib.unified_diff(a_lines, b_lines, a_label, b_label))
+
+def command_diff(opts: dict, rest_argv: List[str]):
+    assert len(rest_argv) == 2, "incorrect argument number in diff"
+
+    a_archive = open_archive_reader(rest_argv[0], jobs=opts["jobs"])
+    b_archive = open_archive_reader(rest_argv[1], jobs=opts["jobs"])
+
+    a_config_bytes: bytes = a_archive.extractfile(ARCHIVE_CONFIG_MEMBER).read()
+    b_config_bytes: bytes = b_archive.extractfile(ARCHIVE_CONFIG_MEMBER).read()
+    a_config: dict = yaml.safe_load(a_config_bytes)
+    b_config: dict = yaml.safe_load(b_config_bytes)
+
+    # config: top level keys, then entries by id
+    for key in sorted(set(a_config.keys()) | set(b_config.keys())):
+        if key != "entries" and a_config.get(key, None) != b_config.get(key, None):
+            warn_print(f'config changed: {key}')
+
+    a_entries: dict = { entry["id"]: entry for entry in a_config.get("entries", []) }
+    b_entries: dict = { entry["id"]: entry for entry in b_config.get("entries", []) }
+    for entry_id in a_entries:
+        if entry_id not in b_entries:
+            warn_print(f'entry removed: {entry_id}')
+        elif a_entries[entry_id] != b_entries[entry_id]:
+            warn_print(f'entry changed: {entry_id}')
+    for entry_id in b_entries:
+        if entry_id not in a_entries:
+            warn_print(f'entry added: {entry_id}')
+
+    # members: compared by manifest, contents are only read for members that differ
+    a_manifests: dict = get_archive_file_manifests(a_archive)
+    b_manifests: dict = get_archive_file_manifests(b_archive)
+    changed_names: List[str] = []
+    for name in a_manifests:
+        if name not in b_manifests:
+            warn_print(f'member removed: {name}')
+            changed_names.append(name)
+        elif (a_manifests[name]["sha256"], a_manifests[name]["size"]) != (b_manifests[name]["sha256"], b_manifests[name]["size"]):
+            warn_print(f'member modified: {name} ({a_manifests[name]["size"]} -> {b_manifests[name]["size"]} bytes)')
+            changed_names.append(name)
+        elif (a_manifests[name].get("mode"), a_manifests[name].get("owner")) != (b_manifests[name].get("mode"), b_manifests[name].get("owner")):
+            warn_print(f'member metadata changed: {name} ({format_manifest_metadata(a_manifests[name])} -> {format_manifest_metadata(b_manifests[name])})')
+    for name in b_manifests:
+        if name not in a_manifests:
+            warn_print(f'member added: {name}')
+            changed_names.append(name)
+
+    print(f'{len(changed_names)} of {len(set(a_manifests) | set(b_manifests))} members differ')
+
+    if opts["unified"]:
+        sys.stdout.write(make_unified_diff(a_config_bytes, b_config_bytes, "a/" + ARCHIVE_CONFIG_MEMBER, "b/" + ARCHIVE_CONFIG_MEMBER))
+
+        # both archives are decompressed at the same time
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            a_future = executor.submit(read_archive_members_for_diff, a_archive, [name for name in changed_names if name in a_manifests])
+            b_future = executor.submit(read_archive_members_for_diff, b_archive, [name for name in changed_names if name in b_manifests])
+            a_contents: dict = a_future.result()
+            b_contents: dict = b_future.result()
+
+        for name in changed_names:
+            if (name in a_contents and a_contents[name] is None) or (name in b_contents and b_contents[name] is None):
+                sys.stdout.write(f'Files a/{name} and b/{name} differ (larger than {DIFF_MAX_MEMBER_SIZE} bytes)\n')
+                continue
+            sys.stdout.write(make_unified_diff(a_contents.get(name, None), b_contents.get(name, None), "a/" + name if name in a_contents else "/dev/null", "b/" + name if name in b_contents else "/dev/null"))
+
+    a_archive.close()
+    b_archive.close()
+
 COMMAND_FUNC_ENTRIES = [
     CommandFuncEntry(("unpack", "u"), command_unpack),
-    CommandFuncEntry(("pack", "p"), command_pack)
+    CommandFuncEntry(("pack", "p"), command_pack),
+    CommandFuncEntry(("status", "s"), command_status),
+    CommandFuncEntry(("diff",), command_diff),
+    CommandFuncEntry(("rollback",), command_rollback),
+    CommandFuncEntry(("gc",), command_gc),
 ]
 
 def init():
@@ -729,15 +3988,32 @@ def init():
     Consts["CurrentGroup"] = grp.getgrgid(Consts["CurrentGroupId"])[0]
 
 def main():
+    if sys.argv[1:] == [PRIVILEGED_HELPER_COMMAND]:
+        # started by PrivilegedHelper, in a frozen myinit
+        exec(PRIVILEGED_HELPER_SOURCE, {"__name__": PRIVILEGED_HELPER_COMMAND})
+        return
     init()
-    opts_raw, args = getopt.gnu_getopt(sys.argv[1:], "-d-a-v", ["dry", "auto-default", "value-auto-default"])
+    opts_raw, args = getopt.gnu_getopt(sys.argv[1:], "-d-a-vj:u", ["dry", "auto-default", "value-auto-default", "jobs=", "chunked", "codec=", "unified", "incremental", "delta-from=", "keep=", "transactional", "answers=", "record-answers="])
     opts = {
-        "dry": False
+        "dry": False,
+        "jobs": None,
+        "chunked": False,
+        "incremental": False,
+        "delta_from": None,
+        "keep": None,
+        "transactional": False,
+        "codec": None,
+        "unified": False,
+        "record_answers": None,
     }
 
     if len(args) == 0:
-        eprint(f'Usage: {sys.argv[0]} {{unpack u}} [-d] [--dry] [-a] [--ask-auto-default] [-v] [--value-auto-default] <archive>.tar.gz')
-        eprint(f'       {sys.argv[0]} {{pack}} [-a] [--ask-auto-default] [-v] [--value-auto-default] [--auto-default]')
+        eprint(f'Usage: {sys.argv[0]} {{unpack u}} [-d] [--dry] [-a] [--ask-auto-default] [-v] [--value-auto-default] [-j <n>] [--jobs <n>] [--transactional] [--answers <file>] [--record-answers <file>] <archive>.tar.gz|- [<entry>|<entryprefix>/]')
+        eprint(f'       {sys.argv[0]} {{pack}} [-a] [--ask-auto-default] [-v] [--value-auto-default] [--auto-default] [-j <n>] [--jobs <n>] [--chunked] [--incremental] [--delta-from <old_archive>] [--codec <none|gzip[:1-9]|bz2[:1-9]|xz[:0-9]>] [--answers <file>] [--record-answers <file>]')
+        eprint(f'       {sys.argv[0]} {{status s}} [-j <n>] [--jobs <n>] [<workspace_dir>] [<entry>|<entryprefix>/]')
+        eprint(f'       {sys.argv[0]} {{diff}} [-u] [--unified] [-j <n>] [--jobs <n>] <archive_a> <archive_b>')
+        eprint(f'       {sys.argv[0]} {{rollback}} [-d] [--dry] [-a] [--ask-auto-default] [--answers <file>] [--record-answers <file>] [<version>] [<workspace_dir>]')
+        eprint(f'       {sys.argv[0]} {{gc}} [-d] [--dry] [--keep <n>] [<workspace_dir>]')
         sys.exit(3)
 
     for opt_raw in opts_raw:
@@ -747,14 +4023,49 @@ def main():
             Overrides["AskAutomaticallyUseDefault"] = True
         if opt_raw[0] == "-v" or opt_raw[0] == "--value-auto-default":
             Overrides["ValueAutomaticallyUseDefault"] = True
+        if opt_raw[0] == "-j" or opt_raw[0] == "--jobs":
+            opts["jobs"] = int(opt_raw[1])
+            assert opts["jobs"] > 0, "--jobs must be positive"
+        if opt_raw[0] == "--chunked":
+            opts["chunked"] = True
+        if opt_raw[0] == "--incremental":
+            opts["incremental"] = True
+        if opt_raw[0] == "--delta-from":
+            opts["delta_from"] = opt_raw[1]
+        if opt_raw[0] == "--transactional":
+            opts["transactional"] = True
+        if opt_raw[0] == "--keep":
+            opts["keep"] = int(opt_raw[1])
+            assert opts["keep"] > 0, "--keep must be positive"
+        if opt_raw[0] == "-u" or opt_raw[0] == "--unified":
+            opts["unified"] = True
+        if opt_raw[0] == "--codec":
+            parse_codec_spec(opt_raw[1])
+            opts["codec"] = opt_raw[1]
+        if opt_raw[0] == "--answers":
+            read_answers_file(opt_raw[1])
+        if opt_raw[0] == "--record-answers":
+            opts["record_answers"] = opt_raw[1]
+
+    if opts["jobs"] is None:
+        # unpack applies one file at a time unless asked to, keeping its output and questions in config order; pack
+        # compresses on one thread until a pool is shown to pay off on more than one core
+        command_name: str = next((cfe.command_names[0] for cfe in COMMAND_FUNC_ENTRIES if args[0] in cfe.command_names), args[0])
+        opts["jobs"] = 1 if command_name in ("unpack", "pack") else os.cpu_count() or 1
 
     cfe: CommandFuncEntry
-    for cfe in COMMAND_FUNC_ENTRIES:
-        if args[0] in cfe.command_names:
-            cfe.func(opts, args[1:])
-
-try:
-    main()
-except Exception:
-    error_print(traceback.format_exc())
-    sys.exit(2)
+    try:
+        for cfe in COMMAND_FUNC_ENTRIES:
+            if args[0] in cfe.command_names:
+                cfe.func(opts, args[1:])
+    finally:
+        # also when the run fails or is exited, keeping what was answered so far
+        if opts["record_answers"] is not None:
+            write_answers_file(opts["record_answers"])
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        error_print(traceback.format_exc())
+        sys.exit(2)
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# Helpers shared by the tests: they drive myinit through its command line, in temp workspaces, and import it for the
+# parts that have no command of their own.
+import os
+import sys
+import subprocess
+import pathlib
+
+import pytest
+
+MYINIT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "myinit.py")
+
+sys.path.insert(0, os.path.dirname(MYINIT))
+
+CONFIG_TEMPLATE = """specVersion: 1
+confVersion: {conf_version}
+id: {config_id}
+commonVarDict:
+  SysRoot: "{sys_root}/"
+  WorkspaceDir: "{unpack_workspace}/"
+entries:
+  - id: files
+    type: file
+    files:
+      - {{name: a, archiveDir: "d/", systemDir: "{{SysRoot}}"}}
+      - {{name: b, archiveDir: "d/sub/", systemDir: "{{SysRoot}}sub/"}}
+"""
+
+def run_myinit(cwd: pathlib.Path, *args: str, check: bool = True, input: bytes = None) -> subprocess.CompletedProcess:
+    # stdin is /dev/null unless input is given, so a question nobody expected fails the run
+    proc = subprocess.run([sys.executable, MYINIT, *args], cwd=cwd, input=input, stdin=subprocess.DEVNULL if input is None else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env={**os.environ, "EDITOR": "true"})
+    if check:
+        assert proc.returncode == 0, proc.stderr.decode()
+    return proc
+
+class Workspace:
+    # a workspace to pack from, the system files it points at and the workspace unpack installs into
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.pack_workspace = root / "pack"
+        self.unpack_workspace = root / "unpack"
+        self.sys_root = root / "sys"
+        (self.pack_workspace / "__extra__").mkdir(parents=True)
+        self.unpack_workspace.mkdir()
+        (self.sys_root / "sub").mkdir(parents=True)
+
+    def write_system_files(self, a: str, b: str):
+        (self.sys_root / "a").write_text(a)
+        (self.sys_root / "sub" / "b").write_text(b)
+
+    def read_system_files(self) -> tuple:
+        return (self.sys_root / "a").read_text(), (self.sys_root / "sub" / "b").read_text()
+
+    def write_config(self, config_text: str):
+        (self.pack_workspace / "config.yaml").write_text(config_text.replace("{root}", self.root.as_posix()))
+
+    def pack(self, conf_version: int, *args: str, config_id: str = "rt") -> pathlib.Path:
+        self.write_config(CONFIG_TEMPLATE.format(conf_version=conf_version, config_id=config_id, sys_root=self.sys_root, unpack_workspace=self.unpack_workspace))
+        return self.pack_config(f'{config_id}.{conf_version}', *args)
+
+    def pack_config(self, archive_stem: str, *args: str) -> pathlib.Path:
+        # packs the config.yaml written last
+        run_myinit(self.pack_workspace, "pack", "-a", *args)
+        archive_paths = list(self.pack_workspace.glob(f'{archive_stem}.tar*'))
+        assert len(archive_paths) == 1
+        return archive_paths[0]
+
+    def unpack(self, archive_path: pathlib.Path, *args: str, check: bool = True) -> subprocess.CompletedProcess:
+        return run_myinit(self.pack_workspace, "unpack", "-a", *args, str(archive_path), check=check)
+
+@pytest.fixture
+def workspace(tmp_path: pathlib.Path) -> Workspace:
+    return Workspace(tmp_path)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+import os
+import stat
+import shutil
+
+from conftest import Workspace, run_myinit
+
+from pyyaml.lib3 import yaml
+
+CONFIG = """specVersion: 1
+confVersion: {conf_version}
+id: rt
+commonVarDict:
+  SysRoot: "{root}/sys/"
+  WorkspaceDir: "{root}/unpack/"
+  Greeting: {{}}
+entries:
+  - id: files
+    type: file
+    files:
+      - {{name: a, archiveDir: "d/", systemDir: "{{SysRoot}}"}}
+  - id: greet
+    type: command
+    askForConfirm: true
+    command: "echo {{Greeting}} > {root}/greeting"
+"""
+
+def pack(workspace: Workspace, conf_version: int):
+    workspace.write_config(CONFIG.format(conf_version=conf_version, root="{root}"))
+    return workspace.pack_config(f'rt.{conf_version}')
+
+def test_recorded_answers_replay_without_prompting(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = pack(workspace, 1)
+    answers_path = workspace.root / "answers.yaml"
+
+    proc = run_myinit(workspace.pack_workspace, "unpack", "--record-answers", answers_path.as_posix(), archive_path.as_posix(), input=b"y\nhello\n")
+    assert b"Input value for variable Greeting" in proc.stdout + proc.stderr
+    assert (workspace.root / "greeting").read_text() == "hello\n"
+    assert stat.S_IMODE(os.stat(answers_path).st_mode) == 0o0600
+    assert yaml.safe_load(answers_path.read_text()) == {"variables": {"Greeting": "hello"}, "ask": {"entry_ask_for_confirm": "yes"}}
+
+    # as on another machine, with stdin at /dev/null
+    shutil.rmtree(workspace.unpack_workspace)
+    (workspace.root / "greeting").unlink()
+    proc = run_myinit(workspace.pack_workspace, "unpack", "--answers", answers_path.as_posix(), archive_path.as_posix())
+    assert b"Input value" not in proc.stdout + proc.stderr and b"apply this entry?" not in proc.stdout + proc.stderr
+    assert (workspace.root / "greeting").read_text() == "hello\n"
+
+def test_answers_settle_conflicts(workspace: Workspace):
+    answers_path = workspace.root / "answers.yaml"
+    workspace.write_system_files("alpha\n", "beta\n")
+    first_archive_path = pack(workspace, 1)
+    workspace.write_system_files("alpha 2\n", "beta\n")
+    second_archive_path = pack(workspace, 2)
+
+    answers_path.write_text("variables:\n  Greeting: hi\nask:\n  entry_ask_for_confirm: yes\n  conflict: skip\n")
+    run_myinit(workspace.pack_workspace, "unpack", "--answers", answers_path.as_posix(), first_archive_path.as_posix())
+    (workspace.sys_root / "a").write_text("local change\n")
+    run_myinit(workspace.pack_workspace, "unpack", "--answers", answers_path.as_posix(), second_archive_path.as_posix())
+    assert (workspace.sys_root / "a").read_text() == "local change\n"
+
+    answers_path.write_text(answers_path.read_text().replace("conflict: skip", "conflict: overwrite"))
+    run_myinit(workspace.pack_workspace, "unpack", "--answers", answers_path.as_posix(), second_archive_path.as_posix())
+    assert (workspace.sys_root / "a").read_text() == "alpha 2\n"
+
+def test_answer_that_is_not_an_option_fails(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = pack(workspace, 1)
+    answers_path = workspace.root / "answers.yaml"
+    answers_path.write_text("variables:\n  Greeting: hi\nask:\n  entry_ask_for_confirm: maybe\n")
+    proc = run_myinit(workspace.pack_workspace, "unpack", "--answers", answers_path.as_posix(), archive_path.as_posix(), check=False)
+    assert proc.returncode != 0
+    assert b"answer to entry_ask_for_confirm is not one of yes/no/exit: maybe" in proc.stderr
@@ -0,0 +1,13 @@
+#!/usr/bin/python3
+import pytest
+
+from conftest import Workspace
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_chunked_round_trip(workspace: Workspace, jobs: str):
+    workspace.write_system_files("alpha\n", "beta\n" * 100000)
+    archive_path = workspace.pack(1, "--chunked", "--codec", "gzip:1")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path, "-j", jobs)
+    assert workspace.read_system_files() == ("alpha\n", "beta\n" * 100000)
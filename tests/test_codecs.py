@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+import pytest
+
+from conftest import Workspace, run_myinit
+
+@pytest.mark.parametrize("codec, suffix", [
+    ("none", ".tar"),
+    ("gzip", ".tar.gz"),
+    ("gzip:9", ".tar.gz"),
+    ("bz2", ".tar.bz2"),
+    ("xz", ".tar.xz"),
+])
+def test_codec_round_trip(workspace: Workspace, codec: str, suffix: str):
+    workspace.write_system_files("alpha\n", "beta\n" * 10000)
+    archive_path = workspace.pack(1, "--codec", codec)
+    assert archive_path.name == "rt.1" + suffix
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    assert workspace.read_system_files() == ("alpha\n", "beta\n" * 10000)
+    assert (workspace.unpack_workspace / archive_path.name).exists()
+
+@pytest.mark.parametrize("codec", ["none", "gzip", "bz2", "xz"])
+def test_codec_is_detected_from_the_stream(workspace: Workspace, codec: str):
+    # read from stdin, there is no file name to tell the codec by
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = workspace.pack(1, "--codec", codec)
+
+    workspace.write_system_files("changed\n", "changed\n")
+    run_myinit(workspace.pack_workspace, "unpack", "-a", "-", input=archive_path.read_bytes())
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
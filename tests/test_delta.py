@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+from conftest import Workspace
+
+def test_delta_archive(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n" * 10000)
+    base_archive_path = workspace.pack(1)
+    workspace.write_system_files("alpha 2\n", "beta\n" * 10000)
+    delta_archive_path = workspace.pack(2, "--delta-from", str(base_archive_path))
+    assert delta_archive_path.stat().st_size < base_archive_path.stat().st_size
+
+    workspace.unpack(base_archive_path)
+    workspace.write_system_files("alpha\n", "beta\n" * 10000)
+    workspace.unpack(delta_archive_path)
+    assert workspace.read_system_files() == ("alpha 2\n", "beta\n" * 10000)
+
+def test_delta_archive_removes_files(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    base_archive_path = workspace.pack(1)
+    workspace.write_config(f"""specVersion: 1
+confVersion: 2
+id: rt
+commonVarDict:
+  SysRoot: "{workspace.sys_root}/"
+  WorkspaceDir: "{workspace.unpack_workspace}/"
+entries:
+  - id: files
+    type: file
+    files:
+      - {{name: a, archiveDir: "d/", systemDir: "{{SysRoot}}"}}
+""")
+    delta_archive_path = workspace.pack_config("rt.2", "--delta-from", str(base_archive_path))
+
+    workspace.unpack(base_archive_path)
+    workspace.unpack(delta_archive_path)
+    assert (workspace.sys_root / "a").read_text() == "alpha\n"
+    assert not (workspace.sys_root / "sub" / "b").exists()
+
+def test_delta_archive_needs_its_base(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    base_archive_path = workspace.pack(1)
+    workspace.write_system_files("alpha 2\n", "beta\n")
+    delta_archive_path = workspace.pack(2, "--delta-from", str(base_archive_path))
+
+    # nothing was unpacked into the workspace, so the base is not at hand
+    proc = workspace.unpack(delta_archive_path, check=False)
+    assert proc.returncode != 0
+    assert b"is a delta from rt version 1, but nothing is installed in" in proc.stderr
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+from conftest import Workspace
+
+CONFIG_HEAD = """specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  WorkspaceDir: "{root}/unpack/"
+entries:
+"""
+
+def test_entries_run_after_their_dependencies(workspace: Workspace):
+    workspace.write_config(CONFIG_HEAD + """  - id: late
+    type: command
+    dependsOn: [early]
+    command: {value: "echo late >> {root}/log", doNotFormat: true}
+  - id: early
+    type: command
+    dependsOn: []
+    command: {value: "sleep 0.2; echo early >> {root}/log", doNotFormat: true}
+  - id: independent
+    type: command
+    dependsOn: []
+    command: {value: "echo independent | tee -a {root}/log", doNotFormat: true}
+""")
+    archive_path = workspace.pack_config("rt.1")
+    proc = workspace.unpack(archive_path, "-j", "2")
+    assert (workspace.root / "log").read_text().split() == ["independent", "early", "late"]
+    # commands running side by side have their output prefixed
+    assert b"[independent] independent\n" in proc.stdout + proc.stderr
+
+def test_depends_on_cycle_is_reported(workspace: Workspace):
+    workspace.write_config(CONFIG_HEAD + """  - id: first
+    type: command
+    dependsOn: [second]
+    command: "true"
+  - id: second
+    type: command
+    dependsOn: [first]
+    command: "true"
+  - id: third
+    type: command
+    dependsOn: [second]
+    command: "true"
+""")
+    archive_path = workspace.pack_config("rt.1")
+    proc = workspace.unpack(archive_path, check=False)
+    assert proc.returncode != 0
+    assert b"entries on or waiting for a dependsOn cycle: first, second, third" in proc.stderr
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import myinit
+
+from conftest import Workspace, run_myinit
+
+CONFIG = """specVersion: 1
+confVersion: {conf_version}
+id: rt
+commonVarDict:
+  SysRoot: "{root}/sys/"
+entries:
+  - id: files
+    type: file
+    files:
+{files}
+"""
+
+def pack_files(workspace: Workspace, conf_version: int, files: str):
+    workspace.write_config(CONFIG.format(conf_version=conf_version, root="{root}", files=files))
+    return workspace.pack_config(f'rt.{conf_version}')
+
+def test_diff_two_versions(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    (workspace.sys_root / "c").write_text("gamma\n")
+    a_archive_path = pack_files(workspace, 1, """      - {name: a, archiveDir: "d/", systemDir: "{SysRoot}"}
+      - {name: b, archiveDir: "d/sub/", systemDir: "{SysRoot}sub/"}
+      - {name: c, archiveDir: "d/", systemDir: "{SysRoot}"}""")
+    (workspace.sys_root / "a").write_text("alpha 2\n")
+    b_archive_path = pack_files(workspace, 2, """      - {name: a, archiveDir: "d/", systemDir: "{SysRoot}"}
+      - {name: c, archiveDir: "d/", systemDir: "{SysRoot}", mode: "600"}""")
+
+    proc = run_myinit(workspace.pack_workspace, "diff", "-u", a_archive_path.name, b_archive_path.name)
+    output = (proc.stdout + proc.stderr).decode()
+    assert "config changed: confVersion" in output
+    assert "entry changed: files" in output
+    assert "member modified: d/a (6 -> 8 bytes)" in output
+    assert "member removed: d/sub/b" in output
+    assert "member metadata changed: d/c (644 " in output and "-> 600 " in output
+    assert "2 of 3 members differ" in output
+    assert "-alpha\n+alpha 2\n" in output
+    assert "--- a/d/sub/b\n+++ /dev/null\n" in output
+
+def test_diff_of_identical_archives(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = workspace.pack(1)
+    proc = run_myinit(workspace.pack_workspace, "diff", archive_path.name, archive_path.name)
+    assert "0 of 2 members differ" in (proc.stdout + proc.stderr).decode()
+
+def test_metadata_without_mode():
+    assert myinit.format_manifest_metadata({"mode": 0o0644, "owner": "root:root"}) == "644 root:root"
+    assert myinit.format_manifest_metadata({"sha256": "", "size": 0}) == "- -"
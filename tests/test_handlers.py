@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+from conftest import Workspace
+
+CONFIG = """specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  SysRoot: "{root}/sys/"
+  WorkspaceDir: "{root}/unpack/"
+entries:
+  - id: reload
+    type: command
+    handler: true
+    command: {value: "echo reload >> {root}/log", doNotFormat: true}
+  - id: first
+    type: file
+    notify: reload
+    files:
+      - {name: a, archiveDir: "d/", systemDir: "{SysRoot}"}
+%s  - id: second
+    type: file
+    files:
+      - {name: b, archiveDir: "d/sub/", systemDir: "{SysRoot}sub/", notify: [reload]}
+  - id: last
+    type: command
+    command: {value: "echo last >> {root}/log", doNotFormat: true}
+"""
+
+FLUSH = """  - id: flush
+    type: flush
+"""
+
+def read_log(workspace: Workspace) -> list:
+    log_path = workspace.root / "log"
+    return log_path.read_text().split() if log_path.exists() else []
+
+def test_handler_notified_twice_runs_once(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config(CONFIG % "")
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    # at the end of unpack, after the command entries
+    assert read_log(workspace) == ["last", "reload"]
+
+def test_handler_is_not_run_when_nothing_was_written(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config(CONFIG % "")
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.unpack(archive_path)
+    assert read_log(workspace) == ["last"]
+
+    (workspace.sys_root / "sub" / "b").write_text("changed\n")
+    workspace.unpack(archive_path)
+    assert read_log(workspace) == ["last", "last", "reload"]
+
+def test_flush_runs_the_handlers_notified_so_far(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config(CONFIG % FLUSH)
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    assert read_log(workspace) == ["reload", "last", "reload"]
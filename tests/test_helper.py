@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+import io
+import os
+import sys
+import stat
+import hashlib
+import pathlib
+
+import pytest
+
+import myinit
+
+from conftest import MYINIT, Workspace
+
+def put_sudo_on_path(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    # stands in for sudo, running the helper as the current user; the protocol is the same
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "sudo").write_text('#!/bin/sh\nshift 2\nexec "$@"\n')
+    os.chmod(bin_dir / "sudo", 0o0755)
+    monkeypatch.setenv("PATH", f'{bin_dir}:{os.environ["PATH"]}')
+
+@pytest.fixture
+def helper(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    put_sudo_on_path(tmp_path, monkeypatch)
+    helper = myinit.PrivilegedHelper("nobody")
+    yield helper
+    helper.close()
+
+# none, less than, exactly and more than a chunk
+@pytest.mark.parametrize("size", [0, 1000, myinit.COMPARE_CHUNK_SIZE, 3 * myinit.COMPARE_CHUNK_SIZE + 17])
+def test_write_and_read_file(helper: myinit.PrivilegedHelper, tmp_path: pathlib.Path, size: int):
+    content = os.urandom(size)
+    written_stat = helper.write_file((tmp_path / "f").as_posix(), io.BytesIO(content), None, "640", 0o0600)
+    assert (tmp_path / "f").read_bytes() == content
+    assert written_stat.st_size == size and stat.S_IMODE(written_stat.st_mode) == 0o0640
+
+    read_content = io.BytesIO()
+    read_stat = helper.read_file((tmp_path / "f").as_posix(), read_content)
+    assert read_content.getvalue() == content
+    assert read_stat.st_ino == os.stat(tmp_path / "f").st_ino
+
+    assert helper.hash_files([(tmp_path / "f").as_posix()]) == [hashlib.sha256(content).hexdigest()]
+    # no temp files are left beside the file
+    assert sorted(os.listdir(tmp_path)) == ["bin", "f"]
+
+def test_batched_operations_fail_one_by_one(helper: myinit.PrivilegedHelper, tmp_path: pathlib.Path):
+    (tmp_path / "f").write_bytes(b"f")
+    results = helper.stat_files([(tmp_path / "f").as_posix(), (tmp_path / "missing").as_posix(), (tmp_path / "f").as_posix()])
+    assert isinstance(results[0], os.stat_result) and results[0].st_size == 1
+    assert isinstance(results[1], FileNotFoundError) and results[1].filename == (tmp_path / "missing").as_posix()
+    assert results[2].st_ino == results[0].st_ino
+
+    with pytest.raises(FileNotFoundError):
+        helper.read_file((tmp_path / "missing").as_posix(), io.BytesIO())
+    # the helper is still usable after a failed call
+    assert helper.hash_files([(tmp_path / "f").as_posix()]) == [hashlib.sha256(b"f").hexdigest()]
+
+def test_makedirs_and_mode(helper: myinit.PrivilegedHelper, tmp_path: pathlib.Path):
+    helper.makedirs((tmp_path / "a" / "b").as_posix(), 0o0750)
+    (tmp_path / "a" / "b" / "f").write_bytes(b"")
+    helper.apply_owner_and_mode((tmp_path / "a" / "b" / "f").as_posix(), None, "600")
+    assert stat.S_IMODE(os.stat(tmp_path / "a" / "b" / "f").st_mode) == 0o0600
+
+def test_frames_round_trip(helper: myinit.PrivilegedHelper, tmp_path: pathlib.Path):
+    # a frame with a body: the chunk of a write goes after the JSON header
+    (tmp_path / "f").write_bytes(b"")
+    results, body = helper.call([["stat", (tmp_path / "f").as_posix()], ["hash", (tmp_path / "f").as_posix()]])
+    assert body == b""
+    assert results[1] == hashlib.sha256(b"").hexdigest()
+
+def test_helper_of_a_frozen_myinit(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    # a frozen myinit is its own sys.executable, and runs the helper through its hidden command
+    frozen_myinit = tmp_path / "myinit"
+    frozen_myinit.write_text(f'#!/bin/sh\nexec {sys.executable} {MYINIT} "$@"\n')
+    os.chmod(frozen_myinit, 0o0755)
+    monkeypatch.setattr(sys, "frozen", True, raising=False)
+    monkeypatch.setattr(sys, "executable", frozen_myinit.as_posix())
+    assert myinit.get_privileged_helper_argv() == [frozen_myinit.as_posix(), myinit.PRIVILEGED_HELPER_COMMAND]
+
+    put_sudo_on_path(tmp_path, monkeypatch)
+    helper = myinit.PrivilegedHelper("nobody")
+    try:
+        helper.write_file((tmp_path / "f").as_posix(), io.BytesIO(b"frozen"), None, None, 0o0644)
+        assert helper.hash_files([(tmp_path / "f").as_posix()]) == [hashlib.sha256(b"frozen").hexdigest()]
+    finally:
+        helper.close()
+
+def test_stale_staging_dirs_are_removed(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    (workspace.pack_workspace / "__extra__" / "extra").write_text("extra\n")
+    archive_path = workspace.pack(1)
+
+    # a run that was killed, and one still running (this one)
+    dead_pid = os.fork()
+    if dead_pid == 0:
+        os._exit(0)
+    os.waitpid(dead_pid, 0)
+    stale_dir = workspace.unpack_workspace / f'{myinit.WORKSPACE_STAGING_DIR_PREFIX}{dead_pid}-abc'
+    live_dir = workspace.unpack_workspace / f'{myinit.WORKSPACE_STAGING_DIR_PREFIX}{os.getpid()}-abc'
+    for staging_dir in (stale_dir, live_dir):
+        (staging_dir / "__extra__").mkdir(parents=True)
+
+    workspace.unpack(archive_path)
+    assert not stale_dir.exists()
+    assert live_dir.exists()
+    assert (workspace.unpack_workspace / "__extra__" / "extra").read_text() == "extra\n"
+    assert [path.name for path in workspace.unpack_workspace.glob(myinit.WORKSPACE_STAGING_DIR_PREFIX + "*")] == [live_dir.name]
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+import os
+import time
+import sqlite3
+
+import myinit
+
+from conftest import Workspace, run_myinit
+
+LARGE = "beta\n" * 700000
+
+def test_incremental_pack_reuses_unchanged_members(workspace: Workspace):
+    # larger than a compressed block, so b gets chunks of its own that can be reused whatever happens to a
+    workspace.write_system_files("alpha\n", LARGE)
+    # files modified just now are not cached, as they could change again within the mtime granularity
+    for system_file_path in (workspace.sys_root / "a", workspace.sys_root / "sub" / "b"):
+        os.utime(system_file_path, (time.time() - 3600, time.time() - 3600))
+    workspace.pack(1, "--incremental")
+    with sqlite3.connect((workspace.pack_workspace / myinit.INSTALLED_LEDGER_FILENAME).as_posix()) as conn:
+        assert sorted(row[0] for row in conn.execute("SELECT system_path FROM stat_cache")) == [f'{workspace.sys_root}/a', f'{workspace.sys_root}/sub/b']
+
+    (workspace.sys_root / "a").write_text("alpha 2\n")
+    workspace.write_config((workspace.pack_workspace / "config.yaml").read_text().replace("confVersion: 1", "confVersion: 2"))
+    proc = run_myinit(workspace.pack_workspace, "pack", "-a", "--incremental")
+    assert b"reusing unchanged members of: rt.1.tar.gz" in proc.stdout + proc.stderr
+    # b and the __extra__/ dir; a is read again
+    assert b"reused 2 of 3 members" in proc.stdout + proc.stderr
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(workspace.pack_workspace / "rt.2.tar.gz")
+    assert workspace.read_system_files() == ("alpha 2\n", LARGE)
+
+def test_incremental_pack_without_previous_archive(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.pack(1, "--incremental")
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(workspace.pack_workspace / "rt.1.tar.gz")
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
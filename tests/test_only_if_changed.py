@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+from conftest import Workspace
+
+CONFIG = """specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  WorkspaceDir: "{root}/unpack/"
+entries:
+  - id: build
+    type: command
+    onlyIfChanged: true
+    watchFiles: ["{root}/input", "{root}/input_dir/"]
+    command: {value: "echo run >> {root}/runs", doNotFormat: true}
+"""
+
+def count_runs(workspace: Workspace) -> int:
+    runs_path = workspace.root / "runs"
+    return len(runs_path.read_text().split()) if runs_path.exists() else 0
+
+def test_unchanged_command_is_skipped(workspace: Workspace):
+    (workspace.root / "input").write_text("1\n")
+    (workspace.root / "input_dir").mkdir()
+    workspace.write_config(CONFIG)
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 1
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 1
+
+    (workspace.root / "input").write_text("2\n")
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 2
+
+    (workspace.root / "input_dir" / "new").write_text("")
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 3
+
+    # a missing path counts as a value too
+    (workspace.root / "input").unlink()
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 4
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 4
+
+def test_changed_command_text_runs_again(workspace: Workspace):
+    workspace.write_config(CONFIG)
+    workspace.unpack(workspace.pack_config("rt.1"))
+    workspace.unpack(workspace.pack_config("rt.1"))
+    assert count_runs(workspace) == 1
+
+    workspace.write_config(CONFIG.replace("echo run", "echo changed"))
+    workspace.unpack(workspace.pack_config("rt.1"))
+    assert count_runs(workspace) == 2
+
+def test_failed_command_is_not_recorded(workspace: Workspace):
+    workspace.write_config(CONFIG.replace('"echo run >> {root}/runs"', '"echo run >> {root}/runs; [ -e {root}/ok ]"'))
+    archive_path = workspace.pack_config("rt.1")
+    assert workspace.unpack(archive_path, check=False).returncode != 0
+    (workspace.root / "ok").write_text("")
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 2
+    workspace.unpack(archive_path)
+    assert count_runs(workspace) == 2
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+import os
+import pwd
+import grp
+
+import pytest
+
+import myinit
+
+from conftest import Workspace
+
+# ids with neither a passwd nor a group entry
+UNKNOWN_ID = 54321
+
+@pytest.fixture(autouse=True)
+def unknown_id_is_unknown():
+    for lookup in (pwd.getpwuid, grp.getgrgid):
+        with pytest.raises(KeyError):
+            lookup(UNKNOWN_ID)
+
+@pytest.mark.parametrize("owner, uid_gid", [
+    ("root", (0, -1)),
+    ("0", (0, -1)),
+    (str(UNKNOWN_ID), (UNKNOWN_ID, -1)),
+    (f'{UNKNOWN_ID}:{UNKNOWN_ID}', (UNKNOWN_ID, UNKNOWN_ID)),
+    (f'root:{UNKNOWN_ID}', (0, UNKNOWN_ID)),
+    (f'{UNKNOWN_ID}:root', (UNKNOWN_ID, 0)),
+    ("root:", (0, pwd.getpwnam("root").pw_gid)),
+    ("nobody:", (pwd.getpwnam("nobody").pw_uid, pwd.getpwnam("nobody").pw_gid)),
+    ("0:", (0, pwd.getpwuid(0).pw_gid)),
+    (":root", (-1, 0)),
+    (f':{UNKNOWN_ID}', (-1, UNKNOWN_ID)),
+])
+def test_resolve_owner(owner: str, uid_gid: tuple):
+    assert myinit.resolve_owner(owner) == uid_gid
+
+@pytest.mark.parametrize("owner", [
+    "no-such-user",
+    "root:no-such-group",
+    ":no-such-group",
+    # the login group of an id without a passwd entry is unknown
+    f'{UNKNOWN_ID}:',
+])
+def test_resolve_invalid_owner(owner: str):
+    with pytest.raises(RuntimeError, match=f'invalid owner: {owner}'):
+        myinit.resolve_owner(owner)
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="chown to another user needs root")
+def test_pack_and_unpack_numeric_owner(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config(f"""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  SysRoot: "{workspace.sys_root}/"
+  WorkspaceDir: "{workspace.unpack_workspace}/"
+entries:
+  - id: files
+    type: file
+    files:
+      - {{name: a, archiveDir: "d/", systemDir: "{{SysRoot}}", owner: "{UNKNOWN_ID}:{UNKNOWN_ID}", mode: "640"}}
+      - {{name: b, archiveDir: "d/sub/", systemDir: "{{SysRoot}}sub/", owner: ":{UNKNOWN_ID}"}}
+""")
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    a_stat = os.stat(workspace.sys_root / "a")
+    b_stat = os.stat(workspace.sys_root / "sub" / "b")
+    assert (a_stat.st_uid, a_stat.st_gid, a_stat.st_mode & 0o7777) == (UNKNOWN_ID, UNKNOWN_ID, 0o640)
+    assert (b_stat.st_uid, b_stat.st_gid) == (0, UNKNOWN_ID)
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+import io
+import sys
+import gzip
+import shutil
+import subprocess
+
+import pytest
+
+import myinit
+
+from conftest import Workspace
+
+def test_parallel_gzip_is_read_by_stock_gunzip():
+    payload = b"".join(b"line %d of the payload\n" % i for i in range(200000))
+    out = io.BytesIO()
+    writer = myinit.ParallelCompressWriter(out, 4)
+    for offset in range(0, len(payload), 100000):
+        writer.write(payload[offset:offset + 100000])
+    writer.close()
+
+    assert gzip.decompress(out.getvalue()) == payload
+    if shutil.which("gunzip") is not None:
+        assert subprocess.run(["gunzip", "-c"], input=out.getvalue(), stdout=subprocess.PIPE, check=True).stdout == payload
+
+def test_pack_unpack_round_trip_on_several_threads(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n" * 100000)
+    archive_path = workspace.pack(1, "-j", "4")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    assert workspace.read_system_files() == ("alpha\n", "beta\n" * 100000)
+
+@pytest.mark.parametrize("argv, jobs", [
+    (["pack"], 1),
+    (["p"], 1),
+    (["p", "-j", "3"], 3),
+    (["unpack", "x.tar.gz"], 1),
+    (["u", "x.tar.gz"], 1),
+    (["s"], 8),
+])
+def test_default_jobs(monkeypatch: pytest.MonkeyPatch, argv: list, jobs: int):
+    called_opts = []
+    monkeypatch.setattr(myinit, "COMMAND_FUNC_ENTRIES", [
+        myinit.CommandFuncEntry(("unpack", "u"), lambda opts, rest_argv: called_opts.append(opts)),
+        myinit.CommandFuncEntry(("pack", "p"), lambda opts, rest_argv: called_opts.append(opts)),
+        myinit.CommandFuncEntry(("status", "s"), lambda opts, rest_argv: called_opts.append(opts)),
+    ])
+    # commands without a default of their own use every core
+    monkeypatch.setattr(myinit.os, "cpu_count", lambda: 8)
+    monkeypatch.setattr(sys, "argv", ["myinit", *argv])
+    myinit.main()
+    assert [opts["jobs"] for opts in called_opts] == [jobs]
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+from conftest import Workspace
+
+def test_command_entries_share_a_shell(workspace: Workspace):
+    # $$ is the pid of the login shell, also in the subshell each script runs in
+    workspace.write_config("""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  WorkspaceDir: "{root}/unpack/"
+entries:
+  - id: first
+    type: command
+    command: {value: "echo $$ >> {root}/pids; cd /; export LEAKED=1; exit 0", doNotFormat: true}
+  - id: second
+    type: command
+    command: {value: "echo $$ >> {root}/pids; echo \\"$PWD ${LEAKED:-unset}\\" > {root}/state", doNotFormat: true}
+  - id: third
+    type: command
+    freshShell: true
+    command: {value: "echo $$ >> {root}/pids", doNotFormat: true}
+""")
+    workspace.unpack(workspace.pack_config("rt.1"))
+    first_pid, second_pid, third_pid = (workspace.root / "pids").read_text().split()
+    assert first_pid == second_pid
+    assert third_pid != first_pid
+    # exit, cd and exports stay in the subshell of their entry
+    assert (workspace.root / "state").read_text().split() == [workspace.pack_workspace.as_posix(), "unset"]
+
+def test_failing_command_fails_the_unpack(workspace: Workspace):
+    workspace.write_config("""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  WorkspaceDir: "{root}/unpack/"
+entries:
+  - id: failing
+    type: command
+    command: "exit 3"
+  - id: after
+    type: command
+    command: {value: "touch {root}/after", doNotFormat: true}
+""")
+    proc = workspace.unpack(workspace.pack_config("rt.1"), check=False)
+    assert proc.returncode != 0
+    assert b"returned status code 3" in proc.stderr
+    assert not (workspace.root / "after").exists()
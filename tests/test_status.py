@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+import os
+import pathlib
+
+import myinit
+
+from conftest import Workspace, run_myinit
+
+def run_status(workspace: Workspace) -> tuple:
+    proc = run_myinit(workspace.unpack_workspace, "status", check=False)
+    return proc.returncode, (proc.stdout + proc.stderr).decode()
+
+def test_status_reports_drift(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.unpack(workspace.pack(1))
+
+    returncode, output = run_status(workspace)
+    assert returncode == 0
+    assert "2 managed files checked" in output and "0 drifted" in output
+
+    (workspace.sys_root / "a").write_text("modified\n")
+    (workspace.sys_root / "sub" / "b").unlink()
+    returncode, output = run_status(workspace)
+    assert returncode == 1
+    assert f'modified: {workspace.sys_root}/a' in output
+    assert f'missing: {workspace.sys_root}/sub/b' in output
+    assert "2 drifted" in output
+
+    os.chmod(workspace.sys_root / "a", 0o0600)
+    (workspace.sys_root / "a").write_text("alpha\n")
+    (workspace.sys_root / "sub" / "b").write_text("beta\n")
+    returncode, output = run_status(workspace)
+    assert returncode == 1
+    assert f'mode changed: {workspace.sys_root}/a 644 -> 600' in output
+    assert "modified:" not in output and "missing:" not in output
+
+def test_status_only_hashes_files_whose_stat_changed(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.unpack(workspace.pack(1))
+    run_status(workspace)
+
+    _, output = run_status(workspace)
+    assert "0 hashed" in output
+    (workspace.sys_root / "a").write_text("alpha 2\n")
+    _, output = run_status(workspace)
+    assert "1 hashed" in output
+
+def test_ledger_in_a_path_that_needs_quoting(tmp_path: pathlib.Path):
+    # the read-only ledger is opened through an sqlite URI, where ?, # and % mean something
+    workspace = Workspace(tmp_path / "a ?#%20 b")
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = workspace.pack(1)
+    workspace.unpack(archive_path)
+
+    returncode, output = run_status(workspace)
+    assert returncode == 0 and "2 managed files checked" in output
+
+    ledger = myinit.InstalledLedger((workspace.unpack_workspace / myinit.INSTALLED_LEDGER_FILENAME).as_posix(), read_only=True)
+    assert sorted(installed_record["system_path"] for installed_record in ledger.get_all()) == [f'{workspace.sys_root}/a', f'{workspace.sys_root}/sub/b']
+    ledger.close()
+
+    # a dry run only reads the ledger
+    proc = workspace.unpack(archive_path, "--dry")
+    assert b"Traceback" not in proc.stderr
@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+import os
+
+from conftest import Workspace
+
+def test_unpack_transactional(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = workspace.pack(1)
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path, "--transactional", "-j", "2")
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
+
+def test_failed_commit_leaves_every_file_as_it_was(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    archive_path = workspace.pack(1)
+
+    # b can not be replaced, once a already has been
+    (workspace.sys_root / "a").write_text("old\n")
+    (workspace.sys_root / "sub" / "b").unlink()
+    (workspace.sys_root / "sub" / "b").mkdir()
+    (workspace.sys_root / "sub" / "b" / "keep").write_text("")
+    proc = workspace.unpack(archive_path, "--transactional", check=False)
+    assert proc.returncode != 0
+    assert (workspace.sys_root / "a").read_text() == "old\n"
+    assert os.listdir(workspace.sys_root / "sub" / "b") == ["keep"]
+    # no staged temp files or backups are left behind
+    assert sorted(os.listdir(workspace.sys_root)) == ["a", "sub"]
+    assert os.listdir(workspace.sys_root / "sub") == ["b"]
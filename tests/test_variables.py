@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+import pytest
+
+from conftest import Workspace, run_myinit
+
+def test_variables_resolve_through_references(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config("""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  Root: "{root}/"
+  SysRoot: "{Root}sys/"
+  SubDir: {refVar: SysRoot}
+  WorkspaceDir: "{root}/unpack/"
+entries:
+  - id: files
+    type: file
+    varDict:
+      SubDir: "{SysRoot}sub/"
+    files:
+      - {name: a, archiveDir: "d/", systemDir: "{SysRoot}"}
+      - {name: b, archiveDir: "d/sub/", systemDir: "{SubDir}"}
+""")
+    archive_path = workspace.pack_config("rt.1")
+
+    workspace.write_system_files("changed\n", "changed\n")
+    workspace.unpack(archive_path)
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
+
+@pytest.mark.parametrize("common_var_dict, cycle", [
+    ('  A: "{B}/a"\n  B: "{C}/b"\n  C: "{A}/c"\n', "A -> B -> C -> A"),
+    ('  A: "{A}/a"\n', "A -> A"),
+    ('  A: {refVar: B}\n  B: {refVar: A}\n', "A -> B -> A"),
+])
+def test_variable_cycle_is_reported(workspace: Workspace, common_var_dict: str, cycle: str):
+    workspace.write_config("""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+""" + common_var_dict + """entries:
+  - id: files
+    type: file
+    files:
+      - {name: a, archiveDir: "d/", systemDir: "{A}"}
+""")
+    proc = run_myinit(workspace.pack_workspace, "pack", "-a", check=False)
+    assert proc.returncode != 0
+    assert f'variable depends on itself: {cycle}'.encode() in proc.stderr
+
+def test_unused_variables_are_not_resolved(workspace: Workspace):
+    # a cycle nothing refers to is never looked at
+    workspace.write_system_files("alpha\n", "beta\n")
+    workspace.write_config("""specVersion: 1
+confVersion: 1
+id: rt
+commonVarDict:
+  SysRoot: "{root}/sys/"
+  WorkspaceDir: "{root}/unpack/"
+  Unused: "{Unused}"
+entries:
+  - id: files
+    type: file
+    files:
+      - {name: a, archiveDir: "d/", systemDir: "{SysRoot}"}
+""")
+    workspace.unpack(workspace.pack_config("rt.1"))
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+from conftest import Workspace, run_myinit
+
+def archive_names(workspace: Workspace) -> list:
+    return sorted(path.name for path in workspace.unpack_workspace.glob("*.tar*"))
+
+def test_superseded_archives_are_removed(workspace: Workspace):
+    archive_paths = []
+    for conf_version in (1, 2, 3):
+        workspace.write_system_files(f'alpha {conf_version}\n', "beta\n")
+        archive_paths.append(workspace.pack(conf_version))
+    for archive_path in archive_paths:
+        workspace.unpack(archive_path)
+    assert archive_names(workspace) == [archive_paths[-1].name]
+
+def test_delta_bases_are_kept(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    base_archive_path = workspace.pack(1)
+    workspace.write_system_files("alpha 2\n", "beta\n")
+    delta_archive_path = workspace.pack(2, "--delta-from", str(base_archive_path))
+
+    workspace.unpack(base_archive_path)
+    workspace.unpack(delta_archive_path)
+    assert archive_names(workspace) == [base_archive_path.name, delta_archive_path.name]
+
+def test_archives_of_other_configs_are_kept(workspace: Workspace):
+    # another config installed into the same workspace before, whose archives are still the bases of its next delta
+    workspace.write_system_files("alpha\n", "beta\n")
+    other_base_archive_path = workspace.pack(1, config_id="rvconf")
+    workspace.write_system_files("alpha 2\n", "beta\n")
+    other_delta_archive_path = workspace.pack(2, "--delta-from", str(other_base_archive_path), config_id="rvconf")
+    workspace.unpack(other_base_archive_path)
+    workspace.unpack(other_delta_archive_path)
+
+    workspace.write_system_files("alpha 3\n", "beta\n")
+    archive_paths = [workspace.pack(1), workspace.pack(2)]
+    for archive_path in archive_paths:
+        workspace.unpack(archive_path)
+    assert archive_names(workspace) == ["rt.2.tar.gz", "rvconf.1.tar.gz", "rvconf.2.tar.gz"]
+
+    run_myinit(workspace.unpack_workspace, "gc")
+    assert archive_names(workspace) == ["rt.2.tar.gz", "rvconf.1.tar.gz", "rvconf.2.tar.gz"]
+
+def test_rollback(workspace: Workspace):
+    workspace.write_system_files("alpha\n", "beta\n")
+    first_archive_path = workspace.pack(1)
+    workspace.write_system_files("alpha 2\n", "beta 2\n")
+    second_archive_path = workspace.pack(2)
+
+    workspace.unpack(first_archive_path)
+    workspace.unpack(second_archive_path)
+    assert workspace.read_system_files() == ("alpha 2\n", "beta 2\n")
+
+    # restored from the blob store; the archive of version 1 is gone by now
+    run_myinit(workspace.unpack_workspace, "rollback", "-a")
+    assert workspace.read_system_files() == ("alpha\n", "beta\n")
+
+    run_myinit(workspace.unpack_workspace, "rollback", "-a", "2")
+    assert workspace.read_system_files() == ("alpha 2\n", "beta 2\n")
+
+    # with stdin at /dev/null, a question about the missing archive would fail the run
+    workspace.write_system_files("alpha 3\n", "beta 3\n")
+    third_archive_path = workspace.pack(3)
+    workspace.write_system_files("alpha 2\n", "beta 2\n")
+    workspace.unpack(third_archive_path)
+    assert workspace.read_system_files() == ("alpha 3\n", "beta 3\n")
+
+def test_gc(workspace: Workspace):
+    for conf_version in (1, 2, 3):
+        workspace.write_system_files(f'alpha {conf_version}\n', "beta\n")
+        workspace.unpack(workspace.pack(conf_version))
+    blob_count = len(list((workspace.unpack_workspace / "objects").rglob("*/*")))
+
+    proc = run_myinit(workspace.unpack_workspace, "gc", "--keep", "1")
+    assert b"removed 2 unreferenced blobs" in proc.stdout + proc.stderr
+    assert len(list((workspace.unpack_workspace / "objects").rglob("*/*"))) == blob_count - 2
+    assert run_myinit(workspace.unpack_workspace, "rollback", "-a", check=False).returncode != 0
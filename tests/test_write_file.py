@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+import io
+import os
+import pwd
+import pathlib
+
+import pytest
+
+import myinit
+
+NOBODY = pwd.getpwnam("nobody")
+
+def write_file(path: pathlib.Path, content: bytes, owner: str = None, mode: str = None):
+    temp_path, target_path = myinit.write_file_beside(io.BytesIO(content), path.as_posix(), owner, mode, 0o0600)
+    myinit.move_file_into_place(temp_path, target_path, owner, mode)
+    return temp_path
+
+def test_new_file_gets_new_file_mode(tmp_path: pathlib.Path):
+    write_file(tmp_path / "f", b"new")
+    assert (tmp_path / "f").read_bytes() == b"new"
+    assert os.stat(tmp_path / "f").st_mode & 0o7777 == 0o0600
+    assert os.listdir(tmp_path) == ["f"]
+
+def test_existing_file_keeps_its_mode(tmp_path: pathlib.Path):
+    (tmp_path / "f").write_bytes(b"old")
+    os.chmod(tmp_path / "f", 0o0751)
+    temp_path = write_file(tmp_path / "f", b"new")
+    assert os.path.dirname(temp_path) == tmp_path.as_posix()
+    assert (tmp_path / "f").read_bytes() == b"new"
+    assert os.stat(tmp_path / "f").st_mode & 0o7777 == 0o0751
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="chown to another user needs root")
+def test_owner_and_mode_are_applied(tmp_path: pathlib.Path):
+    (tmp_path / "f").write_bytes(b"old")
+    write_file(tmp_path / "f", b"new", f'{NOBODY.pw_uid}:{NOBODY.pw_gid}', "640")
+    f_stat = os.stat(tmp_path / "f")
+    assert (f_stat.st_uid, f_stat.st_gid, f_stat.st_mode & 0o7777) == (NOBODY.pw_uid, NOBODY.pw_gid, 0o0640)
+
+    # and kept by the next write without owner and mode
+    write_file(tmp_path / "f", b"newer")
+    f_stat = os.stat(tmp_path / "f")
+    assert (f_stat.st_uid, f_stat.st_gid, f_stat.st_mode & 0o7777) == (NOBODY.pw_uid, NOBODY.pw_gid, 0o0640)
+
+def test_file_that_can_not_be_replaced_is_written_in_place(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    # as for a file of another user, or in a dir that is not writable
+    (tmp_path / "f").write_bytes(b"a longer old content")
+    os.chmod(tmp_path / "f", 0o0666)
+    inode = os.stat(tmp_path / "f").st_ino
+    monkeypatch.setattr(myinit, "can_replace_file_beside", lambda target_path, target_stat: False)
+
+    temp_path = write_file(tmp_path / "f", b"new")
+    assert os.path.dirname(temp_path) != tmp_path.as_posix()
+    assert not os.path.exists(temp_path)
+    assert (tmp_path / "f").read_bytes() == b"new"
+    f_stat = os.stat(tmp_path / "f")
+    assert (f_stat.st_ino, f_stat.st_mode & 0o7777) == (inode, 0o0666)
+    assert os.listdir(tmp_path) == ["f"]
+
+def test_matching_owner_and_mode_are_left_alone(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch):
+    # a process that may not chown or chmod a file still gets through when nothing has to change
+    (tmp_path / "f").write_bytes(b"")
+    os.chmod(tmp_path / "f", 0o0644)
+    f_stat = os.stat(tmp_path / "f")
+
+    def refuse(*args):
+        raise PermissionError(1, "Operation not permitted")
+    monkeypatch.setattr(myinit.os, "chown", refuse)
+    monkeypatch.setattr(myinit.os, "chmod", refuse)
+    myinit.apply_owner_and_mode((tmp_path / "f").as_posix(), f'{f_stat.st_uid}:{f_stat.st_gid}', "644")
+    with pytest.raises(PermissionError):
+        myinit.apply_owner_and_mode((tmp_path / "f").as_posix(), None, "600")